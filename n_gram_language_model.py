@@ -13,8 +13,9 @@ WikiText-2, a corpus of high-quality Wikipedia articles. The dataset was origina
 The code was primarily designed to run on Google Colab.
 """
 
-!pip install torchdata==0.5.1
-!pip install torchtext==0.14.0
+# On Colab, install the dependencies of torchtext.datasets first (only needed to download WikiText-2 with getDataset()):
+# !pip install torchdata==0.5.1
+# !pip install torchtext==0.14.0
 
 """## Preprocessing Data
 
@@ -29,49 +30,296 @@ START = "<s>"   # Start-of-sentence token
 END = "</s>"    # End-of-sentence-token
 UNK = "<UNK>"   # Unknown word token
 
-import torchtext
+import functools
+import importlib.util
 import random
 import sys
+import time
 
-def preprocess(data, vocab=None):
-    final_data = []
+def lazyImport(name):
+    '''
+    Return the module 'name', only executed on the first access to one of its attributes (see importlib.util.LazyLoader),
+    so that importing this file doesn't pay for the heavy dependencies until they are used.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named %r" % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+np = lazyImport('numpy')
+json = lazyImport('json')
+asyncio = lazyImport('asyncio')
+
+def iterPreprocess(data, vocab=None, counts=None):
+    '''
+    Streaming version of preprocess: read the paragraphs of 'data' (any iterable of strings, such as readParagraphs(path)) lazily,
+    and yield every sentence, surrounded by '<s>' and '</s>', as soon as it is complete.
+    If 'counts' is a dictionary, the number of occurrences of every token of the yielded sentences is added to it in the same pass.
+    '''
     lowercase = "abcdefghijklmnopqrstuvwxyz"
     for paragraph in data:
         paragraph = [x if x != '<unk>' else UNK for x in paragraph.split()]
         if vocab is not None:
             paragraph = [x if x in vocab else UNK for x in paragraph]
         if paragraph == [] or paragraph.count('=') >= 2: continue
-        sen = []
+        sen = [START]
         prev_punct, prev_quot = False, False
         for word in paragraph:
             if prev_quot:
                 if word[0] not in lowercase:
-                    final_data.append(sen)
-                    sen = []
+                    sen.append(END)
+                    yield countTokens(sen, counts)
+                    sen = [START]
                     prev_punct, prev_quot = False, False
             if prev_punct:
                 if word == '"':
                     prev_punct, prev_quot = False, True
                 else:
                     if word[0] not in lowercase:
-                        final_data.append(sen)
-                        sen = []
+                        sen.append(END)
+                        yield countTokens(sen, counts)
+                        sen = [START]
                         prev_punct, prev_quot = False, False
             if word in {'.', '?', '!'}: prev_punct = True
-            sen += [word]
+            sen.append(word)
         if sen[-1] not in {'.', '?', '!', '"'}: continue # Prevent a lot of short sentences
-        final_data.append(sen)
-    vocab_was_none = vocab is None
+        sen.append(END)
+        yield countTokens(sen, counts)
+
+def countTokens(sentence, counts):
+    '''
+    Add the tokens of the sentence to the 'counts' dictionary (unless it is None) and return the sentence.
+    '''
+    if counts is not None:
+        for word in sentence:
+            counts[word] = counts.get(word, 0) + 1
+    return sentence
+
+def readParagraphs(path, encoding='utf-8'):
+    '''
+    Lazily yield the paragraphs (lines) of a raw text file, such as the wiki.train.raw file of WikiText.
+    '''
+    with open(path, encoding=encoding) as f:
+        yield from f
+
+def preprocess(data, vocab=None):
+    counts = {} if vocab is None else None
+    final_data = list(iterPreprocess(data, vocab, counts))
     if vocab is None:
-        vocab = set()
-    for i in range(len(final_data)):
-        final_data[i] = [START] + final_data[i] + [END]
-        if vocab_was_none:
-            for word in final_data[i]:
-                vocab.add(word)
+        vocab = set(counts)
     return final_data, vocab
 
-def getDataset():
+# Classes of the tokens for the sentence splitter: only the words that don't start with a lowercase letter change its state
+LOWER, END_PUNCT, QUOTE, OTHER = 0, 1, 2, 3
+
+def splitParagraphs(ids, lengths, classes, equals):
+    '''
+    Split the token ids of consecutive paragraphs of 'lengths' tokens into sentences exactly like iterPreprocess,
+    'classes' being the class of every token id and 'equals' the id of '=' (-1 if there is none).
+    A sentence starts before a word of another class than LOWER if the previous such word of the paragraph is an END_PUNCT and the word isn't a QUOTE,
+    or if the previous one is a QUOTE itself preceded by an END_PUNCT; the last sentence of a paragraph is kept if it ends with an END_PUNCT or a QUOTE.
+    Return the ids of the sentences surrounded by the ids 0 and 1 (START and END) and the offsets of the sentences.
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    paragraphs = np.repeat(np.arange(len(lengths)), lengths)
+    headings = np.bincount(paragraphs[ids == equals], minlength=len(lengths)) >= 2
+    keep = ~headings[paragraphs]
+    ids, paragraphs = ids[keep], paragraphs[keep]
+    if not len(ids):
+        return np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+
+    token_classes = classes[ids]
+    marked = np.flatnonzero(token_classes != LOWER)
+    marked_classes, marked_paragraphs = token_classes[marked], paragraphs[marked]
+    after_punct = (marked_classes[:-1] == END_PUNCT) & (marked_classes[1:] != QUOTE)
+    after_quote = np.zeros(len(after_punct), dtype=bool)
+    after_quote[1:] = (marked_classes[1:-1] == QUOTE) & (marked_classes[:-2] == END_PUNCT) & (marked_paragraphs[:-2] == marked_paragraphs[2:])
+    splits = marked[1:][(marked_paragraphs[:-1] == marked_paragraphs[1:]) & (after_punct | after_quote)]
+
+    starts = np.union1d(np.flatnonzero(np.r_[True, paragraphs[1:] != paragraphs[:-1]]), splits)
+    stops = np.r_[starts[1:], len(ids)]
+    last = np.r_[paragraphs[stops[:-1]] != paragraphs[stops[:-1] - 1], True]
+    kept = ~last | np.isin(token_classes[stops - 1], (END_PUNCT, QUOTE))
+    starts, stops = starts[kept], stops[kept]
+
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(stops - starts + 2, out=offsets[1:])
+    inside = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.add.at(inside, starts, 1)
+    np.add.at(inside, stops, -1)
+    sentences = np.empty(offsets[-1], dtype=np.int32)
+    sentences[offsets[:-1]], sentences[offsets[1:] - 1] = 0, 1
+    words = np.ones(offsets[-1], dtype=bool)
+    words[offsets[:-1]] = words[offsets[1:] - 1] = False
+    sentences[words] = ids[np.cumsum(inside[:-1]) > 0]
+    return sentences, offsets
+
+def scanCorpus(data, vocab=None, chunk_size=100000):
+    '''
+    Fast version of preprocess, with the same sentences: the paragraphs are only split into words and mapped to ids through a dictionary,
+    the '<unk>' and 'vocab' replacements and the token classes are computed once per distinct word,
+    and the sentences of 'chunk_size' paragraphs at a time are found with array operations (see splitParagraphs).
+    Return the sentences as an EncodedCorpus, the ids being numbered in the order in which the tokens first occur,
+    and the set of their tokens (or 'vocab' if given), like loadCorpus.
+    '''
+    lowercase = "abcdefghijklmnopqrstuvwxyz"
+    index = {} # Token id of every distinct word of the paragraphs
+    words = Vocabulary([START, END]) # Tokens of the sentences
+    classes = [OTHER, OTHER] # Class of every token
+    chunks, lengths = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)]
+    for chunk in iterChunks(data, chunk_size):
+        joined = '\0' not in ''.join(chunk)
+        if joined: # Split all the paragraphs at once, separated by a '\0' token, which is then dropped
+            tokens = ' \0 '.join(chunk).split()
+            index['\0'] = -1
+        else:
+            tokens = [token for paragraph in chunk for token in paragraph.split()]
+            index.pop('\0', None)
+        for raw in dict.fromkeys(tokens).keys() - index.keys():
+            word = UNK if raw == '<unk>' else raw
+            if vocab is not None and word not in vocab:
+                word = UNK
+            if word not in words:
+                classes.append(LOWER if word[0] in lowercase else END_PUNCT if word in {'.', '?', '!'} else QUOTE if word == '"' else OTHER)
+            index[raw] = words.add(word)
+        ids = np.fromiter(map(index.__getitem__, tokens), dtype=np.int32, count=len(tokens))
+        if joined:
+            separators = np.flatnonzero(ids < 0)
+            chunk_lengths = np.diff(separators, prepend=-1, append=len(ids)) - 1
+            ids = np.delete(ids, separators)
+        else:
+            chunk_lengths = [len(paragraph.split()) for paragraph in chunk]
+        sentences, offsets = splitParagraphs(ids, chunk_lengths, np.array(classes, dtype=np.int8), words.word2idx.get('=', -1))
+        chunks.append(sentences)
+        lengths.append(np.diff(offsets))
+
+    ids, lengths = np.concatenate(chunks), np.concatenate(lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    first = np.full(len(words), len(ids))
+    np.minimum.at(first, ids, np.arange(len(ids)))
+    present = np.flatnonzero(first < len(ids))
+    order = present[np.argsort(first[present])]
+    mapping = np.zeros(len(words), dtype=np.int32)
+    mapping[order] = np.arange(len(order))
+    tokens = words.decode(order)
+    return EncodedCorpus(tokens, mapping[ids], offsets), set(tokens) if vocab is None else vocab
+
+import os
+
+CORPUS_CACHE_VERSION = 1
+
+class EncodedCorpus(object):
+    def __init__(self, tokens, ids, offsets):
+        '''
+        Read-only list of sentences stored as the int32 ids of their tokens in one flat array, sentence i being ids[offsets[i]:offsets[i+1]],
+        and 'tokens' the list of the token of every id. A sentence is decoded into a list of tokens on access,
+        while Vocabulary.encode_corpus and countCorpus read the ids directly.
+        '''
+        self.tokens = tokens
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return EncodedCorpus(self.tokens, self.ids, self.offsets[start:max(start, stop) + 1])
+        if i < 0:
+            i += len(self)
+        tokens = self.tokens
+        return [tokens[j] for j in self.ids[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def encode(self, vocab, grow=False):
+        '''
+        Return the ids of the tokens of the corpus in 'vocab' and the offsets of the sentences, like vocab.encode_corpus(corpus, grow).
+        With 'grow' the new tokens are added in the order in which they first occur, as when encoding the sentences one by one.
+        '''
+        lo = int(self.offsets[0])
+        ids = self.ids[lo:int(self.offsets[-1])]
+        if grow:
+            present, first = np.unique(ids, return_index=True)
+            tokens = self.tokens
+            vocab.encode([tokens[j] for j in present[np.argsort(first)]], grow=True)
+        mapping = vocab.encode(self.tokens)
+        return mapping[ids], self.offsets - lo
+
+def corpusKey(path, vocab=None, encoding='utf-8'):
+    '''
+    Return the cache key of the preprocessed corpus of a text file: the SHA-256 of its contents and of the preprocessing options,
+    the vocabulary (if any) being hashed as its sorted tokens.
+    '''
+    import hashlib
+    options = {'version': CORPUS_CACHE_VERSION, 'encoding': encoding,
+               'vocab': None if vocab is None else hashlib.sha256('\n'.join(sorted(vocab)).encode('utf-8')).hexdigest()}
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def writeCorpusCache(path, directory, vocab=None, encoding='utf-8'):
+    '''
+    Preprocess a text file (see scanCorpus) into a cache directory: 'vocab.txt' with one token per line in the order of their ids,
+    'ids.npy' with the int32 ids of all the tokens and 'offsets.npy' with the int64 offsets of the sentences.
+    The files are written to a temporary directory that is renamed at the end, so a cache directory is always complete.
+    '''
+    import shutil, tempfile
+    corpus, _ = scanCorpus(readParagraphs(path, encoding), vocab)
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent)
+    with open(os.path.join(temporary, 'vocab.txt'), 'w', encoding='utf-8') as f:
+        f.writelines(word + '\n' for word in corpus.tokens)
+    np.save(os.path.join(temporary, 'ids.npy'), corpus.ids)
+    np.save(os.path.join(temporary, 'offsets.npy'), corpus.offsets)
+    try:
+        os.rename(temporary, directory)
+    except OSError: # Written by another process in the meantime
+        shutil.rmtree(temporary)
+
+def loadCorpus(path, vocab=None, cache_dir='.cache', encoding='utf-8'):
+    '''
+    Offline, cached version of preprocess(readParagraphs(path), vocab) for a raw text file, such as the wiki.train.raw file of WikiText-2.
+    The first call preprocesses the file into cache_dir (see writeCorpusCache), under the key of its contents and options (see corpusKey);
+    the next ones memory-map the cached arrays without reading the text again.
+    Return the sentences as an EncodedCorpus and the set of their tokens (or 'vocab' if given), like preprocess.
+    '''
+    directory = os.path.join(cache_dir, corpusKey(path, vocab, encoding))
+    if not os.path.isdir(directory):
+        writeCorpusCache(path, directory, vocab, encoding)
+    with open(os.path.join(directory, 'vocab.txt'), encoding='utf-8') as f:
+        tokens = f.read().split('\n')[:-1]
+    ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+    return EncodedCorpus(tokens, ids, offsets), set(tokens) if vocab is None else vocab
+
+def getDataset(directory=None, cache_dir='.cache'):
+    '''
+    Return the preprocessed training and validation sentences of WikiText-2, downloaded through torchtext,
+    or read offline from the wiki.train.raw and wiki.valid.raw files of 'directory' and cached (see loadCorpus).
+    '''
+    if directory is not None:
+        train_dataset, vocab = loadCorpus(os.path.join(directory, 'wiki.train.raw'), cache_dir=cache_dir)
+        test_dataset, _ = loadCorpus(os.path.join(directory, 'wiki.valid.raw'), vocab, cache_dir)
+        return train_dataset, test_dataset
+
+    import torchtext
     dataset = torchtext.datasets.WikiText2(root='.data', split=('train', 'valid'))
     train_dataset, vocab = preprocess(dataset[0])
     test_dataset, _ = preprocess(dataset[1], vocab)
@@ -85,539 +333,4402 @@ if __name__ == '__main__':
     for x in random.sample(train_dataset, 10):
         print (x)
 
+"""Sanity check: `scanCorpus` must split WikiText-2 into exactly the sentences of `preprocess`, the validation set being mapped to the vocabulary of the training set."""
+
+def sanityCheckScanCorpus(directory=None):
+    import hashlib, time
+    if directory is not None:
+        train_data, test_data = [list(readParagraphs(os.path.join(directory, name))) for name in ('wiki.train.raw', 'wiki.valid.raw')]
+    else:
+        import torchtext
+        train_data, test_data = [list(split) for split in torchtext.datasets.WikiText2(root='.data', split=('train', 'valid'))]
+
+    print("--- TEST: scanCorpus == preprocess ---")
+    vocab = None
+    passed = True
+    for name, data in (('train', train_data), ('valid', test_data)):
+        start = time.perf_counter()
+        sentences, correct_vocab = preprocess(data, vocab)
+        preprocess_time = time.perf_counter() - start
+        start = time.perf_counter()
+        corpus, scanned_vocab = scanCorpus(data, vocab)
+        scan_time = time.perf_counter() - start
+        correct = '\n'.join(' '.join(sentence) for sentence in sentences).encode('utf-8')
+        scanned = '\n'.join(' '.join(sentence) for sentence in corpus).encode('utf-8')
+        same = scanned == correct and scanned_vocab == correct_vocab
+        print(name, '\t', len(sentences), 'sentences, sha256', hashlib.sha256(correct).hexdigest()[:16], hashlib.sha256(scanned).hexdigest()[:16],
+              '\tpreprocess %.2fs, scanCorpus %.2fs' % (preprocess_time, scan_time), '\t', 'PASSED' if same else 'FAILED')
+        passed &= same
+        vocab = correct_vocab
+    print("Test scanCorpus passed!" if passed else "Test scanCorpus failed...")
+
+if __name__ == '__main__':
+    sanityCheckScanCorpus()
+
 """## The language moedel class
 
 4 tpyes of language models are implemented: a unigram model, a smoothed uigram model, a bigram model, a smoothed bigram model.
 """
 
 import math
-import random
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice, repeat
 
-class LanguageModel(object):
-    def __init__(self, trainCorpus):
+class Vocabulary(object):
+    def __init__(self, tokens=()):
         '''
-        Initialize and train the model (i.e. estimate the model's underlying probability
-        distribution from the training corpus.)
+        Map tokens to dense integer ids, in the order in which they are first seen.
+        A vocabulary can be shared between models so a corpus only needs to be interned once.
         '''
+        self.word2idx = {} # Mapping of word to index
+        self.idx2word = [] # Mapping of index to word
+        for token in tokens:
+            self.add(token)
 
-        return
-
-    def generateSentence(self):
+    @classmethod
+    def from_arrays(cls, chars, offsets):
         '''
-        Generate a sentence by drawing words according to the model's probability distribution.
-        Note: Think about how to set the length of the sentence in a principled way.
+        Rebuild a vocabulary from the arrays returned by to_arrays.
         '''
+        text = bytes(chars)
+        offsets = offsets.tolist()
+        return cls(text[lo:hi].decode('utf-8') for lo, hi in zip(offsets[:-1], offsets[1:]))
 
-        raise NotImplementedError("Implement generateSentence in each subclass.")
-
-    def getSentenceLogProbability(self, sentence):
+    def to_arrays(self):
         '''
-        Calculate the log probability of the sentence provided.
+        Return the UTF-8 bytes of all the tokens, concatenated in id order, as a uint8 array, and the int64 offsets of each token in it.
         '''
+        tokens = [word.encode('utf-8') for word in self.idx2word]
+        offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in tokens], out=offsets[1:])
+        return np.frombuffer(b''.join(tokens), dtype=np.uint8), offsets
 
-        raise NotImplementedError("Implement getSentenceProbability in each subclass.")
+    def __len__(self):
+        return len(self.idx2word)
 
-    def getCorpusPerplexity(self, testCorpus):
+    def __contains__(self, word):
+        return word in self.word2idx
+
+    def add(self, word):
         '''
-        Calculate the perplexity of the corpus provided.
+        Return the id of the word, assigning it a new one if the word hasn't been seen yet.
         '''
+        idx = self.word2idx.get(word)
+        if idx is None:
+            idx = len(self.idx2word)
+            self.word2idx[word] = idx
+            self.idx2word.append(word)
+        return idx
 
-        raise NotImplementedError("Implement getCorpusPerplexity in each subclass.")
-
-    def printSentences(self, n):
+    def encode(self, sentence, grow=False):
         '''
-        Prints n sentences generated by your model.
+        Return an int32 array with the id of every token of the sentence.
+        Unknown tokens are added to the vocabulary if 'grow' is True and mapped to -1 otherwise.
         '''
+        word2idx = self.word2idx
+        if grow:
+            size = len(word2idx)
+            ids = [word2idx.setdefault(word, len(word2idx)) for word in sentence]
+            self.idx2word.extend(islice(word2idx, size, None))
+            return np.array(ids, dtype=np.int32)
+        return np.fromiter(map(word2idx.get, sentence, repeat(-1)), dtype=np.int32, count=len(sentence))
 
-        for i in range(n):
-            sent = self.generateSentence()
-            prob = self.getSentenceLogProbability(sent)
-            print('Log Probability:', prob , '\tSentence:',sent)
-
-"""### Unigram Model"""
+    def encode_corpus(self, corpus, grow=False):
+        '''
+        Encode a list of sentences into one flat id array.
+        Return the ids and the offsets of the sentences, sentence i being ids[offsets[i]:offsets[i+1]].
+        '''
+        if isinstance(corpus, EncodedCorpus):
+            return corpus.encode(self, grow)
+        tokens = []
+        lengths = []
+        for sentence in corpus:
+            tokens.extend(sentence)
+            lengths.append(len(sentence))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return self.encode(tokens, grow), offsets
 
-from binascii import Error
-class UnigramModel(LanguageModel):
-    def __init__(self, trainCorpus):
+    def decode(self, ids):
         '''
-        Initialize and train the model (i.e. estimate the model's underlying probability
-        distribution from the training corpus.)
-        'trainCorpus' is a list of sentence where each sentence is a list of words.
+        Map an iterable of ids back to their tokens.
         '''
-        self.corpus = trainCorpus
-        self.model = self.train()
+        idx2word = self.idx2word
+        return [idx2word[i] for i in ids]
 
+import zlib
 
-    def train(self):
+def hashTokens(chars, offsets):
+    '''
+    Build an open addressing hash table of the tokens of the arrays returned by Vocabulary.to_arrays,
+    hashed with the CRC-32 of their UTF-8 bytes and probed linearly.
+    Return an int32 array of a power of 2 size at least twice the number of tokens, holding the id of a token or -1 in every slot.
+    '''
+    text, offsets = bytes(chars), offsets.tolist()
+    slots = np.full(1 << max(2 * (len(offsets) - 1), 1).bit_length(), -1, dtype=np.int32)
+    mask = len(slots) - 1
+    for i, (lo, hi) in enumerate(zip(offsets[:-1], offsets[1:])):
+        slot = zlib.crc32(text[lo:hi]) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+    return slots
+
+class TokenList(object):
+    def __init__(self, chars, offsets):
         '''
-        Train the model by calculating the probability of each word in then corpus.
-        Return a dictionary which map tokens to their unigram frequency and the total counts of all tokens.
+        Read-only list of the tokens stored in the arrays returned by Vocabulary.to_arrays, decoded on access.
         '''
-        model = {}
-        total_counts = 0
-        for sentence in self.corpus:
-            for word in sentence:
-                if word != '<s>':
-                    total_counts += 1
-                    if word in model:
-                        model[word] += 1
-                    else:
-                        model[word] = 1
+        self.chars = memoryview(chars)
+        self.offsets = offsets
 
-        for word in model:
-            model[word] /= total_counts
+    def __len__(self):
+        return len(self.offsets) - 1
 
-        return model
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return bytes(self.chars[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
 
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
-    def generateSentence(self):
+class TokenIndex(object):
+    def __init__(self, chars, offsets, slots):
         '''
-        Generate a sentence using the unigram model, the sentence should be starting with the '<s>' and end with the token '</s>'.
-        Return a list of tokens representing the sentence.
+        Read-only mapping of the tokens stored in the arrays returned by Vocabulary.to_arrays to their ids, through the table of hashTokens.
         '''
-        import random
-        # Initialize the sentence
-        sentence = []
-        sentence.append('<s>')
-        # Random select tokens from the dictionary based on the count (which is propotional to the frequency)
+        self.chars = memoryview(chars)
+        self.offsets = offsets
+        self.slots = slots
+        self.mask = len(slots) - 1
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, word, default=None):
+        token = word.encode('utf-8')
+        chars, offsets, slots, mask = self.chars, self.offsets, self.slots, self.mask
+        slot = zlib.crc32(token) & mask
         while True:
-            word = random.choices(list(self.model.keys()), weights = self.model.values())[0]
-            sentence.append(word)
-            if word == '</s>':
-                break
+            i = int(slots[slot])
+            if i < 0:
+                return default
+            if chars[offsets[i]:offsets[i + 1]] == token:
+                return i
+            slot = (slot + 1) & mask
 
-        return sentence
+    def __getitem__(self, word):
+        i = self.get(word)
+        if i is None:
+            raise KeyError(word)
+        return i
 
+    def __contains__(self, word):
+        return self.get(word) is not None
 
-    def getSentenceLogProbability(self, sentence):
+class MappedVocabulary(Vocabulary):
+    def __init__(self, chars, offsets, slots=None):
         '''
-        Calculate the log probability of the given sentence.
-        Input is a list of tokens representing a sentence beginning with '<s>' and ends with '</s>'.
-        Output is a float number representing the log probabity of the sentence from the unigram model.
+        Read-only vocabulary working directly on the arrays returned by Vocabulary.to_arrays (and the table of hashTokens, built if not given),
+        without a Python object per token: when the arrays are memory-mapped, every process using them shares their pages.
         '''
-        import math
-        sum_logprob = 0
-        for word in sentence[1:]:
-            if word not in self.model:
-                raise ValueError("Sentence contains tokens that doesn't belong to the corpus")
-            sum_logprob += math.log(self.model[word])
+        if slots is None:
+            slots = hashTokens(chars, offsets)
+        self.word2idx = TokenIndex(chars, offsets, slots)
+        self.idx2word = TokenList(chars, offsets)
+        self.arrays = (chars, offsets)
 
-        return sum_logprob
+    def to_arrays(self):
+        return self.arrays
 
-    def getCorpusPerplexity(self, testCorpus):
+    def add(self, word):
+        idx = self.word2idx.get(word)
+        if idx is None:
+            raise ValueError("Can't add %r to a read-only vocabulary" % word)
+        return idx
+
+    def encode(self, sentence, grow=False):
+        if grow:
+            return np.array([self.add(word) for word in sentence], dtype=np.int32)
+        return super().encode(sentence)
+
+def logProbabilities(probs):
+    '''
+    Return the natural logs of an array of probabilities, -infinity for the probabilities of 0.
+    '''
+    with np.errstate(divide='ignore'):
+        return np.log(probs, dtype=np.float64)
+
+def sumSegments(values, offsets):
+    '''
+    Sum the values of each segment values[offsets[i]:offsets[i+1]], empty segments summing to 0.
+    '''
+    sums = np.zeros(len(offsets) - 1, dtype=np.asarray(values).dtype)
+    nonempty = offsets[1:] > offsets[:-1]
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+"""### Counting n-grams
+
+All the models count their corpus into an `NGramTrie` of sorted arrays rather than nested dictionaries: the node of a k-gram is identified by the node of its (k-1)-gram prefix and its last word, so every level is one sorted array of `parent * vocabulary size + word` keys with a parallel array of counts. The successors of a context are a contiguous slice of the next level, and a lookup is one binary search per word.
+
+Counting can be split over worker processes: each one counts a contiguous shard of the corpus with its own vocabulary, and the partial tries are merged by sorting their concatenated keys and summing the counts of equal keys. The shard vocabularies are merged in order, so the token ids, and therefore the trained model, are exactly the ones of a serial run.
+"""
+
+class NGramTrie(object):
+    def __init__(self, keys, counts, size):
         '''
-        Calculate the perplexity of the corpus provided. The begnning token '<s>' is not counted in this case
-        The input is the corpus, which is list of sentences
-        The output is the perplexity of the corpus
+        Counts of all the k-grams (k = 1..n) of a corpus, stored as a trie in sorted arrays.
+        Level k holds the (k+1)-grams: the node of a (k+1)-gram is the position of the key parent * size + word in the sorted keys[k],
+        parent being the node of its k-gram prefix at level k-1 (0 for the unigrams of level 0) and size the vocabulary size.
+        counts[k] holds the number of occurrences of each node of level k, counts is None for a trie holding the k-grams of a model without their counts.
         '''
-        import math
-        total_log_prob = 0
-        total_word_count = 0
-        for sentence in testCorpus:
-            for word in sentence[1:]:
-                total_log_prob += math.log(self.model[word])
-                total_word_count += 1
-        return math.exp(-total_log_prob / total_word_count)
+        self.keys = keys
+        self.counts = counts
+        self.size = size
 
-"""Here's sanity check on the function"""
+    @property
+    def order(self):
+        return len(self.keys)
 
-def sanityCheck(model_type):
-    assert model_type in {'unigram', 'bigram', 'smoothed-unigram', 'smoothed-bigram'}
+    @property
+    def nbytes(self):
+        return sum(keys.nbytes for keys in self.keys) + (0 if self.counts is None else sum(counts.nbytes for counts in self.counts))
 
-    #	Read in the test corpus
-    train_corpus = ["By the Late Classic , a network of few <unk> ( few <unk> ) linked various parts of the city , running for several kilometres through its urban core .",
-    "Few people realize how difficult it was to create Sonic 's graphics engine , which allowed for the incredible rate of speed the game 's known for ."]
-    test_corpus = ["Classic few parts of the game allowed for few <unk> <unk> incredible city .",
-                   "Few <unk> realize the difficult network , which linked the game to Sonic ."]
-    train_corpus, _ = preprocess(train_corpus)
-    test_corpus, _ = preprocess(test_corpus)
-    sentence = preprocess(["Sonic was difficult ."])[0][0]
+    def find(self, grams, context=False):
+        '''
+        Look up the rows of the (m, k) id array 'grams', one binary search per level for all of them at once.
+        Return the node of each k-gram at level k-1, or -1 for the k-grams that were never seen.
+        If 'context' is True, also return the nodes of their (k-1)-gram prefixes (-1 for unigrams).
+        '''
+        grams = np.asarray(grams, dtype=np.int64)
+        nodes = np.zeros(len(grams), dtype=np.int64)
+        found = np.ones(len(grams), dtype=bool)
+        contexts = np.full(len(grams), -1, dtype=np.int64)
+        for level in range(grams.shape[1]):
+            if level and level == grams.shape[1] - 1:
+                contexts = np.where(found, nodes, -1)
+            keys = self.keys[level]
+            if len(keys) == 0:
+                found[:] = False
+                break
+            queries = nodes * self.size + grams[:, level]
+            positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+            found &= (grams[:, level] >= 0) & (grams[:, level] < self.size) & (keys[positions] == queries)
+            nodes = np.where(found, positions, 0)
+        nodes = np.where(found, nodes, -1)
+        return (nodes, contexts) if context else nodes
 
-    # Correct answers
-    if model_type == "unigram":
-       senprobs = [-19.08542845, -114.5001481799, -108.7963657053, -53.6727664115, -55.4645258807]
-       trainPerp, testPerp = 41.3308239726, 38.0122981569
-       model = UnigramModel(train_corpus)
-    elif model_type == "smoothed-unigram":
-       senprobs = [-19.0405293515, -115.3479413049, -108.9114348746, -54.8190029616, -55.8122547346]
-       trainPerp, testPerp = 41.9994393615, 39.9531928383
-       model = SmoothedUnigramModel(train_corpus)
-    elif model_type == "bigram":
-       senprobs = [-float('inf'), -10.3450917073, -9.2464794186, -float('inf'), -float('inf')]
-       trainPerp, testPerp = 1.3861445461, float('inf')
-       model = BigramModel(train_corpus)
-    elif model_type == "smoothed-bigram":
-       senprobs = [-16.355820202, -76.0026113319, -74.2346475108, -47.2885760372, -51.2730261907]
-       trainPerp, testPerp = 12.2307627397, 26.7193157699
-       model = SmoothedBigramModelAD(train_corpus)
-    else: assert False, 'Invalid model_type'
+    def grams(self, level):
+        '''
+        Return the (m, level + 1) array of the word ids of the m nodes of a level.
+        '''
+        nodes = np.arange(len(self.keys[level]))
+        grams = np.empty((len(nodes), level + 1), dtype=np.int64)
+        for j in range(level, -1, -1):
+            keys = self.keys[j][nodes]
+            grams[:, j] = keys % self.size
+            nodes = keys // self.size
+        return grams
 
-    print("--- TEST: generateSentence() ---")
-    modelSen = model.generateSentence()
-    senTestPassed = isinstance(modelSen, list) and len(modelSen) > 1 and isinstance(modelSen[0], str)
-    if senTestPassed:
-        print ("Test generateSentence() passed!")
-    else:
-        print ("Test generateSentence() failed; did not return a list of strings...")
+    def parents(self, level, nodes):
+        '''
+        Return the nodes (at level - 1) of the prefixes of the given nodes of a level.
+        '''
+        return self.keys[level][nodes] // self.size
 
-    print("\n--- TEST: getSentenceLogProbability(...) ---")
-    sentences = [sentence, *train_corpus, *test_corpus]
-    failed = 0
-    for i in range(len(sentences)):
-        sen, correct_prob = sentences[i], senprobs[i]
-        prob = round(model.getSentenceLogProbability(sen), 10)
-        print("Correct log prob.:", correct_prob, '\tYour log prob.:', prob, '\t', 'PASSED' if prob == correct_prob else 'FAILED', '\t', sen)
-        if prob != correct_prob: failed+=1
+    def children(self, level, node):
+        '''
+        Return the ids and the counts of the words following the given node of a level.
+        '''
+        keys = self.keys[level + 1]
+        lo, hi = np.searchsorted(keys, [node * self.size, (node + 1) * self.size])
+        return keys[lo:hi] % self.size, self.counts[level + 1][lo:hi]
 
-    if not failed:
-        print ("Test getSentenceProbability(...) passed!")
-    else:
-        print("Test getSentenceProbability(...) failed on", failed, "sentence" if failed == 1 else 'sentences...')
+    def successor_totals(self, level):
+        '''
+        Return, for every node of a level, the total count of the words following it.
+        '''
+        parents = self.keys[level + 1] // self.size
+        return np.bincount(parents, weights=self.counts[level + 1], minlength=len(self.keys[level])).astype(np.int64)
 
-    print("\n--- TEST: getCorpusPerplexity(...) ---")
-    train_perp = round(model.getCorpusPerplexity(train_corpus), 10)
-    test_perp = round(model.getCorpusPerplexity(test_corpus), 10)
+def countNGrams(ids, offsets, order, size):
+    '''
+    Count all the k-grams (k = 1..order) of an encoded corpus (see Vocabulary.encode_corpus) that don't span two sentences.
+    Return them as an NGramTrie over a vocabulary of the given size.
+    '''
+    ends = np.repeat(offsets[1:], np.diff(offsets)) # End of the sentence of every position
+    starts = np.arange(len(ids))
+    nodes = np.zeros(len(ids), dtype=np.int64)
+    keys, counts = [], []
+    for k in range(order):
+        if k:
+            fits = starts + k < ends[starts]
+            starts, nodes = starts[fits], nodes[fits]
+        level_keys = nodes * size + ids[starts + k]
+        level_keys, nodes, level_counts = np.unique(level_keys, return_inverse=True, return_counts=True)
+        keys.append(level_keys)
+        counts.append(level_counts.astype(np.int32))
+        nodes = nodes.reshape(-1)
+    return NGramTrie(keys, counts, size)
 
-    print("Correct train perp.:", trainPerp, '\tYour train perp.:', train_perp, '\t', 'PASSED' if trainPerp == train_perp else 'FAILED')
-    print("Correct test perp.:", testPerp, '\tYour test perp.:', test_perp, '\t', 'PASSED' if testPerp == test_perp else 'FAILED')
-    train_passed, test_passed = train_perp == trainPerp, test_perp == testPerp
-    if train_passed and test_passed:
-        print("Test getCorpusPerplexity(...) passed!")
-    else:
-        print("Test getCorpusPerplexity(...) failed on", "the training corpus and the testing corpus..." if not train_passed and not test_passed else "the testing corpus..." if not test_passed else "the training corpus...")
+def sumByKey(keys, counts):
+    '''
+    Sort the keys and sum the counts of equal keys.
+    Return the unique sorted keys and their int32 total counts.
+    '''
+    order = np.argsort(keys, kind='stable') # Merges the sorted runs of the concatenated tries
+    keys, counts = keys[order], counts[order].astype(np.int64)
+    if len(keys) == 0:
+        return keys, counts.astype(np.int32)
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts).astype(np.int32)
 
-if __name__=='__main__':
-    sanityCheck('unigram')
+def mergeTries(tries, size, mappings=None):
+    '''
+    Sum the counts of several NGramTries of the same order into one trie over a vocabulary of the given size.
+    'mappings' optionally gives, for each trie, the array mapping its word ids to the ids of the merged vocabulary.
+    Each level is merged with one sort, after translating the keys of every trie to the merged nodes of the level above.
+    '''
+    merged = NGramTrie([], [], size)
+    nodes = [np.zeros(1, dtype=np.int64) for trie in tries] # Merged node of every node of the level above (the root for level 0)
+    for level in range(tries[0].order):
+        keys = []
+        for i, trie in enumerate(tries):
+            words = trie.keys[level] % trie.size
+            if mappings is not None:
+                words = mappings[i][words]
+            keys.append(nodes[i][trie.keys[level] // trie.size] * size + words)
+        level_keys, counts = sumByKey(np.concatenate(keys), np.concatenate([trie.counts[level] for trie in tries]))
+        merged.keys.append(level_keys)
+        merged.counts.append(counts)
+        nodes = [np.searchsorted(level_keys, trie_keys) for trie_keys in keys]
+    return merged
 
-"""Sanity check with excuting time"""
+shard_corpus = None # Corpus being counted by the worker processes of countCorpus
 
-import time
+def initShardWorker(corpus):
+    '''
+    Give a worker process the corpus to count (inherited without a copy when the processes are forked).
+    '''
+    global shard_corpus
+    shard_corpus = corpus
 
-def sanityCheckFullDataset(model_type):
-    model = UnigramModel(train_dataset)
-    idxes = list(range(75,7500, 800))
-    small_test_corpus = [test_dataset[idx] for idx in idxes]
-    if model_type == 'unigram':
-        senprobs = [-80.7782190984, -174.4769654449, -136.455148267, -225.5890741503, -719.0142129846, -236.350443633, -126.0056604204, -47.3424655612, -47.7775372096, -138.8159941929]
-        testPerp = 881.0132848704
-        model = UnigramModel(train_dataset)
-    elif model_type == 'smoothed-unigram':
-        senprobs = [-80.8423009715, -174.5131424172, -136.3181234818, -225.357454098, -719.1543898871, -236.6682968913, -126.1965419509, -47.4369338195, -47.7692144935, -138.542462715]
-        testPerp = 881.6105352831
-        model = SmoothedUnigramModel(train_dataset)
-    elif model_type == 'bigram':
-        senprobs = [-float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -32.1502020637, -float('inf'), -float('inf')]
-        testPerp = float ('inf')
-        model = BigramModel(train_dataset)
-    elif model_type == 'smoothed-bigram':
-        senprobs = [-61.3754065648, -141.9754903887, -107.0849366076, -168.4944718788, -619.9409055374, -195.8159911677, -86.3762008156, -32.4764801981, -48.124714509, -124.687107856]
-        testPerp = 261.4247123506
-        model = SmoothedBigramModelAD(train_dataset)
-    else: assert False, 'Invalid model_type'
-    print("\n--- TEST: getSentenceLogProbability(...) ---")
-    failed = 0
-    for i in range(len(small_test_corpus)):
-        sen, correct_prob = small_test_corpus[i], senprobs[i]
-        prob = round(model.getSentenceLogProbability(sen), 10)
-        print("Correct log prob.:", correct_prob, '\tYour log prob.:', prob, '\t', 'PASSED' if prob == correct_prob else 'FAILED', '\t', sen)
-        if prob != correct_prob: failed+=1
+def countShard(bounds, order):
+    '''
+    Count the k-grams of the shard shard_corpus[lo:hi] with a vocabulary of its own (run in a worker process).
+    Return the words of the shard vocabulary and the NGramTrie of its counts.
+    '''
+    lo, hi = bounds
+    vocab = Vocabulary()
+    ids, offsets = vocab.encode_corpus(shard_corpus[lo:hi], grow=True)
+    return vocab.idx2word, countNGrams(ids, offsets, order, len(vocab))
 
-    if not failed:
-        print ("Test getSentenceProbability(...) passed!")
-    else:
-        print("Test getSentenceProbability(...) failed on", failed, "sentence" if failed == 1 else 'sentences...')
+def countChunk(chunk, order):
+    '''
+    Count the k-grams of a list of sentences with a vocabulary of its own (run in a worker process).
+    Return the words of the chunk vocabulary and the NGramTrie of its counts.
+    '''
+    vocab = Vocabulary()
+    ids, offsets = vocab.encode_corpus(chunk, grow=True)
+    return vocab.idx2word, countNGrams(ids, offsets, order, len(vocab))
 
-    print("\n--- TEST: getCorpusPerplexity(...) ---")
-    test_perp = round(model.getCorpusPerplexity(small_test_corpus), 10)
+def iterChunks(corpus, chunk_size):
+    '''
+    Yield the sentences of an iterable in lists of chunk_size sentences.
+    '''
+    iterator = iter(corpus)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
-    print("Correct test perp.:", testPerp, '\tYour test perp.:', test_perp, '\t', 'PASSED' if testPerp == test_perp else 'FAILED')
-    test_passed = test_perp == testPerp
-    if test_passed:
-        print("Test getCorpusPerplexity(...) passed!")
-    else:
-        print("Test getCorpusPerplexity(...) failed on the testing corpus...")
+def mapBounded(executor, fn, iterable, limit, *args):
+    '''
+    Like executor.map, but never submits more than 'limit' items ahead of the results already yielded, so an iterable larger than memory can be mapped.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item, *args))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
-if __name__=='__main__':
-    start_time = time.time()
-    sanityCheckFullDataset('unigram')
-    end_time = time.time()
-    print(f'Execution time: {end_time - start_time} seconds')
+def countCorpus(corpus, vocab, order, workers=None, chunk_size=None):
+    '''
+    Count all the k-grams (k = 1..order) of a corpus, adding its tokens to the vocabulary.
+    With 'workers' > 1 the counting is split over a pool of processes and the partial counts are merged.
+    A list of sentences (or an EncodedCorpus) is counted at once (split into 'workers' contiguous shards).
+    Any other iterable, such as the generator of iterPreprocess, is read in chunks of 'chunk_size' sentences (100000 by default)
+    that are counted one by one and merged into the running total, so only a few chunks are ever held in memory.
+    Return the NGramTrie of the counts.
+    '''
+    if isinstance(corpus, (list, EncodedCorpus)) and chunk_size is None:
+        if not workers or workers <= 1:
+            ids, offsets = vocab.encode_corpus(corpus, grow=True)
+            return countNGrams(ids, offsets, order, len(vocab))
 
-"""Train model on the wikitext corpus"""
+        from concurrent.futures import ProcessPoolExecutor
+        bounds = np.linspace(0, len(corpus), workers + 1).astype(int)
+        with ProcessPoolExecutor(workers, initializer=initShardWorker, initargs=(corpus,)) as executor:
+            results = list(executor.map(countShard, zip(bounds[:-1], bounds[1:]), repeat(order)))
+        mappings = [vocab.encode(words, grow=True) for words, trie in results]
+        return mergeTries([trie for words, trie in results], len(vocab), mappings)
 
-def runModel(model_type):
-    assert model_type in {'unigram', 'bigram', 'smoothed-unigram', 'smoothed-bigram'}
-    # Read the corpora
-    if model_type == 'unigram':
-        model = UnigramModel(train_dataset)
-    elif model_type == 'bigram':
-        model = BigramModel(train_dataset)
-    elif model_type == 'smoothed-unigram':
-        model = SmoothedUnigramModel(train_dataset)
+    chunks = iterChunks(corpus, chunk_size or 100000)
+    stack = [] # Partial tries with the number of chunks they count, merged like a binary counter
+    def push(trie):
+        stack.append((trie, 1))
+        while len(stack) > 1 and stack[-1][1] >= stack[-2][1]:
+            (first, n1), (second, n2) = stack.pop(-2), stack.pop()
+            stack.append((mergeTries([first, second], len(vocab)), n1 + n2))
+
+    if not workers or workers <= 1:
+        for chunk in chunks:
+            ids, offsets = vocab.encode_corpus(chunk, grow=True)
+            push(countNGrams(ids, offsets, order, len(vocab)))
     else:
-        model = SmoothedBigramModelAD(train_dataset)
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            for words, trie in mapBounded(executor, countChunk, chunks, 2 * workers, order):
+                mapping = vocab.encode(words, grow=True)
+                push(mergeTries([trie], len(vocab), [mapping]))
 
-    print("--------- 5 sentences from your model ---------")
-    model.printSentences(5)
+    if not stack:
+        return countNGrams(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64), order, len(vocab))
+    return mergeTries([trie for trie, n in stack], len(vocab))
 
-    print ("\n--------- Corpus Perplexities ---------")
-    print ("Training Set:", model.getCorpusPerplexity(train_dataset))
-    print ("Testing Set:", model.getCorpusPerplexity(test_dataset))
+def unigramCounts(trie):
+    '''
+    Return the array mapping every token id of the trie's vocabulary to its count.
+    '''
+    counts = np.zeros(trie.size, dtype=np.int64)
+    counts[trie.keys[0]] = trie.counts[0]
+    return counts
 
-if __name__=='__main__':
-    runModel('unigram')
+class AliasTable(object):
+    def __init__(self, outcomes, weights):
+        '''
+        Walker's alias table over the outcomes, built with Vose's method in O(k).
+        Every draw then costs one random number and O(1) work, whatever the number of outcomes.
+        '''
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        scaled = (weights * (n / weights.sum())).tolist()
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Whatever is left only differs from 1 by rounding errors and keeps a probability of 1
 
-"""### Smoothed Unigram Model"""
+        self.outcomes = list(outcomes)
+        self.prob = prob
+        self.alias = alias
 
-class SmoothedUnigramModel(UnigramModel):
-    def train(self):
+    def draw(self, rng=random):
         '''
-        Train the model by calculating the probability of each word in then corpus, with the smoothed method
-        Return a dictionary which map tokens to their unigram frequency and the total counts of all tokens.
+        Draw one outcome using the random number generator 'rng' (the random module by default).
         '''
-        model = {}
-        total_counts = 0
-        for sentence in self.corpus:
-            for word in sentence:
-                if word != '<s>':
-                    total_counts += 1
-                    if word in model:
-                        model[word] += 1
-                    else:
-                        model[word] = 1
+        u = rng.random() * len(self.prob)
+        i = int(u)
+        if u - i >= self.prob[i]:
+            i = self.alias[i]
+        return self.outcomes[i]
 
-        number_tokens = len(model.keys())
+from collections import OrderedDict
+from itertools import accumulate
 
-        for word in model:
-            model[word] = (model[word] + 1) / (total_counts + number_tokens)
+PREFIX_HASH_MULTIPLIER = 0x100000001b3 # Multiplier of the rolling hashes of the ScoreCache prefixes (the 64-bit FNV prime)
+PREFIX_HASH_INVERSE = pow(PREFIX_HASH_MULTIPLIER, -1, 2**64)
 
-        return model
+def prefixHashes(key):
+    '''
+    Return the rolling hashes of all the prefixes of a tuple of tokens, modulo 2**64: element i is the hash of key[:i], h(key[:i]) = h(key[:i - 1]) * M + hash(key[i - 1]).
+    They are computed at once as h(key[:i]) = M**(i - 1) * sum(hash(key[j]) * M**-j for j < i), M being odd so invertible.
+    '''
+    tokens = np.fromiter(map(hash, key), dtype=np.int64, count=len(key)).view(np.uint64)
+    powers = np.full(len(key), PREFIX_HASH_MULTIPLIER, dtype=np.uint64)
+    inverses = np.full(len(key), PREFIX_HASH_INVERSE, dtype=np.uint64)
+    powers[:1] = inverses[:1] = 1
+    powers, inverses = np.cumprod(powers), np.cumprod(inverses) # M**i and M**-i for i < len(key)
+    return [0] + (powers * np.cumsum(tokens * inverses)).tolist()
 
-if __name__=='__main__':
-    sanityCheck('smoothed-unigram')
+class ScoreCache(object):
+    def __init__(self, size):
+        '''
+        Least recently used cache of sentence log probabilities, keyed by the tuple of the tokens of the sentence, holding at most 'size' entries.
+        A cached sentence is also the prefix of the sentences extending it (see lookup).
+        The entries are indexed by the rolling hash of their tokens, so that every prefix of a sentence is looked up in constant time.
+        '''
+        assert size > 0, "size must be positive"
+        self.size = size
+        self.entries = OrderedDict()
+        self.prefixes = {} # Rolling hash of an entry -> its key
+        self.hits = 0 # Sentences found in the cache
+        self.prefix_hits = 0 # Missed sentences extending a cached prefix
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, model, sentence):
+        '''
+        Return the log probability of the sentence under the model, caching it.
+        On a miss the longest cached prefix of the sentence is looked for, so that only the tokens after it are scored (see getSuffixLogProbabilities).
+        The prefixes of the sentence whose lengths are powers of two are cached with it, so that a sentence sharing only a prefix with a scored one
+        reuses at least half of the common prefix. Scoring them only looks up the words once.
+        The model's cache is disabled while scoring, so that the scores computed on the way aren't looked up or cached again.
+        '''
+        key = tuple(sentence)
+        entries = self.entries
+        log_prob = entries.get(key)
+        if log_prob is not None:
+            entries.move_to_end(key)
+            self.hits += 1
+            return log_prob
+
+        self.misses += 1
+        hashes = prefixHashes(key)
+        start, prefix_log_prob = 1, 0.0
+        prefixes = [self.prefixes[h] for h in self.prefixes.keys() & hashes[2:len(key)]] # Cached prefixes, and hash collisions
+        for prefix in sorted(prefixes, key=len, reverse=True):
+            if prefix == key[:len(prefix)]:
+                entries.move_to_end(prefix)
+                self.prefix_hits += 1
+                start, prefix_log_prob = len(prefix), entries[prefix]
+                break
+        stops = [length for length in (2 ** i for i in range(1, len(key).bit_length())) if start < length < len(key)] + [len(key)]
+        model.cache = None
+        try:
+            log_probs = model.getSuffixLogProbabilities(sentence, start, stops)
+        finally:
+            model.cache = self
+        for stop, suffix_log_prob in zip(stops, log_probs):
+            prefix = key[:stop] if stop < len(key) else key
+            if prefix not in entries:
+                self.add(prefix, hashes[stop], prefix_log_prob + float(suffix_log_prob))
+        return entries[key]
+
+    def add(self, key, key_hash, log_prob):
+        '''
+        Cache the log probability of a sentence, with the rolling hash of its tokens, evicting the least recently used one if the cache is full.
+        '''
+        self.entries[key] = log_prob
+        self.prefixes[key_hash] = key
+        if len(self.entries) > self.size:
+            evicted = self.entries.popitem(last=False)[0]
+            evicted_hash = prefixHashes(evicted)[-1]
+            if self.prefixes.get(evicted_hash) is evicted:
+                del self.prefixes[evicted_hash]
+            self.evictions += 1
+
+    def clear(self):
+        '''
+        Drop every entry, the counters are kept.
+        '''
+        self.entries.clear()
+        self.prefixes.clear()
+
+    def stats(self):
+        '''
+        Return the counters and the number of entries as a dictionary.
+        '''
+        return {'size': self.size, 'entries': len(self.entries), 'hits': self.hits, 'prefix_hits': self.prefix_hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+# Sentences processed by each instrumented method, from its arguments bound by name and its result, to count its tokens
+INSTRUMENTED_METHODS = {'train': None,
+                        'getSentenceLogProbability': lambda arguments, result: [arguments['sentence']],
+                        'getCorpusPerplexity': lambda arguments, result: arguments['testCorpus'],
+                        'scoreSentences': lambda arguments, result: arguments['sentences'],
+                        'generateSentence': lambda arguments, result: [result],
+                        'generateSentences': lambda arguments, result: result}
+SCORING_METHODS = {'getSentenceLogProbability', 'getCorpusPerplexity', 'scoreSentences'}
+CORPUS_ARGUMENTS = {'testCorpus', 'sentences'} # Read into a list first when they are iterators, so that they can be counted after the call
+
+def countScoredTokens(sentences):
+    '''
+    Count the tokens scored in the sentences (all but the first of each sentence), from the offsets of an EncodedCorpus without decoding it.
+    '''
+    if isinstance(sentences, EncodedCorpus):
+        return int(sentences.offsets[-1] - sentences.offsets[0]) - len(sentences)
+    return sum(max(len(sentence) - 1, 0) for sentence in sentences)
+
+class MethodStats(object):
+    def __init__(self, window):
+        '''
+        Call count, total time and tokens of one method, with the latencies of its last 'window' calls for the percentiles.
+        '''
+        self.calls = 0
+        self.seconds = 0.0
+        self.tokens = 0
+        self.latencies = np.zeros(window)
+
+    def record(self, seconds, tokens):
+        self.latencies[self.calls % len(self.latencies)] = seconds
+        self.calls += 1
+        self.seconds += seconds
+        self.tokens += tokens
+
+    def percentiles(self, quantiles=(0.5, 0.9, 0.99)):
+        '''
+        Return the latency quantiles in seconds over the last calls, as a dictionary.
+        '''
+        latencies = self.latencies[:min(self.calls, len(self.latencies))]
+        if not len(latencies):
+            return {q: 0.0 for q in quantiles}
+        return dict(zip(quantiles, np.quantile(latencies, quantiles).tolist()))
+
+class Instrumentation(object):
+    def __init__(self, window=10000):
+        '''
+        Statistics of the instrumented methods of one model (see LanguageModel.enableInstrumentation).
+        Only the outermost instrumented call counts the bigrams it looks up, so that getCorpusPerplexity and the
+        getSentenceLogProbability calls it makes aren't counted twice.
+        '''
+        self.window = window
+        self.methods = {}
+        self.depth = 0 # Number of instrumented calls in progress
+        self.seen = 0 # Bigrams found in the model
+        self.backoffs = 0 # Bigrams backing off to the unigram model
+        self.profiler = None
+        self.profiled = None # Name of the method run under the profiler
+        self.profiling = False
+
+    def wrap(self, model, name):
+        '''
+        Return the bound method 'name' of the model wrapped to record its calls.
+        '''
+        method = getattr(model, name)
+        stats = self.methods.setdefault(name, MethodStats(self.window))
+        import inspect
+        sentences_of = INSTRUMENTED_METHODS[name]
+        signature = inspect.signature(method)
+        corpora = CORPUS_ARGUMENTS & signature.parameters.keys()
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            for argument in corpora & bound.arguments.keys():
+                corpus = bound.arguments[argument]
+                if iter(corpus) is corpus:
+                    bound.arguments[argument] = list(corpus)
+            args, kwargs = bound.args, bound.kwargs
+            outer = self.depth == 0
+            profiler = self.profiler if self.profiled == name and not self.profiling else None
+            self.depth += 1
+            if profiler is not None:
+                self.profiling = True
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if profiler is not None:
+                    profiler.disable()
+                    self.profiling = False
+                self.depth -= 1
+            sentences = sentences_of(bound.arguments, result) if sentences_of is not None else []
+            stats.record(elapsed, countScoredTokens(sentences))
+            if outer and name in SCORING_METHODS:
+                counts = model.countBackoffs(sentences)
+                if counts is not None:
+                    self.seen += counts[0]
+                    self.backoffs += counts[1]
+            return result
+        return wrapper
+
+    def start_profile(self, name):
+        '''
+        Run the calls of the method 'name' under a new cProfile profiler until stop_profile.
+        '''
+        import cProfile
+        self.profiler, self.profiled, self.profiling = cProfile.Profile(), name, False
+
+    def stop_profile(self):
+        '''
+        Stop profiling and return the pstats.Stats of the profiled calls.
+        '''
+        import pstats
+        profiler, self.profiler, self.profiled = self.profiler, None, None
+        return pstats.Stats(profiler)
+
+    def stats(self):
+        '''
+        Return the statistics as a dictionary: for each method, its calls, total and percentile latencies in milliseconds,
+        tokens and tokens per second; then the bigram lookups of the models that back off.
+        '''
+        methods = {}
+        for name, stats in self.methods.items():
+            percentiles = stats.percentiles()
+            methods[name] = {'calls': stats.calls, 'total_ms': stats.seconds * 1000,
+                             'mean_ms': stats.seconds * 1000 / stats.calls if stats.calls else 0.0,
+                             **{'p%d_ms' % round(q * 100): seconds * 1000 for q, seconds in percentiles.items()},
+                             'tokens': stats.tokens, 'tokens_per_s': stats.tokens / stats.seconds if stats.seconds else 0.0}
+        lookups = self.seen + self.backoffs
+        return {'methods': methods, 'bigrams': {'seen': self.seen, 'backoffs': self.backoffs,
+                                                'backoff_rate': self.backoffs / lookups if lookups else 0.0}}
+
+    def prometheus(self, model_name):
+        '''
+        Return the statistics in the Prometheus text exposition format, labelled with the class name of the model.
+        '''
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % item for item in [('model', model_name), *labels])
+                lines.append('%s%s{%s} %r' % (name, suffix, labels, float(value)))
+
+        methods = self.methods.items()
+        metric('languagemodel_calls_total', 'counter', 'Calls of the LanguageModel method.',
+               [('', [('method', name)], stats.calls) for name, stats in methods])
+        metric('languagemodel_tokens_total', 'counter', 'Tokens processed by the LanguageModel method.',
+               [('', [('method', name)], stats.tokens) for name, stats in methods])
+        samples = []
+        for name, stats in methods:
+            samples += [('', [('method', name), ('quantile', q)], seconds) for q, seconds in stats.percentiles().items()]
+            samples += [('_sum', [('method', name)], stats.seconds), ('_count', [('method', name)], stats.calls)]
+        metric('languagemodel_latency_seconds', 'summary', 'Latency of the LanguageModel method.', samples)
+        metric('languagemodel_bigram_lookups_total', 'counter', 'Bigrams scored from the model (seen) or backing off to the unigram model.',
+               [('', [('path', 'seen')], self.seen), ('', [('path', 'backoff')], self.backoffs)])
+        return '\n'.join(lines) + '\n'
+
+class LanguageModel(object):
+    cache = None # ScoreCache of getSentenceLogProbability, disabled by default (see enableCache)
+    instrumentation = None # Instrumentation of the model, disabled by default (see enableInstrumentation)
+
+    def __init__(self, trainCorpus):
+        '''
+        Initialize and train the model (i.e. estimate the model's underlying probability
+        distribution from the training corpus.)
+        '''
+
+        return
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate a sentence by drawing words according to the model's probability distribution.
+        'rng' is the random number generator to draw from (the random module by default).
+        Note: Think about how to set the length of the sentence in a principled way.
+        '''
+
+        raise NotImplementedError("Implement generateSentence in each subclass.")
+
+    def generateSentences(self, n, seed=None):
+        '''
+        Generate n sentences with a random.Random seeded with 'seed', so that the same seed gives the same sentences.
+        '''
+
+        rng = random.Random(seed)
+        return [self.generateSentence(rng) for i in range(n)]
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the log probability of the sentence provided.
+        '''
+
+        raise NotImplementedError("Implement getSentenceProbability in each subclass.")
+
+    def getSuffixLogProbability(self, sentence, start):
+        '''
+        Calculate the log probability of the words sentence[start:] given the words before them, for 1 <= start <= len(sentence).
+        The unigram and bigram models score every word from at most the previous one, so it is the log probability of sentence[start - 1:];
+        the n-gram models override this.
+        '''
+
+        return self.getSentenceLogProbability(sentence[start - 1:])
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        '''
+        Calculate the log probabilities of the words sentence[start:stop] given the words before them, for each length of the increasing list 'stops'.
+        Each is the previous one plus the log probability of the words added (see getSuffixLogProbability): the models override this to look every word up once.
+        '''
+
+        log_probs, log_prob = [], 0.0
+        for stop in stops:
+            log_prob += self.getSuffixLogProbability(sentence[:stop], start)
+            log_probs.append(log_prob)
+            start = stop
+        return log_probs
+
+    def enableCache(self, size=100000):
+        '''
+        Cache the results of getSentenceLogProbability in a ScoreCache of at most 'size' sentences and prefixes.
+        A sentence extending a cached one only scores its new words. The cache is cleared by update.
+        '''
+
+        self.cache = ScoreCache(size)
+
+    def disableCache(self):
+        self.cache = None
+
+    def clearCache(self):
+        if self.cache is not None:
+            self.cache.clear()
+
+    def enableInstrumentation(self, methods=tuple(INSTRUMENTED_METHODS), window=10000):
+        '''
+        Record the calls, latencies (the percentiles over the last 'window' calls) and tokens of the methods of this model named in 'methods',
+        and the bigrams scored from the model or backing off (see countBackoffs). See getMetrics for the results.
+        The methods are wrapped on this instance only, and the wrappers removed by disableInstrumentation: the class isn't changed,
+        so a model without instrumentation runs exactly the same code as before.
+        The training done by the constructor happens before, but train is also recorded when update makes the model retrain.
+        '''
+
+        self.disableInstrumentation()
+        self.instrumentation = Instrumentation(window)
+        for name in methods:
+            if hasattr(self, name):
+                setattr(self, name, self.instrumentation.wrap(self, name))
+
+    def disableInstrumentation(self):
+        if self.instrumentation is not None:
+            for name in self.instrumentation.methods:
+                del self.__dict__[name]
+            del self.instrumentation
+
+    def getMetrics(self, format='dict'):
+        '''
+        Return the statistics of the instrumentation as a dictionary ('dict') or in the Prometheus text format ('prometheus').
+        '''
+
+        assert format in {'dict', 'prometheus'}, "format must be 'dict' or 'prometheus'"
+        if self.instrumentation is None:
+            raise ValueError("Instrumentation is disabled, call enableInstrumentation first")
+        if format == 'prometheus':
+            return self.instrumentation.prometheus(type(self).__name__)
+        return self.instrumentation.stats()
+
+    def startProfile(self, method):
+        '''
+        Profile the calls of one instrumented method with cProfile, including everything they call, until stopProfile.
+        '''
+
+        if self.instrumentation is None:
+            self.enableInstrumentation()
+        if method not in self.instrumentation.methods:
+            raise ValueError("%s isn't an instrumented method" % method)
+        self.instrumentation.start_profile(method)
+
+    def stopProfile(self):
+        '''
+        Stop the profiling started by startProfile and return its pstats.Stats.
+        '''
+
+        return self.instrumentation.stop_profile()
+
+    def countBackoffs(self, sentences):
+        '''
+        Count the bigrams of the sentences found in the model and those backing off to a lower order, as a pair,
+        for the instrumentation; None for the models without backoff.
+        '''
+
+        return None
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexity of the corpus provided.
+        '''
+
+        raise NotImplementedError("Implement getCorpusPerplexity in each subclass.")
+
+    def scoreSentences(self, sentences):
+        '''
+        Calculate the log probability of every sentence of the list.
+        Return a float64 array; subclasses override this with a vectorized batch path.
+        '''
+
+        return np.array([self.getSentenceLogProbability(sentence) for sentence in sentences], dtype=np.float64)
+
+    def printSentences(self, n):
+        '''
+        Prints n sentences generated by your model.
+        '''
+
+        for i in range(n):
+            sent = self.generateSentence()
+            prob = self.getSentenceLogProbability(sent)
+            print('Log Probability:', prob , '\tSentence:',sent)
+
+    def update(self, sentences):
+        '''
+        Add sentences (an iterable of lists of words) to the training corpus without retraining from scratch:
+        their counts are added to the raw counts of the model at once, and the probabilities are recomputed lazily, at the next query.
+        '''
+
+        raise NotImplementedError("Implement update in each subclass.")
+
+    def refresh(self):
+        '''
+        Recompute the probabilities left out of date by update, if any. Every query starts with it.
+        '''
+
+        return
+
+    def getState(self):
+        '''
+        Return the trained state of the model as a dictionary of named numpy arrays and a dictionary of JSON serializable parameters.
+        '''
+
+        raise NotImplementedError("Implement getState in each subclass.")
+
+    def setState(self, arrays, params):
+        '''
+        Restore the trained state returned by getState (self.vocab being already set).
+        '''
+
+        raise NotImplementedError("Implement setState in each subclass.")
+
+    def getBackoffLevels(self):
+        '''
+        Return the model in the backoff form of ARPA files: for each order k, the (m, k) array of the ids of its k-grams,
+        their natural log probabilities and the natural log backoff weights of the k-grams as contexts (None for the highest order).
+        '''
+
+        raise NotImplementedError("Implement getBackoffLevels in each subclass.")
+
+    def save(self, path):
+        '''
+        Save the trained model to a binary file (see saveModel).
+        '''
+
+        arrays, params = self.getState()
+        saveModel(path, type(self).__name__, self.vocab, arrays, params)
+
+    @classmethod
+    def load(cls, path, mmap=True, shared=False):
+        '''
+        Load a model saved with save, without retraining it.
+        With 'mmap' the arrays of the model are memory-mapped read-only from the file instead of read into memory:
+        the model is usable at once, and the pages are loaded on first use and shared by all the processes loading the same file.
+        With 'shared' the model also keeps no per-process copy of its tables: the bigram models use the 'csr' backend on the arrays of the file
+        instead of building dictionaries, and the vocabulary is a MappedVocabulary. Such a model is read-only, it can't be updated.
+        '''
+
+        name, vocab, arrays, params = loadModel(path, mmap, shared)
+        if shared and 'backend' in params:
+            params = dict(params, backend='csr')
+        model_class = modelClass(name)
+        if not issubclass(model_class, cls):
+            raise ValueError("%s holds a %s, not a %s" % (path, name, cls.__name__))
+        model = model_class.__new__(model_class)
+        model.corpus, model.workers, model.vocab = None, None, vocab
+        model.setState(arrays, params)
+        return model
+
+    def saveARPA(self, path):
+        '''
+        Export the model to an ARPA text file (see saveARPA).
+        '''
+
+        saveARPA(self, path)
+
+    def quantize(self, bits=8, method='binning'):
+        '''
+        Return a copy of the model storing its log probabilities as 8 or 16-bit codes (see quantizeModel).
+        '''
+
+        return quantizeModel(self, bits, method)
+
+"""### Unigram Model"""
+
+from binascii import Error
+class UnigramModel(LanguageModel):
+    def __init__(self, trainCorpus, vocab=None, workers=None):
+        '''
+        Initialize and train the model (i.e. estimate the model's underlying probability
+        distribution from the training corpus.)
+        'trainCorpus' is a list (or any iterable, read once) of sentences where each sentence is a list of words.
+        'vocab' is an optional Vocabulary to share with other models, a new one is built otherwise.
+        'workers' is the number of processes counting the corpus in parallel (see countCorpus).
+        '''
+        self.corpus = trainCorpus
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = workers
+        self.counts, self.model = self.train()
+        self.logmodel = logProbabilities(self.model) # Scoring only sums lookups in the log probabilities
+        self.sampler = None
+        self.stale = False # Whether update added counts since the probabilities were computed
+
+
+    def countWords(self):
+        '''
+        Count the tokens of the corpus, '<s>' excluded.
+        Return an int64 array mapping token ids to their counts.
+        '''
+        start = self.vocab.add(START)
+        counts = unigramCounts(countCorpus(self.corpus, self.vocab, 1, self.workers))
+        counts[start] = 0
+        return counts
+
+
+    def train(self):
+        '''
+        Train the model by calculating the probability of each word in then corpus.
+        Return the array of token counts and the array of unigram probabilities, both indexed by token id.
+        '''
+        counts = self.countWords()
+        return counts, self.getProbabilities(counts)
+
+
+    def getProbabilities(self, counts):
+        '''
+        Return the array of the probabilities of the tokens from the array of their counts.
+        '''
+        return counts / counts.sum()
+
+
+    def update(self, sentences):
+        start = self.vocab.add(START)
+        new_counts = unigramCounts(countCorpus(sentences, self.vocab, 1, self.workers))
+        new_counts[:len(self.counts)] += self.counts
+        new_counts[start] = 0
+        self.counts = new_counts
+        self.stale = True
+        self.clearCache()
+
+
+    def refresh(self):
+        '''
+        Recompute the probabilities from the counts after an update (the normalizer is the total count, so all of them change).
+        '''
+        if self.stale:
+            self.model = self.getProbabilities(self.counts)
+            self.logmodel = logProbabilities(self.model)
+            self.sampler = None
+            self.stale = False
+
+
+    def encodeKnown(self, sentence):
+        '''
+        Return the ids of the tokens in the sentence.
+        Raise a ValueError if one of them doesn't belong to the corpus.
+        '''
+        return self.checkKnown(self.vocab.encode(sentence))
+
+
+    def checkKnown(self, ids):
+        '''
+        Raise a ValueError if one of the ids doesn't belong to the corpus, return the ids otherwise.
+        '''
+        unknown = (ids < 0) | (ids >= len(self.counts))
+        if unknown.any() or not self.counts[ids].all():
+            raise ValueError("Sentence contains tokens that doesn't belong to the corpus")
+        return ids
+
+
+    def getSampler(self):
+        '''
+        Return the alias table drawing words according to their probability, built on first use.
+        '''
+        self.refresh()
+        if self.sampler is None:
+            self.sampler = AliasTable(self.vocab.idx2word[:len(self.model)], self.model)
+        return self.sampler
+
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate a sentence using the unigram model, the sentence should be starting with the '<s>' and end with the token '</s>'.
+        'rng' is the random number generator to draw from (the random module by default).
+        Return a list of tokens representing the sentence.
+        '''
+        # Initialize the sentence
+        sentence = []
+        sentence.append('<s>')
+        # Random select tokens from the vocabulary based on their probability
+        sampler = self.getSampler()
+        while True:
+            word = sampler.draw(rng)
+            sentence.append(word)
+            if word == '</s>':
+                break
+
+        return sentence
+
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the log probability of the given sentence.
+        Input is a list of tokens representing a sentence beginning with '<s>' and ends with '</s>'.
+        Output is a float number representing the log probabity of the sentence from the unigram model.
+        '''
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        self.refresh()
+        ids = self.encodeKnown(sentence[1:])
+        return float(self.logmodel[ids].sum())
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        self.refresh()
+        log_probs = np.cumsum(self.logmodel[self.encodeKnown(sentence[start:stops[-1]])])
+        return [float(log_probs[stop - start - 1]) if stop > start else 0.0 for stop in stops]
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexity of the corpus provided. The begnning token '<s>' is not counted in this case
+        The input is the corpus, which is list of sentences
+        The output is the perplexity of the corpus
+        '''
+        self.refresh()
+        ids = self.encodeKnown([word for sentence in testCorpus for word in sentence[1:]])
+        return math.exp(-self.logmodel[ids].sum() / len(ids))
+
+    def scoreSentences(self, sentences):
+        '''
+        Calculate the log probability of every sentence of the list at once.
+        The sentences are encoded into one flat id array, whose log probabilities are gathered and summed per sentence.
+        Return a float64 array.
+        '''
+        self.refresh()
+        ids, offsets = self.vocab.encode_corpus(sentence[1:] for sentence in sentences)
+        return sumSegments(self.logmodel[self.checkKnown(ids)], offsets)
+
+    def getState(self):
+        self.refresh()
+        return {'counts': self.counts, 'model': self.model, 'logmodel': self.logmodel}, {}
+
+    def setState(self, arrays, params):
+        self.counts, self.model, self.logmodel = arrays['counts'], arrays['model'], arrays['logmodel']
+        self.sampler = None
+        self.stale = False
+
+    def getBackoffLevels(self):
+        self.refresh()
+        return [(np.arange(len(self.model))[:, None], self.logmodel, None)]
+
+"""Here's sanity check on the function"""
+
+def getSanityCorpora():
+    #	Read in the test corpus
+    train_corpus = ["By the Late Classic , a network of few <unk> ( few <unk> ) linked various parts of the city , running for several kilometres through its urban core .",
+    "Few people realize how difficult it was to create Sonic 's graphics engine , which allowed for the incredible rate of speed the game 's known for ."]
+    test_corpus = ["Classic few parts of the game allowed for few <unk> <unk> incredible city .",
+                   "Few <unk> realize the difficult network , which linked the game to Sonic ."]
+    train_corpus, _ = preprocess(train_corpus)
+    test_corpus, _ = preprocess(test_corpus)
+    sentence = preprocess(["Sonic was difficult ."])[0][0]
+    return train_corpus, test_corpus, sentence
+
+def zipfCorpus(tokens, vocab_size=None, exponent=1.1, seed=0, words=None):
+    '''
+    Return an EncodedCorpus of about 'tokens' tokens, sentences of 1 to 40 words between '<s>' and '</s>',
+    the word of rank r ('w<r>') being drawn with a probability proportional to r ** -exponent.
+    The vocabulary grows with the size of the corpus, as in natural text, unless 'vocab_size' is given.
+    'words' restricts the draws to the given ranks, e.g. to build a test corpus without unknown words.
+    The same arguments give the same corpus.
+    '''
+    if vocab_size is None:
+        vocab_size = int(min(200000, 40 * tokens ** 0.5))
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 41, size=tokens // 22 + 1)
+    lengths = lengths[:max(np.searchsorted(np.cumsum(lengths + 2), tokens), 1)]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths + 2, out=offsets[1:])
+
+    probs = np.arange(1, vocab_size + 1, dtype=np.float64) ** -exponent
+    if words is not None:
+        allowed = np.zeros(vocab_size, dtype=bool)
+        allowed[words] = True
+        probs[~allowed] = 0
+    ids = np.empty(offsets[-1], dtype=np.int32)
+    inside = np.ones(offsets[-1], dtype=bool)
+    inside[offsets[:-1]] = inside[offsets[1:] - 1] = False
+    ids[offsets[:-1]], ids[offsets[1:] - 1] = 0, 1
+    ids[inside] = rng.choice(vocab_size, size=int(lengths.sum()), p=probs / probs.sum()) + 2
+    return EncodedCorpus(['<s>', '</s>'] + ['w%d' % r for r in range(vocab_size)], ids, offsets)
+
+def sanityCheck(model_type):
+    assert model_type in {'unigram', 'bigram', 'smoothed-unigram', 'smoothed-bigram'}
+
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+
+    # Correct answers
+    if model_type == "unigram":
+       senprobs = [-19.08542845, -114.5001481799, -108.7963657053, -53.6727664115, -55.4645258807]
+       trainPerp, testPerp = 41.3308239726, 38.0122981569
+       model = UnigramModel(train_corpus)
+    elif model_type == "smoothed-unigram":
+       senprobs = [-19.0405293515, -115.3479413049, -108.9114348746, -54.8190029616, -55.8122547346]
+       trainPerp, testPerp = 41.9994393615, 39.9531928383
+       model = SmoothedUnigramModel(train_corpus)
+    elif model_type == "bigram":
+       senprobs = [-float('inf'), -10.3450917073, -9.2464794186, -float('inf'), -float('inf')]
+       trainPerp, testPerp = 1.3861445461, float('inf')
+       model = BigramModel(train_corpus)
+    elif model_type == "smoothed-bigram":
+       senprobs = [-16.355820202, -76.0026113319, -74.2346475108, -47.2885760372, -51.2730261907]
+       trainPerp, testPerp = 12.2307627397, 26.7193157699
+       model = SmoothedBigramModelAD(train_corpus)
+    else: assert False, 'Invalid model_type'
+
+    print("--- TEST: generateSentence() ---")
+    modelSen = model.generateSentence()
+    senTestPassed = isinstance(modelSen, list) and len(modelSen) > 1 and isinstance(modelSen[0], str)
+    if senTestPassed:
+        print ("Test generateSentence() passed!")
+    else:
+        print ("Test generateSentence() failed; did not return a list of strings...")
+
+    print("\n--- TEST: getSentenceLogProbability(...) ---")
+    sentences = [sentence, *train_corpus, *test_corpus]
+    failed = 0
+    for i in range(len(sentences)):
+        sen, correct_prob = sentences[i], senprobs[i]
+        prob = round(model.getSentenceLogProbability(sen), 10)
+        print("Correct log prob.:", correct_prob, '\tYour log prob.:', prob, '\t', 'PASSED' if prob == correct_prob else 'FAILED', '\t', sen)
+        if prob != correct_prob: failed+=1
+
+    if not failed:
+        print ("Test getSentenceProbability(...) passed!")
+    else:
+        print("Test getSentenceProbability(...) failed on", failed, "sentence" if failed == 1 else 'sentences...')
+
+    print("\n--- TEST: getCorpusPerplexity(...) ---")
+    train_perp = round(model.getCorpusPerplexity(train_corpus), 10)
+    test_perp = round(model.getCorpusPerplexity(test_corpus), 10)
+
+    print("Correct train perp.:", trainPerp, '\tYour train perp.:', train_perp, '\t', 'PASSED' if trainPerp == train_perp else 'FAILED')
+    print("Correct test perp.:", testPerp, '\tYour test perp.:', test_perp, '\t', 'PASSED' if testPerp == test_perp else 'FAILED')
+    train_passed, test_passed = train_perp == trainPerp, test_perp == testPerp
+    if train_passed and test_passed:
+        print("Test getCorpusPerplexity(...) passed!")
+    else:
+        print("Test getCorpusPerplexity(...) failed on", "the training corpus and the testing corpus..." if not train_passed and not test_passed else "the testing corpus..." if not test_passed else "the training corpus...")
+
+if __name__=='__main__':
+    sanityCheck('unigram')
+
+"""Sanity check with excuting time"""
+
+def sanityCheckFullDataset(model_type):
+    model = UnigramModel(train_dataset)
+    idxes = list(range(75,7500, 800))
+    small_test_corpus = [test_dataset[idx] for idx in idxes]
+    if model_type == 'unigram':
+        senprobs = [-80.7782190984, -174.4769654449, -136.455148267, -225.5890741503, -719.0142129846, -236.350443633, -126.0056604204, -47.3424655612, -47.7775372096, -138.8159941929]
+        testPerp = 881.0132848704
+        model = UnigramModel(train_dataset)
+    elif model_type == 'smoothed-unigram':
+        senprobs = [-80.8423009715, -174.5131424172, -136.3181234818, -225.357454098, -719.1543898871, -236.6682968913, -126.1965419509, -47.4369338195, -47.7692144935, -138.542462715]
+        testPerp = 881.6105352831
+        model = SmoothedUnigramModel(train_dataset)
+    elif model_type == 'bigram':
+        senprobs = [-float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -float('inf'), -32.1502020637, -float('inf'), -float('inf')]
+        testPerp = float ('inf')
+        model = BigramModel(train_dataset)
+    elif model_type == 'smoothed-bigram':
+        senprobs = [-61.3754065648, -141.9754903887, -107.0849366076, -168.4944718788, -619.9409055374, -195.8159911677, -86.3762008156, -32.4764801981, -48.124714509, -124.687107856]
+        testPerp = 261.4247123506
+        model = SmoothedBigramModelAD(train_dataset)
+    else: assert False, 'Invalid model_type'
+    print("\n--- TEST: getSentenceLogProbability(...) ---")
+    failed = 0
+    for i in range(len(small_test_corpus)):
+        sen, correct_prob = small_test_corpus[i], senprobs[i]
+        prob = round(model.getSentenceLogProbability(sen), 10)
+        print("Correct log prob.:", correct_prob, '\tYour log prob.:', prob, '\t', 'PASSED' if prob == correct_prob else 'FAILED', '\t', sen)
+        if prob != correct_prob: failed+=1
+
+    if not failed:
+        print ("Test getSentenceProbability(...) passed!")
+    else:
+        print("Test getSentenceProbability(...) failed on", failed, "sentence" if failed == 1 else 'sentences...')
+
+    print("\n--- TEST: getCorpusPerplexity(...) ---")
+    test_perp = round(model.getCorpusPerplexity(small_test_corpus), 10)
+
+    print("Correct test perp.:", testPerp, '\tYour test perp.:', test_perp, '\t', 'PASSED' if testPerp == test_perp else 'FAILED')
+    test_passed = test_perp == testPerp
+    if test_passed:
+        print("Test getCorpusPerplexity(...) passed!")
+    else:
+        print("Test getCorpusPerplexity(...) failed on the testing corpus...")
+
+if __name__=='__main__':
+    start_time = time.time()
+    sanityCheckFullDataset('unigram')
+    end_time = time.time()
+    print(f'Execution time: {end_time - start_time} seconds')
+
+"""Train model on the wikitext corpus"""
+
+def runModel(model_type):
+    assert model_type in {'unigram', 'bigram', 'smoothed-unigram', 'smoothed-bigram', 'trigram', 'kneser-ney'}
+    # Read the corpora
+    if model_type == 'unigram':
+        model = UnigramModel(train_dataset)
+    elif model_type == 'bigram':
+        model = BigramModel(train_dataset)
+    elif model_type == 'smoothed-unigram':
+        model = SmoothedUnigramModel(train_dataset)
+    elif model_type == 'trigram':
+        model = NGramModel(train_dataset, n=3)
+    elif model_type == 'kneser-ney':
+        model = KneserNeyModel(train_dataset, n=3)
+    else:
+        model = SmoothedBigramModelAD(train_dataset)
+
+    print("--------- 5 sentences from your model ---------")
+    model.printSentences(5)
+
+    print ("\n--------- Corpus Perplexities ---------")
+    print ("Training Set:", model.getCorpusPerplexity(train_dataset))
+    print ("Testing Set:", model.getCorpusPerplexity(test_dataset))
+
+if __name__=='__main__':
+    runModel('unigram')
+
+"""### Smoothed Unigram Model"""
+
+class SmoothedUnigramModel(UnigramModel):
+    def getProbabilities(self, counts):
+        '''
+        Return the array of the smoothed probabilities of the tokens from the array of their counts.
+        Tokens that never occur (such as '<s>') keep a probability of 0.
+        '''
+        number_tokens = np.count_nonzero(counts)
+
+        model = (counts + 1) / (counts.sum() + number_tokens)
+        model[counts == 0] = 0
+
+        return model
+
+if __name__=='__main__':
+    sanityCheck('smoothed-unigram')
+
+if __name__=='__main__':
+    sanityCheckFullDataset('smoothed-unigram')
+
+if __name__=='__main__':
+    runModel('smoothed-unigram')
+
+"""### Bigram Model
+
+The bigram models can keep their conditional distributions either in a dictionary of dictionaries, or in a compressed sparse row (CSR) matrix: row `i` holds the successors of the token with id `i`, as sorted column ids and their probabilities. The CSR backend stores a few bytes per observed bigram instead of a pair of boxed Python objects.
+"""
+
+class CSRMatrix(object):
+    def __init__(self, indptr, indices, data, n_cols):
+        '''
+        Compressed sparse row matrix with n_cols columns.
+        Row i holds the entries indices[indptr[i]:indptr[i+1]] (sorted column ids) with the values data[indptr[i]:indptr[i+1]].
+        '''
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_cols = n_cols
+        self.keys = None # Sorted row * n_cols + col keys, built on the first lookup
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        keys = 0 if self.keys is None else self.keys.nbytes
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes + keys
+
+    def row(self, i):
+        '''
+        Return the column ids and the values of row i.
+        '''
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return self.indices[lo:hi], self.data[lo:hi]
+
+    def row_ids(self):
+        '''
+        Return the row id of every stored entry.
+        '''
+        return np.repeat(np.arange(self.n_rows, dtype=np.int32), np.diff(self.indptr))
+
+    def row_sums(self):
+        '''
+        Return the sum of the values of each row.
+        '''
+        return np.bincount(self.row_ids(), weights=self.data, minlength=self.n_rows)
+
+    def with_data(self, data):
+        '''
+        Return a matrix with the same sparsity structure and new values.
+        '''
+        matrix = CSRMatrix(self.indptr, self.indices, data, self.n_cols)
+        matrix.keys = self.keys
+        return matrix
+
+    def sorted_keys(self):
+        '''
+        Return the sorted row * n_cols + col keys of the entries, built on first use.
+        '''
+        if self.keys is None:
+            self.keys = self.row_ids().astype(np.int64) * self.n_cols + self.indices
+        return self.keys
+
+    def find(self, rows, cols):
+        '''
+        Look up the entries (rows[k], cols[k]) with one binary search over the sorted row * n_cols + col keys.
+        Return the position of each entry in self.indices, or -1 for entries that are not stored.
+        '''
+        n_cols = self.n_cols
+        keys = self.sorted_keys()
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        valid = (rows >= 0) & (rows < self.n_rows) & (cols >= 0) & (cols < n_cols)
+        queries = rows * n_cols + cols
+        if len(keys) == 0:
+            return np.full(len(queries), -1, dtype=np.int64)
+        # Searching for sorted queries keeps the binary searches cache friendly
+        order = np.argsort(queries)
+        positions = np.empty(len(queries), dtype=np.int64)
+        positions[order] = np.searchsorted(keys, queries[order])
+        np.minimum(positions, len(keys) - 1, out=positions)
+        found = valid & (keys[positions] == queries)
+        return np.where(found, positions, -1)
+
+    def to_dict(self, vocab):
+        '''
+        Convert the matrix to a dictionary of dictionaries keyed by tokens.
+        '''
+        model = {}
+        for i in np.flatnonzero(np.diff(self.indptr)):
+            cols, values = self.row(i)
+            model[vocab.idx2word[i]] = dict(zip(vocab.decode(cols), values.tolist()))
+        return model
+
+def pairMask(ids, offsets):
+    '''
+    Return a boolean mask over the pairs (ids[j], ids[j+1]) of an encoded corpus, which is False for the pairs spanning two sentences.
+    '''
+    keep = np.ones(max(len(ids) - 1, 0), dtype=bool)
+    boundaries = offsets[1:-1]
+    keep[boundaries[(boundaries > 0) & (boundaries < len(ids))] - 1] = False
+    return keep
+
+def bigramMatrix(trie):
+    '''
+    Return the CSRMatrix of the bigram counts of a trie, the rows being previous-word ids and the columns next-word ids.
+    '''
+    size = trie.size
+    rows = trie.keys[0][trie.keys[1] // size] # Nodes of level 0 are sorted by word id, so the keys stay sorted
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return CSRMatrix(indptr, (trie.keys[1] % size).astype(np.int32), trie.counts[1], size)
+
+def dictMatrix(model, vocab, dtype='float64'):
+    '''
+    Convert a dictionary of dictionaries keyed by tokens (see CSRMatrix.to_dict) back to a CSRMatrix over the vocabulary.
+    '''
+    size = len(vocab)
+    rows = vocab.encode([word for word, successors in model.items() for next_word in successors])
+    cols = vocab.encode([next_word for successors in model.values() for next_word in successors])
+    values = np.array([value for successors in model.values() for value in successors.values()], dtype=dtype)
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return CSRMatrix(indptr, cols[order], values[order], size)
+
+def addBigramCounts(counts, trie):
+    '''
+    Add the bigram counts of a trie to a CSRMatrix of bigram counts, over the (possibly larger) vocabulary of the trie.
+    Return the CSRMatrix of the sums and the ids of the rows whose counts changed.
+    '''
+    size = trie.size
+    new_counts = bigramMatrix(trie)
+    keys = [matrix.row_ids().astype(np.int64) * size + matrix.indices for matrix in (counts, new_counts)]
+    keys, data = sumByKey(np.concatenate(keys), np.concatenate([counts.data, new_counts.data]))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // size, minlength=size), out=indptr[1:])
+    return CSRMatrix(indptr, (keys % size).astype(np.int32), data, size), np.flatnonzero(np.diff(new_counts.indptr))
+
+def logMatrix(model, dtype='float64'):
+    '''
+    Return a CSRMatrix of probabilities with their natural logs instead.
+    '''
+    return model.with_data(np.log(model.data, dtype=np.float64).astype(dtype))
+
+class BigramModel(LanguageModel):
+    def __init__(self, trainCorpus, backend='dict', vocab=None, dtype='float64', workers=None):
+        '''
+        Initialize and train the model
+        Input 'trainCorpus' is a list (or any iterable, read once) of sentences where each sentence is a list of words.
+        'backend' is either 'dict' (a dictionary of dictionaries) or 'csr' (a CSRMatrix indexed by token ids).
+        'vocab' is an optional Vocabulary to share with other models, a new one is built otherwise.
+        'dtype' is the type of the probabilities stored by the 'csr' backend, np.float32 halves their memory.
+        'workers' is the number of processes counting the corpus in parallel (see countCorpus).
+        '''
+        assert backend in {'dict', 'csr'}, "backend must be 'dict' or 'csr'"
+        self.corpus = trainCorpus
+        self.backend = backend
+        self.dtype = dtype
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = workers
+        self.counts = bigramMatrix(countCorpus(self.corpus, self.vocab, 2, self.workers)) # Raw counts, kept for update
+        self.model = self.train()
+        self.logmodel = self.getLogModel()
+        self.samplers = {}
+        self.successors = None # Successor lists sorted by probability, built on the first prediction
+        self.logmatrix = None # CSRMatrix of the log probabilities of the 'dict' backend, built on the first batch query
+        self.changed = None # Ids of the words whose successor counts changed since the probabilities were computed
+
+    def train(self):
+        '''
+        Train the model by calculating the conditional probability of each word from the bigram counts of the corpus.
+        Return a dictionary of dictionaries stroing the conditional frequency of each word on the previous word,
+        or the equivalent CSRMatrix with the 'csr' backend.
+        '''
+        model = self.getProbabilities(self.counts)
+        return model if self.backend == 'csr' else model.to_dict(self.vocab)
+
+    def getProbabilities(self, counts):
+        '''
+        Return the CSRMatrix of the conditional probabilities from the CSRMatrix of the bigram counts.
+        '''
+        # Calculate the conditional porbabilities
+        totals = counts.row_sums()
+        return counts.with_data((counts.data / totals[counts.row_ids()]).astype(self.dtype))
+
+    def getLogModel(self):
+        '''
+        Return the model with natural log probabilities instead of probabilities, in the same backend.
+        They are computed once after training, so that scoring only sums lookups.
+        '''
+        logmodel = logMatrix(self.getMatrix(), self.dtype)
+        return logmodel if self.backend == 'csr' else logmodel.to_dict(self.vocab)
+
+    def update(self, sentences):
+        self.addCounts(countCorpus(sentences, self.vocab, 2, self.workers))
+        self.clearCache()
+
+    def addCounts(self, trie):
+        '''
+        Add the counts of an NGramTrie of order 2 to the raw counts, and remember which words have new successor counts.
+        '''
+        self.counts, changed = addBigramCounts(self.counts, trie)
+        self.changed = changed if self.changed is None else np.union1d(self.changed, changed)
+
+    def refresh(self):
+        '''
+        Recompute the conditional probabilities of the words whose successor counts changed since the last query.
+        The normalizer of a word only depends on its own counts: with the 'dict' backend only the dictionaries of these words are rebuilt,
+        the 'csr' backend recomputes its arrays in one vectorized pass.
+        '''
+        if self.changed is None:
+            return
+        changed, self.changed = self.changed, None
+        model = self.getProbabilities(self.counts)
+        logmodel = logMatrix(model, self.dtype)
+        words = self.vocab.decode(changed)
+        if self.backend == 'csr':
+            self.model, self.logmodel = model, logmodel
+        else:
+            for i, word in zip(changed, words):
+                next_ids, probs = model.row(i)
+                next_words = self.vocab.decode(next_ids)
+                self.model[word] = dict(zip(next_words, probs.tolist()))
+                self.logmodel[word] = dict(zip(next_words, logmodel.row(i)[1].tolist()))
+        for word in words:
+            self.samplers.pop(word, None)
+        self.successors = None
+        self.logmatrix = None
+
+    def getSampler(self, word):
+        '''
+        Return the alias table drawing the successors of the word, built on first use and cached per word.
+        '''
+        self.refresh()
+        sampler = self.samplers.get(word)
+        if sampler is None:
+            if self.backend == 'csr':
+                next_ids, probs = self.model.row(self.vocab.word2idx[word])
+                sampler = AliasTable(self.vocab.decode(next_ids), probs)
+            else:
+                sampler = AliasTable(self.model[word].keys(), list(self.model[word].values()))
+            self.samplers[word] = sampler
+        return sampler
+
+    def getSuccessors(self):
+        '''
+        Return a CSRMatrix of the log probabilities where each row is sorted by decreasing probability (ties by id),
+        sorted once and cached until the next update. Its column ids aren't sorted, so it must not be searched with find.
+        '''
+        self.refresh()
+        if self.successors is None:
+            logmodel = self.getLogMatrix()
+            order = np.lexsort((logmodel.indices, -logmodel.data, logmodel.row_ids()))
+            self.successors = CSRMatrix(logmodel.indptr, logmodel.indices[order], logmodel.data[order].astype(np.float64), logmodel.n_cols)
+        return self.successors
+
+    def predictNext(self, context, k=5):
+        '''
+        Return the k most probable next words after the context (a token or a list of tokens, only the last one matters)
+        as a list of (word, log probability) pairs by decreasing probability.
+        A context word that doesn't belong to the corpus, or that was never followed by a word (such as '</s>'), gives an empty list.
+        '''
+        word = context if isinstance(context, str) else context[-1]
+        successors = self.getSuccessors()
+        i = self.vocab.word2idx.get(word, -1)
+        if not 0 <= i < successors.n_rows:
+            return []
+        next_ids, log_probs = successors.row(i)
+        return list(zip(self.vocab.decode(next_ids[:k]), log_probs[:k].tolist()))
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate sentences based on the bigram model, the sentence starts with the token '<s>' and ends with the token '</s>'
+        'rng' is the random number generator to draw from (the random module by default).
+        The output sentence is a list of tokens from the model beginning with '<s>' and ends with '</s>'
+        '''
+        # Initialize the sentence
+        sentence = []
+        sentence.append('<s>')
+
+        curr_word = sentence[0] # Set the current word to be the '<s>'
+        while True:
+            next_word = self.getSampler(curr_word).draw(rng)
+            sentence.append(next_word)
+            curr_word = next_word
+            if curr_word == '</s>':
+                break # Break if the token generated is '</s>'
+
+        return sentence
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the conditonal log probability of the sentence
+        Input is the list of tokens
+        Output is the float number that is the log probability of the sentence
+        '''
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        if self.backend == 'csr':
+            return float(self.scoreSentences([sentence])[0])
+
+        return sum(self.getWordLogProbabilities(sentence))
+
+    def getWordLogProbabilities(self, sentence):
+        '''
+        Calculate the log probability of every word of the sentence but the first given the previous one, with the 'dict' backend.
+        Return a list, -infinity for the bigrams that were never seen.
+        '''
+        self.refresh()
+        logmodel = self.logmodel
+        log_probs = []
+        for curr_word, next_word in zip(sentence, sentence[1:]):
+            if curr_word in logmodel and next_word in logmodel[curr_word]:
+                log_probs.append(logmodel[curr_word][next_word])
+            else:
+                log_probs.append(-math.inf) # If there's no such conditional distribution in the model, the sentence gets -infinity
+        return log_probs
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        '''
+        Score the words of sentence[start:stops[-1]] once, with the dictionaries or the arrays of the backend, and sum them up to each stop.
+        '''
+        words = sentence[start - 1:stops[-1]]
+        if self.backend == 'csr':
+            ids = self.vocab.encode(words)
+            log_probs = self.getPairLogProbabilities(ids[:-1], ids[1:]).tolist()
+        else:
+            log_probs = self.getWordLogProbabilities(words)
+        log_probs = [0.0, *accumulate(log_probs)]
+        return [log_probs[max(stop - start, 0)] for stop in stops]
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexcity of the testcorpus based on the model from the current corpus
+        Input testCorpus is the list of sentences
+        Output is a float number representing the perplexity of the input corpus
+        '''
+        ids, offsets = self.vocab.encode_corpus(testCorpus)
+        log_prob_sum = self.getTokenLogProbabilities(ids, offsets).sum()
+        word_count = len(ids) - (len(offsets) - 1) # Don't take '<s>' as the word count
+        return math.exp(-log_prob_sum / word_count)
+
+    def scoreSentences(self, sentences):
+        '''
+        Calculate the log probability of every sentence of the list.
+        The sentences are encoded into one flat id array and all their bigrams are looked up at once, whatever the backend.
+        Return a float64 array.
+        '''
+        ids, offsets = self.vocab.encode_corpus(sentences)
+        return sumSegments(self.getTokenLogProbabilities(ids, offsets), offsets)
+
+    def getTokenLogProbabilities(self, ids, offsets):
+        '''
+        Calculate the log probability of every word of an encoded corpus given the previous one, 0 for the first word of each sentence.
+        '''
+        keep = pairMask(ids, offsets)
+        log_probs = np.zeros(len(ids))
+        log_probs[1:][keep] = self.getPairLogProbabilities(ids[:-1][keep], ids[1:][keep])
+        return log_probs
+
+    def getPairLogProbabilities(self, curr_ids, next_ids):
+        '''
+        Calculate log P(next | curr) for arrays of token ids, -infinity for the bigrams that were never seen.
+        '''
+        logmodel = self.getLogMatrix()
+        positions = logmodel.find(curr_ids, next_ids)
+        log_probs = np.full(len(positions), -np.inf)
+        seen = positions >= 0
+        log_probs[seen] = logmodel.data[positions[seen]]
+        return log_probs
+
+    def getLogMatrix(self):
+        '''
+        Return the CSRMatrix of the log probabilities, whatever the backend.
+        With the 'dict' backend it is built from the dictionaries on first use and cached until the next update,
+        so that the batch queries look up id arrays like the 'csr' backend.
+        '''
+        self.refresh()
+        if self.backend == 'csr':
+            return self.logmodel
+        if self.logmatrix is None:
+            self.logmatrix = dictMatrix(self.logmodel, self.vocab, self.dtype)
+        return self.logmatrix
+
+    def getMatrix(self):
+        '''
+        Return the model as a CSRMatrix, whatever the backend.
+        '''
+        return self.model if self.backend == 'csr' else dictMatrix(self.model, self.vocab, self.dtype)
+
+    def getState(self):
+        self.refresh()
+        model = self.getMatrix() # Same sparsity structure as the counts
+        logmodel = self.getLogMatrix()
+        arrays = {'indptr': model.indptr, 'indices': model.indices, 'counts': self.counts.data, 'data': model.data, 'logdata': logmodel.data,
+                  'keys': logmodel.sorted_keys()} # Saved so that processes loading the file share them instead of building their own
+        return arrays, {'backend': self.backend, 'dtype': np.dtype(self.dtype).str, 'n_cols': model.n_cols}
+
+    def setState(self, arrays, params):
+        self.backend, self.dtype = params['backend'], np.dtype(params['dtype']).type
+        model = CSRMatrix(arrays['indptr'], arrays['indices'], arrays['data'], params['n_cols'])
+        model.keys = arrays.get('keys')
+        logmodel = model.with_data(arrays['logdata'])
+        self.counts = model.with_data(arrays['counts'])
+        self.model, self.logmodel = (model, logmodel) if self.backend == 'csr' else (model.to_dict(self.vocab), logmodel.to_dict(self.vocab))
+        self.samplers = {}
+        self.successors = None
+        self.logmatrix = None if self.backend == 'csr' else logmodel
+        self.changed = None
+
+    def getBackoffLevels(self):
+        '''
+        The unseen bigrams have a probability of 0, so every unigram probability and backoff weight is log 0.
+        '''
+        model = self.getLogMatrix()
+        unigrams = np.full(model.n_rows, -np.inf)
+        grams = np.column_stack([model.row_ids(), model.indices])
+        return [(np.arange(model.n_rows)[:, None], unigrams, unigrams), (grams, model.data.astype(np.float64), None)]
+
+    def prune(self, min_count=1, threshold=0.0):
+        '''
+        Return a smaller copy of the model, as a BackoffModel over the same vocabulary.
+        The bigrams seen less than 'min_count' times are dropped, and so are the bigrams whose removal would increase the perplexity
+        by a relative amount under 'threshold' (Stolcke's relative entropy pruning, see getPruningCosts).
+        The probabilities of the bigrams that are kept don't change, the distributions are renormalized by getPrunedLevels.
+        '''
+        self.refresh()
+        keep = self.counts.data >= min_count
+        if threshold > 0:
+            keep &= np.expm1(self.getPruningCosts()) >= threshold
+        return backoffModel(self.getPrunedLevels(keep), self.vocab)
+
+    def getPruningCosts(self):
+        '''
+        Calculate the relative entropy between the model and the model without each bigram (in the order of self.counts).
+        A bigram of the unsmoothed model would get a probability of 0, so all the costs are infinite.
+        '''
+        return np.full(len(self.counts.data), np.inf)
+
+    def getPrunedLevels(self, keep):
+        '''
+        Return the backoff form (see getBackoffLevels) of the model keeping only the bigrams where 'keep' is True.
+        The unsmoothed model renormalizes the probabilities of the bigrams kept in each context, i.e. re-estimates them from their counts.
+        '''
+        unigrams, (grams, log_probs, log_bows) = self.getBackoffLevels()
+        grams, log_probs = grams[keep], log_probs[keep]
+        totals = np.bincount(grams[:, 0], weights=np.exp(log_probs), minlength=len(unigrams[0]))
+        return [unigrams, (grams, log_probs - np.log(totals[grams[:, 0]]), None)]
+
+if __name__=='__main__':
+    sanityCheck('bigram')
+
+if __name__=='__main__':
+    sanityCheckFullDataset('bigram')
+
+if __name__=='__main__':
+    runModel('bigram')
+
+"""### Smoothed Bigram Model"""
+
+class SmoothedBigramModelAD(BigramModel):
+    def __init__(self, trainCorpus, backend='dict', vocab=None, dtype='float64', workers=None):
+        '''
+        Initialize and train the model
+        Input 'trainCorpus' is a list (or any iterable, read once) of sentences where each sentence is a list of words.
+        'backend', 'vocab', 'dtype' and 'workers' are the same as for BigramModel.
+        '''
+        assert backend in {'dict', 'csr'}, "backend must be 'dict' or 'csr'"
+        self.corpus = trainCorpus
+        self.backend = backend
+        self.dtype = dtype
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = workers
+        trie = countCorpus(self.corpus, self.vocab, 2, self.workers)
+        self.counts, self.unigram_counts = bigramMatrix(trie), unigramCounts(trie) # Raw counts, kept for update
+        self.model, self.model_count, self.D, self.S, self.unigram = self.train()
+        self.logmodel = self.getLogModel()
+        self.logbows, self.logunigram = self.getLogBackoff()
+        self.samplers = {}
+        self.successors = None
+        self.logmatrix = None
+        self.backoff_arrays = None # Backoff arrays of the 'dict' backend, built on the first batch query
+        self.unigram_ranking = None # Ids of the unigram model by decreasing probability, the backoff candidates of predictNext
+        self.changed = None
+
+    def train(self):
+        '''
+        Train the model with the smoothed method from the bigram and unigram counts of the corpus
+        Output is a dictionary of dictionaries that represents the smoothed distribution of the model (a CSRMatrix with the 'csr' backend),
+        the number of bigrams starting with each word, the discount D, the number of distinct successors S of each word and the smoothed unigram model.
+        '''
+        counts = self.counts
+        unigram = self.get_unirgam(self.unigram_counts)
+
+        D, S = self.calculate_DS(counts)
+
+        # Calculate the conditional porbabilities
+        model_count = counts.row_sums().astype(np.int64)
+        rows, cols = counts.row_ids(), counts.indices
+        total_next_words = model_count[rows]
+        probs = np.maximum(counts.data - D, 0) / total_next_words + (D / total_next_words * S[rows] * unigram[cols])
+        model = counts.with_data(probs.astype(self.dtype))
+
+        if self.backend == 'csr':
+            return model, model_count, D, S, unigram
+        return self.toDicts(model, model_count, D, S, unigram)
+
+    def toDicts(self, model, model_count, D, S, unigram):
+        '''
+        Convert the arrays of the 'csr' backend to the dictionaries keyed by tokens of the 'dict' backend.
+        '''
+        words = self.vocab.idx2word
+        contexts = np.flatnonzero(model_count)
+        model_count = {words[i]: int(model_count[i]) for i in contexts}
+        S = {words[i]: int(S[i]) for i in contexts}
+        unigram = {words[i]: float(unigram[i]) for i in np.flatnonzero(unigram)}
+        return model.to_dict(self.vocab), model_count, D, S, unigram
+
+    def addCounts(self, trie):
+        super().addCounts(trie)
+        unigram_counts = unigramCounts(trie)
+        unigram_counts[:len(self.unigram_counts)] += self.unigram_counts
+        self.unigram_counts = unigram_counts
+
+    def refresh(self):
+        '''
+        Recompute the model after an update. D depends on the count-of-counts of all the bigrams and the unigram model on the total count,
+        so every probability changes: the whole model is recomputed from the counts, in one vectorized pass.
+        '''
+        if self.changed is None:
+            return
+        self.changed = None
+        self.model, self.model_count, self.D, self.S, self.unigram = self.train()
+        self.logmodel = self.getLogModel()
+        self.logbows, self.logunigram = self.getLogBackoff()
+        self.samplers = {}
+        self.successors = None
+        self.logmatrix = None
+        self.backoff_arrays = None
+        self.unigram_ranking = None
+
+    def getLogBackoff(self, backend=None):
+        '''
+        Return the log backoff weights log(D / count(curr) * S[curr]) and the log of the smoothed unigram model,
+        as arrays indexed by token id (dictionaries keyed by tokens with the 'dict' backend, unless 'backend' is 'csr').
+        An unseen bigram then scores logbows[curr] + logunigram[next] with two lookups.
+        '''
+        model_count, S, unigram = self.getArrays()
+        logbows = logProbabilities(self.D * S / np.maximum(model_count, 1))
+        logunigram = logProbabilities(unigram)
+        if (backend or self.backend) == 'csr':
+            return logbows, logunigram
+        words = self.vocab.idx2word
+        logbows = {words[i]: float(logbows[i]) for i in np.flatnonzero(model_count)}
+        logunigram = {words[i]: float(logunigram[i]) for i in np.flatnonzero(unigram)}
+        return logbows, logunigram
+
+    def calculate_DS(self, counts):
+        '''
+        Calculate the D and S of the model from the CSRMatrix of bigram counts
+        S is the array of the number of distinct successors of each word
+        '''
+        n1 = int(np.count_nonzero(counts.data == 1))
+        n2 = int(np.count_nonzero(counts.data == 2))
+        S = np.diff(counts.indptr)
+
+        D = n1 / (n1 + 2 * n2)
+
+        return D, S
+
+    def get_unirgam(self, counts):
+        '''
+        Get the smoothed unigram model from the array of the token counts of the corpus
+        Return an array of probabilities indexed by token id, tokens that never occur (such as '<s>') have a probability of 0
+        '''
+        counts = counts.copy()
+        counts[self.vocab.add(START)] = 0
+        number_tokens = np.count_nonzero(counts)
+
+        model = (counts + 1) / (counts.sum() + number_tokens)
+        model[counts == 0] = 0
+
+        return model
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the conditonal log probability of the sentence
+        Input is the list of tokens
+        Output is the float number that is the log probability of the sentence
+        '''
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        if self.backend == 'csr':
+            return float(self.scoreSentences([sentence])[0])
+
+        return sum(self.getWordLogProbabilities(sentence))
+
+    def getWordLogProbabilities(self, sentence):
+        self.refresh()
+        logmodel, logbows, logunigram = self.logmodel, self.logbows, self.logunigram
+        log_probs = []
+        for curr_word, next_word in zip(sentence, sentence[1:]):
+            if curr_word in logmodel and next_word in logmodel[curr_word]:
+                log_probs.append(logmodel[curr_word][next_word])
+            else:
+                log_probs.append(logbows[curr_word] + logunigram[next_word])
+        return log_probs
+
+    def getPairLogProbabilities(self, curr_ids, next_ids):
+        '''
+        Calculate the smoothed log P(next | curr) for arrays of token ids.
+        Unseen bigrams get the discounted mass D / count(curr) * S[curr] * unigram[next], i.e. logbows[curr] + logunigram[next].
+        '''
+        logmodel = self.getLogMatrix()
+        model_count, unigram, logbows, logunigram = self.getBackoffArrays()
+        known = (curr_ids >= 0) & (curr_ids < len(model_count)) & (next_ids >= 0) & (next_ids < len(unigram))
+        if not known.all() or not model_count[curr_ids].all() or not unigram[next_ids].all():
+            raise ValueError("Sentence contains tokens that doesn't belong to the corpus")
+
+        positions = logmodel.find(curr_ids, next_ids)
+        seen = positions >= 0
+        log_probs = np.empty(len(positions))
+        log_probs[seen] = logmodel.data[positions[seen]]
+        curr_ids, next_ids = curr_ids[~seen], next_ids[~seen]
+        log_probs[~seen] = logbows[curr_ids] + logunigram[next_ids]
+        return log_probs
+
+    def getBackoffArrays(self):
+        '''
+        Return the model counts, the smoothed unigram model, the log backoff weights and the log unigram probabilities as arrays indexed by token id,
+        whatever the backend: with the 'dict' backend they are built on first use and cached until the next update, like getLogMatrix.
+        '''
+        self.refresh()
+        if self.backend == 'csr':
+            return self.model_count, self.unigram, self.logbows, self.logunigram
+        if self.backoff_arrays is None:
+            model_count, S, unigram = self.getArrays()
+            self.backoff_arrays = (model_count, unigram, *self.getLogBackoff('csr'))
+        return self.backoff_arrays
+
+    def countBackoffs(self, sentences):
+        '''
+        The bigrams seen in the training corpus are scored from the model, the others back off to the unigram model.
+        Both backends look the bigrams up by id in the log matrix (see getLogMatrix), without decoding an EncodedCorpus.
+        '''
+        ids, offsets = self.vocab.encode_corpus(sentences)
+        keep = pairMask(ids, offsets)
+        seen = int((self.getLogMatrix().find(ids[:-1][keep], ids[1:][keep]) >= 0).sum())
+        return seen, int(keep.sum()) - seen
+
+    def getUnigramRanking(self):
+        '''
+        Return the ids of the words of the unigram model sorted by decreasing probability (ties by id) and their log probabilities,
+        sorted once and cached until the next update.
+        '''
+        self.refresh()
+        if self.unigram_ranking is None:
+            unigram = self.getArrays()[2]
+            ids = np.flatnonzero(unigram)
+            ids = ids[np.lexsort((ids, -unigram[ids]))]
+            self.unigram_ranking = ids, np.log(unigram[ids])
+        return self.unigram_ranking
+
+    def predictNext(self, context, k=5):
+        '''
+        Return the k most probable next words after the context (a token or a list of tokens, only the last one matters)
+        as a list of (word, log probability) pairs by decreasing probability.
+        A context word that doesn't belong to the corpus, or that was never followed by a word (such as '</s>'), gives an empty list, as for BigramModel.
+        An unseen successor scores logbows[curr] + logunigram[next], so its rank only depends on the unigram model:
+        the best unseen words are the first words of the global unigram ranking that aren't seen successors,
+        and at most k + (number of seen successors) of them need to be looked at.
+        '''
+        word = context if isinstance(context, str) else context[-1]
+        successors = self.getSuccessors()
+        i = self.vocab.word2idx.get(word, -1)
+        if not 0 <= i < successors.n_rows or successors.indptr[i] == successors.indptr[i + 1]:
+            return []
+        seen_ids, seen_log_probs = successors.row(i)
+        seen_ids, seen_log_probs = seen_ids[:k], seen_log_probs[:k]
+        ranked_ids, ranked_log_probs = self.getUnigramRanking()
+        candidates = slice(0, k + successors.indptr[i + 1] - successors.indptr[i])
+        unseen = ~np.isin(ranked_ids[candidates], successors.row(i)[0])
+        log_bow = self.logbows[i] if self.backend == 'csr' else self.logbows[word]
+        unseen_ids = ranked_ids[candidates][unseen][:k]
+        unseen_log_probs = log_bow + ranked_log_probs[candidates][unseen][:k]
+        ids = np.concatenate([seen_ids, unseen_ids])
+        log_probs = np.concatenate([seen_log_probs, unseen_log_probs])
+        order = np.lexsort((ids, -log_probs))[:k]
+        return list(zip(self.vocab.decode(ids[order]), log_probs[order].tolist()))
+
+    def getArrays(self):
+        '''
+        Return the model counts, S and the unigram model as arrays indexed by token id, whatever the backend.
+        '''
+        if self.backend == 'csr':
+            return self.model_count, self.S, self.unigram
+        size = len(self.vocab)
+        model_count, S, unigram = np.zeros(size, dtype=np.int64), np.zeros(size, dtype=np.int64), np.zeros(size)
+        model_count[self.vocab.encode(list(self.model_count))] = list(self.model_count.values())
+        S[self.vocab.encode(list(self.S))] = list(self.S.values())
+        unigram[self.vocab.encode(list(self.unigram))] = list(self.unigram.values())
+        return model_count, S, unigram
+
+    def getState(self):
+        arrays, params = super().getState()
+        arrays['model_count'], arrays['S'], arrays['unigram'] = self.getArrays()
+        arrays['unigram_counts'] = self.unigram_counts
+        params['D'] = self.D
+        return arrays, params
+
+    def setState(self, arrays, params):
+        self.backend, self.dtype = params['backend'], np.dtype(params['dtype']).type
+        model = CSRMatrix(arrays['indptr'], arrays['indices'], arrays['data'], params['n_cols'])
+        model.keys = arrays.get('keys')
+        state = (model, arrays['model_count'], params['D'], arrays['S'], arrays['unigram'])
+        self.model, self.model_count, self.D, self.S, self.unigram = state if self.backend == 'csr' else self.toDicts(*state)
+        logmodel = model.with_data(arrays['logdata'])
+        self.logmodel = logmodel if self.backend == 'csr' else logmodel.to_dict(self.vocab)
+        self.logbows, self.logunigram = self.getLogBackoff() # Only as large as the vocabulary
+        self.counts, self.unigram_counts = model.with_data(arrays['counts']), arrays['unigram_counts']
+        self.samplers = {}
+        self.successors = None
+        self.logmatrix = None if self.backend == 'csr' else logmodel
+        self.backoff_arrays = None
+        self.unigram_ranking = None
+        self.changed = None
+
+    def getBackoffLevels(self):
+        '''
+        The backoff weight of a context is D / count(curr) * S[curr], and the unigrams are the smoothed unigram model.
+        '''
+        model = self.getLogMatrix()
+        model_count, S, unigram = self.getArrays()
+        log_unigram = logProbabilities(unigram)
+        log_bows = np.where(model_count > 0, logProbabilities(self.D * S / np.maximum(model_count, 1)), 0)
+        grams = np.column_stack([model.row_ids(), model.indices])
+        return [(np.arange(len(unigram))[:, None], log_unigram, log_bows), (grams, model.data.astype(np.float64), None)]
+
+    def getPruningCosts(self):
+        '''
+        Calculate, for every bigram (in the order of self.counts), the relative entropy between the model and the model without it (Stolcke, 1998):
+        the bigram then backs off to the unigram model, and the backoff weight of its context is recomputed so that the distribution still sums to 1.
+        The probability of a context is estimated by its relative frequency. exp(cost) - 1 is the relative increase of the perplexity.
+        '''
+        (ids, log_unigram, log_bows), (grams, log_probs, _) = self.getBackoffLevels()
+        rows, cols = grams[:, 0], grams[:, 1]
+        probs, unigram = np.exp(log_probs), np.exp(log_unigram)
+        # Mass left to the unseen words by each context, and mass of the unseen words in the unigram model
+        left = 1 - np.bincount(rows, weights=probs, minlength=len(ids))
+        unseen = 1 - np.bincount(rows, weights=unigram[cols], minlength=len(ids))
+        new_log_bows = np.log((left[rows] + probs) / (unseen[rows] + unigram[cols]))
+        history = self.counts.row_sums()
+        history = history[rows] / history.sum()
+        return -history * (probs * (new_log_bows + log_unigram[cols] - log_probs) + left[rows] * (new_log_bows - log_bows[rows]))
+
+    def getPrunedLevels(self, keep):
+        '''
+        Return the backoff form (see getBackoffLevels) of the model keeping only the bigrams where 'keep' is True.
+        The backoff weight of each context that lost bigrams becomes the mass left to its unseen words over their unigram mass.
+        '''
+        (ids, log_unigram, log_bows), (grams, log_probs, _) = self.getBackoffLevels()
+        pruned = np.bincount(grams[~keep, 0], minlength=len(ids)) > 0
+        grams, log_probs = grams[keep], log_probs[keep]
+        rows, cols = grams[:, 0], grams[:, 1]
+        left = 1 - np.bincount(rows, weights=np.exp(log_probs), minlength=len(ids))
+        unseen = 1 - np.bincount(rows, weights=np.exp(log_unigram[cols]), minlength=len(ids))
+        log_bows = np.where(pruned, logProbabilities(np.maximum(left, 0) / np.where(pruned, unseen, 1)), log_bows)
+        return [(ids, log_unigram, log_bows), (grams, log_probs, None)]
+
+if __name__=='__main__':
+    sanityCheck('smoothed-bigram')
+
+if __name__=='__main__':
+    sanityCheckFullDataset('smoothed-bigram')
+
+if __name__=='__main__':
+    runModel('smoothed-bigram')
+
+"""### Next Word Prediction
+
+`predictNext(context, k)` returns the k most probable next words of a bigram model. The successors of every word are sorted by probability once, so a query only slices the row of the context. A context word outside the corpus, or never followed by a word like `</s>`, gets an empty list from both models. For the smoothed model the unseen words all share the backoff weight of the context, so they rank like the unigram model: their best candidates are read from the global unigram ranking, skipping the seen successors, and merged with the best seen successors.
+"""
+
+def sanityCheckPredictNext(k=5):
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    for model_type, backend in (('bigram', 'dict'), ('bigram', 'csr'), ('smoothed-bigram', 'dict'), ('smoothed-bigram', 'csr')):
+        model = (BigramModel if model_type == 'bigram' else SmoothedBigramModelAD)(train_corpus, backend=backend)
+        print("--- TEST: predictNext of the %s model (%s backend) ---" % (model_type, backend))
+        words = model.vocab.idx2word
+        failed = 0
+        for context in sorted(set(word for sen in train_corpus for word in sen[:-1])):
+            # Brute force: score every word of the vocabulary after the context
+            log_probs = [model.getSentenceLogProbability([context, word]) if word != START else -math.inf for word in words]
+            ranking = sorted((-log_prob, i) for i, log_prob in enumerate(log_probs) if log_prob > -math.inf)[:k]
+            correct = [(words[i], round(-log_prob, 10)) for log_prob, i in ranking]
+            prediction = [(word, round(log_prob, 10)) for word, log_prob in model.predictNext(context, k)]
+            if prediction != correct:
+                print("Context:", context, "\tpredicted:", prediction, "\texpected:", correct, "\tFAILED")
+                failed += 1
+        for context in ('unknown-word', END, ['the', END]): # No successors: no prediction, whatever the model
+            if model.predictNext(context, k) != []:
+                print("Context:", context, "\tpredicted:", model.predictNext(context, k), "\texpected: []\tFAILED")
+                failed += 1
+        print("Test predictNext passed!" if not failed else "Test predictNext failed...")
+
+if __name__=='__main__':
+    sanityCheckPredictNext()
+
+"""### N-gram Model
+
+`NGramModel` generalizes the bigram model to any order n >= 2, on top of the `NGramTrie` of its counts.
+
+The first words of a sentence are predicted from the shorter contexts available, e.g. $P(w_1 | \text{<s>})$ and $P(w_2 | \text{<s>}, w_1)$ for a trigram model, so `NGramModel(corpus, n=2)` gives the same results as `BigramModel`.
+"""
+
+def gramWindows(ids, offsets, n):
+    '''
+    Group the positions of an encoded corpus by the length k of the n-gram ending there, sentence starts excluded:
+    the first words of a sentence only have the shorter contexts that precede them.
+    Yield k and the (m, k) array of the ids of the k-grams ending at each of the m positions, with these positions.
+    '''
+    depth = np.arange(len(ids)) - np.repeat(offsets[:-1], np.diff(offsets)) # Position within the sentence
+    lengths = np.where(depth > 0, np.minimum(depth + 1, n), 0)
+    for k in range(min(n, 2), n + 1):
+        positions = np.flatnonzero(lengths == k)
+        yield k, ids[positions[:, None] + np.arange(1 - k, 1)], positions
+
+class NGramModel(LanguageModel):
+    def __init__(self, trainCorpus, n=3, vocab=None, workers=None):
+        '''
+        Initialize and train an n-gram model
+        Input 'trainCorpus' is a list (or any iterable, read once) of sentences where each sentence is a list of words, n is the order of the model (at least 2).
+        'vocab' is an optional Vocabulary to share with other models, a new one is built otherwise.
+        'workers' is the number of processes counting the corpus in parallel (see countCorpus).
+        '''
+        assert n >= 2, 'Use UnigramModel for n = 1'
+        self.corpus = trainCorpus
+        self.n = n
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = workers
+        self.model = self.train()
+        self.totals = [self.model.successor_totals(level) for level in range(n - 1)]
+        self.logprobs = self.getLogProbabilities()
+        self.samplers = {}
+        self.stale = False # Whether update added counts since the probabilities were computed
+
+    def train(self):
+        '''
+        Train the model by counting all the k-grams of the corpus up to the order of the model.
+        Return the NGramTrie of the counts.
+        '''
+        return countCorpus(self.corpus, self.vocab, self.n, self.workers)
+
+    def getLogProbabilities(self):
+        '''
+        Return the log probability of every node of the trie given its prefix, log(count / total count of the prefix's successors),
+        the unigrams being relative frequencies. They are computed once after training, so that scoring only sums lookups.
+        '''
+        logprobs = [logProbabilities(self.model.counts[0] / self.model.counts[0].sum())]
+        for level in range(1, self.n):
+            totals = self.totals[level - 1][self.model.parents(level, np.arange(len(self.model.keys[level])))]
+            logprobs.append(np.log(self.model.counts[level] / totals))
+        return logprobs
+
+    def update(self, sentences):
+        self.model = mergeTries([self.model, countCorpus(sentences, self.vocab, self.n, self.workers)], len(self.vocab))
+        self.stale = True
+        self.clearCache()
+
+    def refresh(self):
+        '''
+        Recompute the successor totals and the log probabilities from the merged counts after an update.
+        '''
+        if self.stale:
+            self.totals = [self.model.successor_totals(level) for level in range(self.n - 1)]
+            self.logprobs = self.getLogProbabilities()
+            self.samplers = {}
+            self.stale = False
+
+    def getSampler(self, context):
+        '''
+        Return the alias table drawing the ids of the words following a context (a tuple of ids), built on first use and cached.
+        '''
+        self.refresh()
+        sampler = self.samplers.get(context)
+        if sampler is None:
+            level = len(context) - 1
+            node = self.model.find([context])[0]
+            next_ids, counts = self.model.children(level, node)
+            sampler = AliasTable(next_ids.tolist(), counts)
+            self.samplers[context] = sampler
+        return sampler
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate a sentence based on the n-gram model, each word being drawn given the n-1 words before it.
+        'rng' is the random number generator to draw from (the random module by default).
+        The output sentence is a list of tokens beginning with '<s>' and ending with '</s>'
+        '''
+        end = self.vocab.word2idx[END]
+        ids = [self.vocab.word2idx[START]]
+        while ids[-1] != end:
+            ids.append(self.getSampler(tuple(ids[-(self.n - 1):])).draw(rng))
+        return self.vocab.decode(ids)
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the log probability of the sentence, -infinity if it contains an n-gram that was never seen
+        Input is the list of tokens
+        Output is the float number that is the log probability of the sentence
+        '''
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        return float(self.scoreSentences([sentence])[0])
+
+    def getSuffixLogProbability(self, sentence, start):
+        return self.getSuffixLogProbabilities(sentence, start, [len(sentence)])[0]
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        '''
+        Calculate the log probabilities of the words sentence[start:stop] given the words before them for each length in 'stops',
+        looking up only the n-grams ending after 'start', once.
+        '''
+        ids = self.vocab.encode(sentence[:stops[-1]])
+        log_probs = np.zeros(len(ids) + 1)
+        for k, grams, positions in gramWindows(ids, np.array([0, len(ids)]), self.n):
+            new = positions >= start
+            if new.any():
+                log_probs[positions[new] + 1] = self.getGramLogProbabilities(grams[new])
+        return np.cumsum(log_probs)[stops].tolist()
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexcity of the testcorpus, '<s>' not being counted as a word
+        Input testCorpus is the list of sentences
+        Output is a float number representing the perplexity of the input corpus
+        '''
+        ids, offsets = self.vocab.encode_corpus(testCorpus)
+        log_prob_sum = self.getTokenLogProbabilities(ids, offsets).sum()
+        word_count = len(ids) - (len(offsets) - 1) # Don't take '<s>' as the word count
+        return math.exp(-log_prob_sum / word_count)
+
+    def scoreSentences(self, sentences):
+        '''
+        Calculate the log probability of every sentence of the list.
+        Return a float64 array.
+        '''
+        ids, offsets = self.vocab.encode_corpus(sentences)
+        return sumSegments(self.getTokenLogProbabilities(ids, offsets), offsets)
+
+    def getTokenLogProbabilities(self, ids, offsets):
+        '''
+        Calculate the log probability of every word of an encoded corpus given the previous ones, 0 for the first word of each sentence.
+        The n-grams of all the sentences are looked up in the trie at once, one batch per n-gram length.
+        '''
+        log_probs = np.zeros(len(ids))
+        for k, grams, positions in gramWindows(ids, offsets, self.n):
+            log_probs[positions] = self.getGramLogProbabilities(grams)
+        return log_probs
+
+    def getGramLogProbabilities(self, grams):
+        '''
+        Calculate log P(last word | previous words) for the rows of an (m, k) id array, -infinity for the k-grams never seen.
+        '''
+        self.refresh()
+        level = grams.shape[1] - 1
+        nodes = self.model.find(grams)
+        seen = nodes >= 0
+        log_probs = np.full(len(grams), -np.inf)
+        log_probs[seen] = self.logprobs[level][nodes[seen]]
+        return log_probs
+
+    def getState(self):
+        self.refresh()
+        arrays = {}
+        for level in range(self.n):
+            arrays['keys.%d' % level], arrays['counts.%d' % level] = self.model.keys[level], self.model.counts[level]
+            arrays['logprobs.%d' % level] = self.logprobs[level]
+        for level in range(self.n - 1):
+            arrays['totals.%d' % level] = self.totals[level]
+        return arrays, {'n': self.n, 'size': self.model.size}
+
+    def setState(self, arrays, params):
+        self.n = params['n']
+        keys = [arrays['keys.%d' % level] for level in range(self.n)]
+        counts = [arrays['counts.%d' % level] for level in range(self.n)]
+        self.model = NGramTrie(keys, counts, params['size'])
+        self.totals = [arrays['totals.%d' % level] for level in range(self.n - 1)]
+        self.logprobs = [arrays['logprobs.%d' % level] for level in range(self.n)]
+        self.samplers = {}
+        self.stale = False
+
+    def getBackoffLevels(self):
+        '''
+        The unseen n-grams have a probability of 0, so every backoff weight is log 0,
+        and so is the probability of the lower order k-grams, except for those starting with '<s>' that begin a sentence.
+        '''
+        self.refresh()
+        start = self.vocab.word2idx[START]
+        levels = []
+        for level in range(self.n):
+            grams = self.model.grams(level)
+            log_probs = np.full(len(grams), -np.inf)
+            if level > 0:
+                log_probs = self.getGramLogProbabilities(grams)
+            if level < self.n - 1:
+                log_probs[grams[:, 0] != start] = -np.inf
+            levels.append((grams, log_probs, np.full(len(grams), -np.inf) if level < self.n - 1 else None))
+        return levels
+
+"""Sanity check: an `NGramModel` of order 2 must match the bigram model, and a trigram model should fit the training corpus better."""
+
+def sanityCheckNGram():
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    bigram, ngram, trigram = BigramModel(train_corpus), NGramModel(train_corpus, n=2), NGramModel(train_corpus, n=3)
+
+    print("--- TEST: NGramModel(n=2) == BigramModel ---")
+    sentences = [sentence, *train_corpus, *test_corpus]
+    failed = 0
+    for sen in sentences:
+        correct_prob, prob = round(bigram.getSentenceLogProbability(sen), 10), round(ngram.getSentenceLogProbability(sen), 10)
+        print("Bigram log prob.:", correct_prob, '\tN-gram log prob.:', prob, '\t', 'PASSED' if prob == correct_prob else 'FAILED')
+        if prob != correct_prob: failed += 1
+    print("Test NGramModel(n=2) passed!" if not failed else "Test NGramModel(n=2) failed...")
+
+    print("\n--- TEST: trigram model ---")
+    modelSen = trigram.generateSentence()
+    print("Generated:", modelSen)
+    train_perp, bigram_perp = trigram.getCorpusPerplexity(train_corpus), bigram.getCorpusPerplexity(train_corpus)
+    print("Trigram train perp.:", train_perp, '\tBigram train perp.:', bigram_perp, '\t', 'PASSED' if train_perp <= bigram_perp else 'FAILED')
+
+if __name__=='__main__':
+    sanityCheckNGram()
+
+if __name__=='__main__':
+    runModel('trigram')
+
+"""### Kneser-Ney Smoothed N-gram Model
+
+`KneserNeyModel` applies interpolated modified Kneser-Ney smoothing (Chen & Goodman, 1998) to an n-gram trie. Each order k uses three discounts $D_1, D_2, D_{3+}$ estimated from its count-of-counts, and the lower orders are estimated from continuation counts $N_{1+}(\bullet\, w_{i-k+1} \dots w_i)$ (the number of distinct words preceding the k-gram) rather than raw counts, except for the k-grams starting with `<s>`:
+
+$$P(w|h) = \frac{a(hw) - D(a(hw))}{\sum_{w'} a(hw')} + \gamma(h)\, P(w|h'), \qquad \gamma(h) = \frac{D_1 N_1(h\,\bullet) + D_2 N_2(h\,\bullet) + D_{3+} N_{3+}(h\,\bullet)}{\sum_{w'} a(hw')}$$
+
+where $h'$ is $h$ without its first word, and the unigrams are interpolated with the uniform distribution. Everything is computed once at training time and stored in log space in the backoff form used by ARPA files: every observed k-gram keeps its interpolated $\log P(w|h)$, and every context its $\log \gamma(h)$. Scoring a word is then one lookup plus one add per order it backs off through: $\log P(w|h) = \log \gamma(h) + \log P(w|h')$ for a word never seen after $h$.
+
+Scoring and generation only need this backoff form, so they live in `BackoffModel`, which also holds the models imported from ARPA files.
+"""
+
+class BackoffModel(LanguageModel):
+    def __init__(self, model, logprobs, logbows, vocab):
+        '''
+        N-gram model given in backoff form, such as a model read from an ARPA file (see loadARPA).
+        'model' is the NGramTrie of the k-grams of the model (its counts are not used, they may be None), 'logprobs' the log probability of every node of the trie
+        and 'logbows' the log backoff weight of every node of the levels below the highest order, 'vocab' the Vocabulary of the word ids.
+        '''
+        self.corpus = None
+        self.n = model.order
+        self.vocab = vocab
+        self.workers = None
+        self.model, self.logprobs, self.logbows = model, logprobs, logbows
+        self.samplers = {}
+
+    def getSampler(self, context):
+        '''
+        Return the sampler of a context (a tuple of ids), built on first use and cached:
+        the alias table of the words seen after the context, their total probability, and the set of their ids.
+        '''
+        self.refresh()
+        sampler = self.samplers.get(context)
+        if sampler is None:
+            level = len(context) - 1
+            if level < 0:
+                words = self.model.keys[0]
+                sampler = (AliasTable(words.tolist(), np.exp(self.logprobs[0])), 1.0, frozenset())
+            else:
+                node = self.model.find([context])[0]
+                if node < 0:
+                    sampler = (None, 0.0, frozenset())
+                else:
+                    keys = self.model.keys[level + 1]
+                    lo, hi = np.searchsorted(keys, [node * self.model.size, (node + 1) * self.model.size])
+                    next_ids = (keys[lo:hi] % self.model.size).tolist()
+                    probs = np.exp(self.logprobs[level + 1][lo:hi])
+                    sampler = (AliasTable(next_ids, probs) if next_ids else None, float(probs.sum()), frozenset(next_ids))
+            self.samplers[context] = sampler
+        return sampler
+
+    def drawWord(self, context, rng=random):
+        '''
+        Draw the id of the word following a context (a tuple of ids).
+        A word seen after the context is drawn with their total probability; otherwise the model backs off to the shorter context,
+        rejecting the words seen after the full one, which draws every other word with probability gamma(h) * P(w|h').
+        '''
+        table, seen_mass, seen = self.getSampler(context)
+        if table is not None and rng.random() < seen_mass:
+            return table.draw(rng)
+        while True:
+            word = self.drawWord(context[1:], rng)
+            if word not in seen:
+                return word
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate a sentence based on the n-gram model, each word being drawn given the n-1 words before it.
+        'rng' is the random number generator to draw from (the random module by default).
+        The output sentence is a list of tokens beginning with '<s>' and ending with '</s>'
+        '''
+        end = self.vocab.word2idx[END]
+        ids = [self.vocab.word2idx[START]]
+        while ids[-1] != end:
+            ids.append(self.drawWord(tuple(ids[max(len(ids) - self.n + 1, 0):]), rng))
+        return self.vocab.decode(ids)
+
+    def getSentenceLogProbability(self, sentence):
+        '''
+        Calculate the log probability of the sentence
+        Input is the list of tokens
+        Output is the float number that is the log probability of the sentence
+        '''
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        return float(self.scoreSentences([sentence])[0])
+
+    def getSuffixLogProbability(self, sentence, start):
+        return self.getSuffixLogProbabilities(sentence, start, [len(sentence)])[0]
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        '''
+        Calculate the log probabilities of the words sentence[start:stop] given the words before them for each length in 'stops',
+        looking up only the n-grams ending after 'start', once.
+        '''
+        ids = self.vocab.encode(sentence[:stops[-1]])
+        log_probs = np.zeros(len(ids) + 1)
+        for k, grams, positions in gramWindows(ids, np.array([0, len(ids)]), self.n):
+            new = positions >= start
+            if new.any():
+                log_probs[positions[new] + 1] = self.getGramLogProbabilities(grams[new])
+        return np.cumsum(log_probs)[stops].tolist()
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexcity of the testcorpus, '<s>' not being counted as a word
+        Input testCorpus is the list of sentences
+        Output is a float number representing the perplexity of the input corpus
+        '''
+        ids, offsets = self.vocab.encode_corpus(testCorpus)
+        log_prob_sum = self.getTokenLogProbabilities(ids, offsets).sum()
+        word_count = len(ids) - (len(offsets) - 1) # Don't take '<s>' as the word count
+        return math.exp(-log_prob_sum / word_count)
+
+    def scoreSentences(self, sentences):
+        '''
+        Calculate the log probability of every sentence of the list.
+        Return a float64 array.
+        '''
+        ids, offsets = self.vocab.encode_corpus(sentences)
+        return sumSegments(self.getTokenLogProbabilities(ids, offsets), offsets)
+
+    def getTokenLogProbabilities(self, ids, offsets):
+        '''
+        Calculate the log probability of every word of an encoded corpus given the previous ones, 0 for the first word of each sentence,
+        looking up all their n-grams at once.
+        '''
+        log_probs = np.zeros(len(ids))
+        for k, grams, positions in gramWindows(ids, offsets, self.n):
+            log_probs[positions] = self.getGramLogProbabilities(grams)
+        return log_probs
+
+    def getGramLogProbabilities(self, grams):
+        '''
+        Calculate log P(last word | previous words) for the rows of an (m, k) id array.
+        Each row looks up its longest suffix stored in the trie, adding the log backoff weights of the contexts it backs off from.
+        '''
+        self.refresh()
+        k = grams.shape[1]
+        log_probs = np.zeros(len(grams))
+        todo = np.arange(len(grams))
+        for j in range(k):
+            level = k - 1 - j
+            nodes, contexts = self.model.find(grams[todo, j:], context=True)
+            hit = nodes >= 0
+            log_probs[todo[hit]] += self.logprobs[level][nodes[hit]]
+            todo, contexts = todo[~hit], contexts[~hit]
+            if level > 0:
+                backoff = contexts >= 0
+                log_probs[todo[backoff]] += self.logbows[level - 1][contexts[backoff]]
+            if len(todo) == 0:
+                break
+        if len(todo):
+            raise ValueError("Sentence contains tokens that doesn't belong to the corpus")
+        return log_probs
+
+    def getState(self):
+        self.refresh()
+        arrays = {}
+        for level in range(self.n):
+            arrays['keys.%d' % level] = self.model.keys[level]
+            if self.model.counts is not None:
+                arrays['counts.%d' % level] = self.model.counts[level]
+            arrays['logprobs.%d' % level] = self.logprobs[level]
+        for level in range(self.n - 1):
+            arrays['logbows.%d' % level] = self.logbows[level]
+        return arrays, {'n': self.n, 'size': self.model.size}
+
+    def setState(self, arrays, params):
+        self.n = params['n']
+        keys = [arrays['keys.%d' % level] for level in range(self.n)]
+        counts = [arrays['counts.%d' % level] for level in range(self.n)] if 'counts.0' in arrays else None
+        self.model = NGramTrie(keys, counts, params['size'])
+        self.logprobs = [arrays['logprobs.%d' % level] for level in range(self.n)]
+        self.logbows = [arrays['logbows.%d' % level] for level in range(self.n - 1)]
+        self.samplers = {}
+
+    def getBackoffLevels(self):
+        self.refresh()
+        return [(self.model.grams(level), self.logprobs[level], self.logbows[level] if level < self.n - 1 else None) for level in range(self.n)]
+
+def backoffModel(levels, vocab):
+    '''
+    Build a BackoffModel from the backoff form of a model (see LanguageModel.getBackoffLevels) over the given Vocabulary.
+    The k-grams of every level must have their (k-1)-gram prefix in the level below.
+    '''
+    size = len(vocab)
+    trie = NGramTrie([], None, size)
+    logprobs, logbows = [], []
+    for level, (grams, log_probs, log_bows) in enumerate(levels):
+        parents = trie.find(grams[:, :-1]) if level else np.zeros(len(grams), dtype=np.int64)
+        if (parents < 0).any():
+            raise ValueError("Some %d-grams have no prefix in the model" % (level + 1))
+        keys = parents * size + grams[:, -1]
+        order = np.argsort(keys, kind='stable')
+        trie.keys.append(keys[order])
+        logprobs.append(np.asarray(log_probs, dtype=np.float64)[order])
+        logbows.append(np.zeros(len(keys)) if log_bows is None else np.asarray(log_bows, dtype=np.float64)[order])
+    return BackoffModel(trie, logprobs, logbows[:-1], vocab)
+
+class KneserNeyModel(BackoffModel):
+    def __init__(self, trainCorpus, n=3, vocab=None, workers=None):
+        '''
+        Initialize and train an interpolated modified Kneser-Ney n-gram model
+        Input 'trainCorpus' is a list (or any iterable, read once) of sentences where each sentence is a list of words, n is the order of the model (at least 2).
+        'vocab' is an optional Vocabulary to share with other models, a new one is built otherwise.
+        'workers' is the number of processes counting the corpus in parallel (see countCorpus).
+        '''
+        assert n >= 2, 'n must be at least 2'
+        self.corpus = trainCorpus
+        self.n = n
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = workers
+        self.model, self.discounts, self.logprobs, self.logbows = self.train()
+        self.samplers = {}
+        self.stale = False # Whether update added counts since the model was smoothed
+
+    def train(self):
+        '''
+        Count the k-grams of the corpus and smooth them.
+        Return the NGramTrie of the raw counts, the discounts (D1, D2, D3+) of each order,
+        the log probability of every node of the trie and the log backoff weight of every context node.
+        '''
+        self.vocab.add(START)
+        trie = countCorpus(self.corpus, self.vocab, self.n, self.workers)
+        return (trie,) + self.smooth(trie)
+
+    def update(self, sentences):
+        self.model = mergeTries([self.model, countCorpus(sentences, self.vocab, self.n, self.workers)], len(self.vocab))
+        self.stale = True
+        self.clearCache()
+
+    def refresh(self):
+        '''
+        Smooth the merged counts again after an update: the discounts depend on the count-of-counts of each order,
+        and the continuation counts of a k-gram on all the (k+1)-grams ending with it, so the whole model is recomputed (vectorized).
+        '''
+        if self.stale:
+            self.discounts, self.logprobs, self.logbows = self.smooth(self.model)
+            self.samplers = {}
+            self.stale = False
+
+    def smooth(self, trie):
+        '''
+        Smooth the counts of an NGramTrie.
+        Return the discounts (D1, D2, D3+) of each order, the log probability of every node of the trie and the log backoff weight of every context node.
+        '''
+        start = self.vocab.word2idx[START]
+        adjusted = self.adjustedCounts(trie, start)
+        discounts = [self.calculateDiscounts(counts) for counts in adjusted]
+
+        logprobs, logbows = [], []
+        probs = None
+        for level in range(self.n):
+            counts = adjusted[level]
+            discounted = counts - np.array((0,) + discounts[level])[np.minimum(counts, 3)]
+            if level == 0:
+                parents = np.zeros(len(counts), dtype=np.int64)
+            else:
+                parents = trie.parents(level, np.arange(len(counts)))
+            n_contexts = 1 if level == 0 else len(adjusted[level - 1])
+            totals = np.bincount(parents, weights=counts, minlength=n_contexts)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                gamma = np.bincount(parents, weights=counts - discounted, minlength=n_contexts) / totals
+                if level == 0:
+                    # Interpolate the unigrams with the uniform distribution over the words that can follow a context
+                    probs = discounted / totals[0] + gamma[0] / (len(counts) - np.count_nonzero(trie.keys[0] == start))
+                    probs[trie.keys[0] == start] = 0
+                else:
+                    suffixes = trie.find(trie.grams(level)[:, 1:])
+                    probs = discounted / totals[parents] + gamma[parents] * probs[suffixes]
+                    logbows.append(np.where(totals > 0, np.log(gamma), 0))
+                logprobs.append(np.log(probs))
+
+        return discounts, logprobs, logbows
+
+    def adjustedCounts(self, trie, start):
+        '''
+        Return the counts used at every level of the trie: the raw counts for the highest order and for the k-grams starting with '<s>',
+        the continuation counts N1+(. w1 ... wk) otherwise.
+        '''
+        adjusted = []
+        for level in range(trie.order - 1):
+            suffixes = trie.find(trie.grams(level + 1)[:, 1:])
+            counts = np.bincount(suffixes, minlength=len(trie.keys[level]))
+            at_start = trie.grams(level)[:, 0] == start
+            counts[at_start] = trie.counts[level][at_start]
+            adjusted.append(counts)
+        adjusted.append(trie.counts[-1].astype(np.int64))
+        adjusted[0][trie.keys[0] == start] = 0 # '<s>' is never predicted
+        return adjusted
+
+    def calculateDiscounts(self, counts):
+        '''
+        Calculate the modified Kneser-Ney discounts (D1, D2, D3+) from the count-of-counts n1..n4 of one order.
+        Fall back to the absolute discount n1 / (n1 + 2 * n2) for all three when one of n1..n4 is zero.
+        '''
+        n1, n2, n3, n4 = (int(np.count_nonzero(counts == i)) for i in range(1, 5))
+        Y = n1 / (n1 + 2 * n2) if n1 + n2 else 0.0
+        if not (n1 and n2 and n3 and n4):
+            return (Y, Y, Y)
+        D1 = 1 - 2 * Y * n2 / n1
+        D2 = 2 - 3 * Y * n3 / n2
+        D3 = 3 - 4 * Y * n4 / n3
+        return (min(max(D1, 0), 1), min(max(D2, 0), 2), min(max(D3, 0), 3))
+
+    def getState(self):
+        arrays, params = super().getState()
+        params['discounts'] = self.discounts
+        return arrays, params
+
+    def setState(self, arrays, params):
+        super().setState(arrays, params)
+        self.discounts = [tuple(discounts) for discounts in params['discounts']]
+        self.stale = False
+
+"""Sanity check: for every context of the sanity corpora, the smoothed probabilities of all the words that can follow it must sum to 1."""
+
+def sanityCheckKneserNey(n=3):
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    model = KneserNeyModel(train_corpus, n=n)
+    words = model.model.keys[0]
+
+    print("--- TEST: KneserNeyModel probabilities sum to 1 ---")
+    contexts = {tuple(sen[max(0, i - n + 1):i]) for sen in train_corpus + test_corpus for i in range(1, len(sen))}
+    failed = 0
+    for context in contexts:
+        context_ids = model.vocab.encode(context)
+        grams = np.column_stack([np.tile(context_ids, (len(words), 1)), words])
+        total = np.exp(model.getGramLogProbabilities(grams)).sum()
+        if abs(total - 1) > 1e-9: failed += 1
+    if not failed:
+        print("Test KneserNeyModel(...) passed on", len(contexts), "contexts!")
+    else:
+        print("Test KneserNeyModel(...) failed on", failed, "contexts...")
+
+    print("\n--- TEST: perplexities ---")
+    print("Train perp.:", model.getCorpusPerplexity(train_corpus), '\tTest perp.:', model.getCorpusPerplexity(test_corpus))
+    print("Generated:", model.generateSentence())
+
+if __name__=='__main__':
+    sanityCheckKneserNey()
+
+if __name__=='__main__':
+    runModel('kneser-ney')
+
+"""### Saving and loading models
+
+`save(path)` writes a trained model to one binary file: an 8-byte magic string, the format version and the length of a JSON header, the JSON header (model class, parameters, and the dtype, shape and offset of every array), then the arrays themselves, each aligned on 64 bytes. The vocabulary is stored as two arrays too: the concatenated UTF-8 bytes of the tokens and their offsets.
+
+`load(path)` memory-maps the file and views the arrays in place, so loading costs one read of the header and the rebuilding of the vocabulary dictionary, whatever the size of the model. The mapping is read-only and shared, so processes serving the same model file share its pages.
+
+`saveARPA` and `loadARPA` exchange models with other toolkits through the ARPA text format (log10 probabilities, backoff weights). A model read from an ARPA file is a `BackoffModel`.
+"""
+
+import struct
+
+MODEL_MAGIC = b'NGRAMLM\0'
+MODEL_VERSION = 1
+MODEL_ALIGNMENT = 64
+
+def saveModel(path, name, vocab, arrays, params):
+    '''
+    Write a model to a binary file: the name of its class, its vocabulary, its named arrays and its JSON serializable parameters.
+    '''
+    chars, offsets = vocab.to_arrays()
+    slots = vocab.word2idx.slots if isinstance(vocab, MappedVocabulary) else hashTokens(chars, offsets)
+    arrays = dict(arrays, **{'vocab.chars': chars, 'vocab.offsets': offsets, 'vocab.slots': slots})
+    arrays = {key: np.ascontiguousarray(array) for key, array in arrays.items()}
+
+    def header(entries):
+        return json.dumps({'class': name, 'params': params, 'arrays': entries}).encode('utf-8')
+
+    # The offsets depend on the length of the header, which depends on the offsets: reserve the room of the largest offsets first
+    entries = [[key, array.dtype.str, list(array.shape), 0] for key, array in arrays.items()]
+    position = len(MODEL_MAGIC) + 8 + len(header(entries)) + 20 * len(entries)
+    for entry, array in zip(entries, arrays.values()):
+        position += -position % MODEL_ALIGNMENT
+        entry[3] = position
+        position += array.nbytes
+    data = header(entries)
+
+    with open(path, 'wb') as f:
+        f.write(MODEL_MAGIC)
+        f.write(struct.pack('<II', MODEL_VERSION, len(data)))
+        f.write(data)
+        for (key, dtype, shape, offset), array in zip(entries, arrays.values()):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(array.data)
+
+def loadModel(path, mmap=True, shared=False):
+    '''
+    Read a model written by saveModel.
+    Return the name of its class, its Vocabulary, its named arrays (memory-mapped read-only with 'mmap') and its parameters.
+    With 'shared' the vocabulary is a MappedVocabulary viewing the arrays of the file instead of a Vocabulary.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise ValueError("%s is not a saved language model" % path)
+        version, length = struct.unpack('<II', f.read(8))
+        if version != MODEL_VERSION:
+            raise ValueError("%s has version %d of the model format, only version %d is supported" % (path, version, MODEL_VERSION))
+        header = json.loads(f.read(length).decode('utf-8'))
+
+    data = np.memmap(path, dtype=np.uint8, mode='r') if mmap else np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for key, dtype, shape, offset in header['arrays']:
+        dtype = np.dtype(dtype)
+        arrays[key] = data[offset:offset + dtype.itemsize * int(np.prod(shape))].view(dtype).reshape(shape)
+    chars, offsets, slots = arrays.pop('vocab.chars'), arrays.pop('vocab.offsets'), arrays.pop('vocab.slots', None)
+    vocab = MappedVocabulary(chars, offsets, slots) if shared else Vocabulary.from_arrays(chars, offsets)
+    return header['class'], vocab, arrays, header['params']
+
+def modelClass(name):
+    '''
+    Return the subclass of LanguageModel with the given name.
+    '''
+    classes = [LanguageModel]
+    while classes:
+        model_class = classes.pop()
+        if model_class.__name__ == name:
+            return model_class
+        classes.extend(model_class.__subclasses__())
+    raise ValueError("Unknown model class " + name)
+
+ARPA_LOG_ZERO = -99 # log10 probability standing for a probability of 0 in ARPA files
+
+def saveARPA(model, path):
+    '''
+    Write a model in the ARPA format, from the backoff form returned by its getBackoffLevels method.
+    The natural logs are converted to log10, log 0 being written as -99; backoff weights of log 1 are omitted.
+    '''
+    levels = model.getBackoffLevels()
+    words = model.vocab.idx2word
+    def log10(values):
+        values = np.asarray(values, dtype=np.float64) / math.log(10)
+        return np.where(np.isneginf(values), ARPA_LOG_ZERO, values).tolist()
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n\\data\\\n')
+        for k, (grams, log_probs, log_bows) in enumerate(levels):
+            f.write('ngram %d=%d\n' % (k + 1, len(grams)))
+        for k, (grams, log_probs, log_bows) in enumerate(levels):
+            f.write('\n\\%d-grams:\n' % (k + 1))
+            bows = repeat(0) if log_bows is None else log10(log_bows)
+            for gram, prob, bow in zip(grams.tolist(), log10(log_probs), bows):
+                line = '%r\t%s' % (prob, ' '.join([words[i] for i in gram]))
+                f.write(line + '\t%r\n' % bow if bow else line + '\n')
+        f.write('\n\\end\\\n')
+
+def loadARPA(path):
+    '''
+    Read a model from an ARPA file, log10 probabilities of -99 or less being read as log 0.
+    Return it as a BackoffModel over a new Vocabulary of the words of its unigrams.
+    '''
+    levels = []
+    with open(path, encoding='utf-8') as f:
+        k = 0
+        for line in f:
+            line = line.strip()
+            if line.startswith('\\') and line.endswith('-grams:'):
+                k = int(line[1:-len('-grams:')])
+                levels.append(([], [], []))
+            elif line == '\\end\\':
+                break
+            elif k and line:
+                fields = line.split()
+                levels[-1][0].append(fields[1:k + 1])
+                levels[-1][1].append(float(fields[0]))
+                levels[-1][2].append(float(fields[k + 1]) if len(fields) > k + 1 else 0.0)
+    if not levels:
+        raise ValueError("%s has no n-grams" % path)
+
+    def ln(values):
+        values = np.array(values, dtype=np.float64)
+        return np.where(values <= ARPA_LOG_ZERO, -np.inf, values * math.log(10))
+
+    vocab = Vocabulary(words[0] for words in levels[0][0])
+    backoff_levels = []
+    for level, (grams, log_probs, log_bows) in enumerate(levels):
+        ids = vocab.encode([word for words in grams for word in words]).reshape(len(grams), level + 1)
+        if (ids < 0).any():
+            raise ValueError("%s has %d-grams with words missing from its unigrams" % (path, level + 1))
+        backoff_levels.append((ids, ln(log_probs), ln(log_bows)))
+    return backoffModel(backoff_levels, vocab)
+
+"""Sanity check: every model must give the same log probabilities after a round trip through save and load (with the 'dict' and 'csr' backends) and through an ARPA file."""
+
+def sanityCheckSaveLoad(directory='.'):
+    import os
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    sentences = [sentence, *train_corpus, *test_corpus]
+    models = {'unigram': UnigramModel(train_corpus), 'smoothed-unigram': SmoothedUnigramModel(train_corpus),
+              'bigram': BigramModel(train_corpus), 'bigram (csr)': BigramModel(train_corpus, backend='csr'),
+              'smoothed-bigram': SmoothedBigramModelAD(train_corpus), 'smoothed-bigram (csr)': SmoothedBigramModelAD(train_corpus, backend='csr'),
+              'trigram': NGramModel(train_corpus, n=3), 'kneser-ney': KneserNeyModel(train_corpus, n=3)}
+    path = os.path.join(directory, 'sanity_model.bin')
+    arpa_path = os.path.join(directory, 'sanity_model.arpa')
+
+    print("--- TEST: save / load / ARPA round trips ---")
+    failed = 0
+    for name, model in models.items():
+        model.save(path)
+        loaded = LanguageModel.load(path)
+        model.saveARPA(arpa_path)
+        imported = loadARPA(arpa_path)
+        correct = [round(model.getSentenceLogProbability(sen), 10) for sen in sentences]
+        probs = [round(loaded.getSentenceLogProbability(sen), 10) for sen in sentences]
+        arpa_probs = [round(imported.getSentenceLogProbability(sen), 8) for sen in sentences]
+        passed = type(loaded) is type(model) and probs == correct and arpa_probs == [round(prob, 8) for prob in correct]
+        print(name, '\t', 'PASSED' if passed else 'FAILED')
+        if not passed: failed += 1
+    os.remove(path)
+    os.remove(arpa_path)
+    print("Test save / load passed!" if not failed else "Test save / load failed on %d models..." % failed)
+
+if __name__=='__main__':
+    sanityCheckSaveLoad()
+
+"""### Pruning bigram models
+
+`prune(min_count, threshold)` shrinks a bigram model in two stages. Count cutoffs drop the bigrams seen fewer than `min_count` times. Relative entropy pruning (Stolcke, 1998) then drops every bigram whose removal alone would raise the perplexity by a relative amount under `threshold`. The smoothed model gives the mass of the dropped bigrams back to its unigram distribution through the backoff weights; the unsmoothed model renormalizes what is left. The pruned model is a `BackoffModel`, so it can be saved, memory-mapped and exported to ARPA like the others.
+"""
+
+def pruningReport(model, pruned, testCorpus, directory='.'):
+    '''
+    Compare a model with its pruned version: number of bigrams, size of the saved file, loading time and perplexity of the test corpus.
+    Return a dictionary of the measurements, with the relative increase of the perplexity.
+    '''
+    import os
+    report = {}
+    for name, current in (('before', model), ('after', pruned)):
+        path = os.path.join(directory, 'pruning_%s.bin' % name)
+        current.save(path)
+        start_time = time.time()
+        LanguageModel.load(path).getCorpusPerplexity(testCorpus[:1])
+        report[name] = {'bigrams': len(current.getBackoffLevels()[1][0]), 'file bytes': os.path.getsize(path),
+                        'load seconds': time.time() - start_time, 'perplexity': current.getCorpusPerplexity(testCorpus)}
+        os.remove(path)
+    report['perplexity increase'] = report['after']['perplexity'] / report['before']['perplexity'] - 1
+    return report
+
+"""Sanity check: pruning nothing must not change the model, and the distributions of a pruned smoothed model must still sum to 1."""
+
+def sanityCheckPruning():
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    sentences = [sentence, *train_corpus, *test_corpus]
+
+    print("--- TEST: prune(min_count=1, threshold=0) keeps the model ---")
+    failed = 0
+    for model in (BigramModel(train_corpus), SmoothedBigramModelAD(train_corpus, backend='csr')):
+        pruned = model.prune()
+        for sen in sentences:
+            correct_prob, prob = round(model.getSentenceLogProbability(sen), 10), round(pruned.getSentenceLogProbability(sen), 10)
+            if prob != correct_prob: failed += 1
+    print("Test prune() passed!" if not failed else "Test prune() failed on %d sentences..." % failed)
+
+    print("\n--- TEST: pruned distributions sum to 1 ---")
+    model = SmoothedBigramModelAD(train_corpus, backend='csr')
+    pruned = model.prune(min_count=2, threshold=1e-3)
+    words = np.flatnonzero(model.unigram)
+    failed = 0
+    for context in np.flatnonzero(model.model_count):
+        total = np.exp(pruned.getGramLogProbabilities(np.column_stack([np.full(len(words), context), words]))).sum()
+        if abs(total - 1) > 1e-9: failed += 1
+    print("Test prune(...) passed!" if not failed else "Test prune(...) failed on %d contexts..." % failed)
+    print("Bigrams:", len(model.counts.data), '->', len(pruned.model.keys[1]),
+          '\tTest perp.:', model.getCorpusPerplexity(test_corpus), '->', pruned.getCorpusPerplexity(test_corpus))
 
 if __name__=='__main__':
-    sanityCheckFullDataset('smoothed-unigram')
+    sanityCheckPruning()
 
 if __name__=='__main__':
-    runModel('smoothed-unigram')
+    model = SmoothedBigramModelAD(train_dataset, backend='csr')
+    for min_count, threshold in ((2, 0.0), (1, 1e-6), (1, 1e-5)):
+        print('min_count', min_count, 'threshold', threshold, pruningReport(model, model.prune(min_count, threshold), test_dataset))
 
-"""### Bigram Model"""
+"""### Quantized models
 
-class BigramModel(LanguageModel):
-    def __init__(self, trainCorpus):
+`quantize(bits, method)` converts any model to a `QuantizedModel`: the backoff form of the model where every log probability and log backoff weight is an 8 or 16-bit code into a codebook of the order it belongs to. The codebooks are built either by binning (equal-population bins of the sorted values, each represented by its mean) or by k-means (Lloyd iterations started from the bins; in one dimension the nearest centroid is found with a binary search over the midpoints between centroids). Code 0 stands for log 0. Decoding is a single gather `codebook[codes]`, so the scoring code of `BackoffModel` runs unchanged on top of it.
+"""
+
+class QuantizedArray(object):
+    def __init__(self, codes, codebook):
         '''
-        Initialize and train the model
-        Input 'trainCorpus' is a list of sentence where each sentence is a list of words.
+        Array of float64 values stored as integer codes into a codebook.
+        Indexing it decodes the selected values with one vectorized lookup.
         '''
-        self.corpus = trainCorpus
-        self.model = self.train()
+        self.codes = codes
+        self.codebook = codebook
 
-    def train(self):
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.codebook[self.codes[index]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.codebook[self.codes].astype(dtype or np.float64, copy=False)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebook.nbytes
+
+def quantizeValues(values, bits=8, method='binning', iterations=20):
+    '''
+    Quantize an array of log values to codes of 'bits' bits (8 or 16), -infinity getting code 0.
+    'method' is 'binning' (equal-population bins represented by their mean) or 'kmeans' (Lloyd iterations started from the bins).
+    Return the QuantizedArray of the values.
+    '''
+    assert bits in {8, 16}, 'bits must be 8 or 16'
+    assert method in {'binning', 'kmeans'}, "method must be 'binning' or 'kmeans'"
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    n_codes = 2 ** bits - 1
+    distinct = np.unique(values[finite])
+    if len(distinct) <= n_codes:
+        centroids = distinct # Lossless
+    else:
+        # Equal-population bins of the sorted values, represented by their mean
+        ordered = np.sort(values[finite])
+        starts = np.unique(np.linspace(0, len(ordered), n_codes + 1).astype(np.int64)[:-1])
+        centroids = np.add.reduceat(ordered, starts) / np.diff(np.append(starts, len(ordered)))
+        for i in range(iterations if method == 'kmeans' else 0):
+            clusters = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, ordered)
+            sizes = np.bincount(clusters, minlength=len(centroids))
+            sums = np.bincount(clusters, weights=ordered, minlength=len(centroids))
+            updated = np.where(sizes > 0, sums / np.maximum(sizes, 1), centroids)
+            if np.allclose(updated, centroids, rtol=0, atol=1e-12):
+                break
+            centroids = np.sort(updated)
+    codebook = np.concatenate(([-np.inf], centroids))
+    codes = np.zeros(len(values), dtype=np.uint8 if bits == 8 else np.uint16)
+    codes[finite] = 1 + np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values[finite])
+    return QuantizedArray(codes, codebook)
+
+class QuantizedModel(BackoffModel):
+    '''
+    BackoffModel whose log probabilities and log backoff weights are QuantizedArrays (see quantizeModel).
+    '''
+
+    def getState(self):
+        arrays = {}
+        for level in range(self.n):
+            arrays['keys.%d' % level] = self.model.keys[level]
+            if self.model.counts is not None:
+                arrays['counts.%d' % level] = self.model.counts[level]
+            arrays['logprobs.%d.codes' % level], arrays['logprobs.%d.codebook' % level] = self.logprobs[level].codes, self.logprobs[level].codebook
+        for level in range(self.n - 1):
+            arrays['logbows.%d.codes' % level], arrays['logbows.%d.codebook' % level] = self.logbows[level].codes, self.logbows[level].codebook
+        return arrays, {'n': self.n, 'size': self.model.size}
+
+    def setState(self, arrays, params):
+        self.n = params['n']
+        keys = [arrays['keys.%d' % level] for level in range(self.n)]
+        counts = [arrays['counts.%d' % level] for level in range(self.n)] if 'counts.0' in arrays else None
+        self.model = NGramTrie(keys, counts, params['size'])
+        self.logprobs = [QuantizedArray(arrays['logprobs.%d.codes' % level], arrays['logprobs.%d.codebook' % level]) for level in range(self.n)]
+        self.logbows = [QuantizedArray(arrays['logbows.%d.codes' % level], arrays['logbows.%d.codebook' % level]) for level in range(self.n - 1)]
+        self.samplers = {}
+
+def quantizeModel(model, bits=8, method='binning'):
+    '''
+    Convert a model to a QuantizedModel over the same vocabulary, from its backoff form (see LanguageModel.getBackoffLevels).
+    Every order gets a codebook of its own for its log probabilities, and another one for its log backoff weights.
+    '''
+    exact = backoffModel(model.getBackoffLevels(), model.vocab)
+    logprobs = [quantizeValues(values, bits, method) for values in exact.logprobs]
+    logbows = [quantizeValues(values, bits, method) for values in exact.logbows]
+    return QuantizedModel(exact.model, logprobs, logbows, model.vocab)
+
+def quantizationReport(model, quantized, testCorpus, directory='.'):
+    '''
+    Compare a model with its quantized version: bytes of the stored log probabilities and backoff weights (float64 in the exact backoff form,
+    codes and codebooks once quantized), bytes of the whole tables, size of the saved file, perplexity of the test corpus and its relative drift.
+    '''
+    import os
+    exact = backoffModel(model.getBackoffLevels(), model.vocab)
+    report = {}
+    for name, current in (('exact', exact), ('quantized', quantized)):
+        path = os.path.join(directory, 'quantization_%s.bin' % name)
+        current.save(path)
+        value_bytes = sum(values.nbytes for values in current.logprobs + current.logbows)
+        report[name] = {'value bytes': value_bytes, 'table bytes': value_bytes + current.model.nbytes, 'file bytes': os.path.getsize(path),
+                        'perplexity': current.getCorpusPerplexity(testCorpus)}
+        os.remove(path)
+    report['perplexity drift'] = report['quantized']['perplexity'] / report['exact']['perplexity'] - 1
+    return report
+
+"""Sanity check: a quantized model must stay close to the exact one and survive a round trip through save and load. The model is trained on a Zipf corpus (see `zipfCorpus`) with more distinct log probabilities than 8-bit codes, so that the 8-bit quantization is lossy."""
+
+def sanityCheckQuantization(directory='.'):
+    import os
+    train_corpus = zipfCorpus(5000, seed=0)
+    words = np.unique(train_corpus.ids)
+    test_corpus = zipfCorpus(2000, len(train_corpus.tokens) - 2, seed=1, words=words[words >= 2] - 2)
+    model = KneserNeyModel(train_corpus, n=3)
+    print("--- TEST: quantized Kneser-Ney model ---")
+    passed = True
+    for bits in (8, 16):
+        for method in ('binning', 'kmeans'):
+            quantized = model.quantize(bits, method)
+            report = quantizationReport(model, quantized, test_corpus, directory)
+            print(bits, 'bits', method, '\tTest perp.:', report['exact']['perplexity'], '->', report['quantized']['perplexity'],
+                  '\tValue bytes:', report['exact']['value bytes'], '->', report['quantized']['value bytes'],
+                  '\tFile bytes:', report['exact']['file bytes'], '->', report['quantized']['file bytes'])
+            passed &= abs(report['perplexity drift']) < 1e-2
+            passed &= report['quantized']['value bytes'] < report['exact']['value bytes']
+            if bits == 8:
+                passed &= report['perplexity drift'] != 0 and 4 * report['quantized']['value bytes'] < report['exact']['value bytes']
+    path = os.path.join(directory, 'sanity_quantized.bin')
+    quantized.save(path)
+    try:
+        loaded = LanguageModel.load(path)
+        passed &= loaded.getCorpusPerplexity(test_corpus) == quantized.getCorpusPerplexity(test_corpus)
+    finally:
+        os.remove(path)
+    print("Test quantize(...) passed!" if passed else "Test quantize(...) failed...")
+
+if __name__=='__main__':
+    sanityCheckQuantization()
+
+if __name__=='__main__':
+    model = KneserNeyModel(train_dataset, n=3)
+    for bits in (8, 16):
+        for method in ('binning', 'kmeans'):
+            print(bits, 'bits', method, quantizationReport(model, model.quantize(bits, method), test_dataset))
+
+"""### Caching scores
+
+`enableCache(size)` puts a least recently used `ScoreCache` in front of `getSentenceLogProbability`. It keeps whole sentences and prefixes alike: on a miss, the longest cached prefix of the sentence is reused and only the words after it are scored with `getSuffixLogProbabilities`, which for an n-gram model only looks up the n-grams ending after the prefix. The prefixes are found by the rolling hashes of their tokens, so a miss costs time linear in the length of the sentence, and the prefixes of a scored sentence whose lengths are powers of two are cached with it. `update` clears the cache, and a model loaded from a file starts without one.
+"""
+
+def sanityCheckCache(size=20):
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    sentences = [sentence, *train_corpus, *test_corpus]
+    prefixes = [sen[:i] for sen in sentences for i in range(2, len(sen))]
+    models = {'unigram': UnigramModel(train_corpus), 'bigram': BigramModel(train_corpus), 'bigram (csr)': BigramModel(train_corpus, backend='csr'),
+              'smoothed-bigram': SmoothedBigramModelAD(train_corpus), 'trigram': NGramModel(train_corpus, n=3), 'kneser-ney': KneserNeyModel(train_corpus, n=3)}
+
+    print("--- TEST: cached scores ---")
+    failed = 0
+    for name, model in models.items():
+        correct = [round(model.getSentenceLogProbability(sen), 10) for sen in prefixes + sentences]
+        model.enableCache(size)
+        probs = [round(model.getSentenceLogProbability(sen), 10) for sen in prefixes + sentences] # Every prefix extends the previous one
+        probs_again = [round(model.getSentenceLogProbability(sen), 10) for sen in sentences] # Still cached
+        stats = model.cache.stats()
+        passed = probs == correct and probs_again == correct[len(prefixes):] and len(model.cache) == size
+        passed &= stats['hits'] == len(sentences) and stats['prefix_hits'] > 0 and stats['evictions'] > 0
+        model.enableCache(size)
+        model.getSentenceLogProbability(sentence) # Also caches its prefixes of 2, 4, 8... words
+        cached = {key: round(log_prob, 10) for key, log_prob in model.cache.entries.items()}
+        passed &= sorted(map(len, cached)) == [2 ** i for i in range(1, (len(sentence) - 1).bit_length())] + [len(sentence)]
+        model.disableCache()
+        passed &= all(round(model.getSentenceLogProbability(list(key)), 10) == log_prob for key, log_prob in cached.items())
+        model.enableCache(size)
+        model.getSentenceLogProbability(sentence)
+        passed &= round(model.getSentenceLogProbability(sentence[:-1]), 10) == correct[prefixes.index(sentence[:-1])] and model.cache.prefix_hits == 1
+        model.update(train_corpus[:1])
+        passed &= len(model.cache) == 0 and round(model.getSentenceLogProbability(sentences[1]), 10) != correct[len(prefixes) + 1]
+        print(name, '\t', stats, '\t', 'PASSED' if passed else 'FAILED')
+        if not passed: failed += 1
+    print("Test cache passed!" if not failed else "Test cache failed on %d models..." % failed)
+
+if __name__=='__main__':
+    sanityCheckCache()
+
+if __name__=='__main__':
+    model = KneserNeyModel(train_dataset, n=3)
+    queries = [sen[:i] for sen in test_dataset[:2000] for i in range(2, len(sen) + 1)] # Growing prefixes, as typed
+    for size in (None, 100000):
+        if size is not None:
+            model.enableCache(size)
+        start = time.time()
+        for sen in queries + queries:
+            model.getSentenceLogProbability(sen)
+        print('cache size', size, '\t%.2fs' % (time.time() - start), model.cache.stats() if model.cache else '')
+
+"""### Serving models
+
+`serveModel` serves a model over a local TCP or Unix socket. Requests and responses are lines of JSON:
+
+* `{"id": 1, "op": "score", "sentences": [["<s>", "the", ..., "</s>"], ...]}` returns the log probability of every sentence,
+* `{"id": 2, "op": "perplexity", "sentences": [...]}` the perplexity of the sentences,
+* `{"id": 3, "op": "generate", "n": 5, "seed": 0}` n generated sentences,
+* `{"id": 4, "op": "stats"}` the number of batches and sentences scored so far.
+
+Every response is `{"id": ..., "result": ...}` or `{"id": ..., "error": "..."}`. A connection may send several requests without waiting: the responses come back as soon as they are ready, matched by their id.
+
+The scoring requests of all the connections are gathered into micro-batches by a `ScoringBatcher`: a batch is scored with one `scoreSentences` call as soon as it holds `max_batch` sentences, or `max_delay` seconds after its first request arrived. Under concurrency, many small calls are replaced by a few vectorized ones. `loadTest` is a load generator measuring the throughput and the latency percentiles of a running server, and `benchmarkServer` compares batch sizes on localhost (`max_batch=1` scores every request on its own).
+"""
+
+class ScoringBatcher(object):
+    def __init__(self, model, max_batch=64, max_delay=0.002):
         '''
-        Train the model by calculating the conditional probability of each word in then corpus.
-        Return a dictionary of dictionaries stroing the conditional frequency of each word on the previous word
+        Gather the scoring requests of concurrent tasks into batches scored with one model.scoreSentences call.
+        A batch is scored once it holds 'max_batch' sentences, or 'max_delay' seconds after its first request arrived.
+        The model runs in one background thread, so that the event loop keeps reading requests while a batch is scored.
         '''
-        model = {}
-        for sentence in self.corpus:
-            for i in range(len(sentence) - 1):
-                word = sentence[i]
-                word_next = sentence[i + 1]
-                if word in model:
-                    if word_next in model[word]:
-                        model[word][word_next] += 1
-                    else:
-                        model[word][word_next] = 1
-                else:
-                    model[word] = {word_next : 1}
+        self.model = model
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        from concurrent.futures import ThreadPoolExecutor
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+        self.task = None
+        self.batches = 0
+        self.sentences = 0
 
-        # Calculate the conditional porbabilities
-        for word in model:
-            total_next_words = sum(model[word].values())
-            for word_next in model[word]:
-                model[word][word_next] /= total_next_words
+    def start(self):
+        '''
+        Start scoring the batches in a task of the running event loop.
+        '''
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
 
-        return model
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
 
-    def generateSentence(self):
+    async def score(self, sentences):
         '''
-        Generate sentences based on the bigram model, the sentence starts with the token '<s>' and ends with the token '</s>'
-        The output sentence is a list of tokens from the model beginning with '<s>' and ends with '</s>'
+        Return the float64 array of the log probabilities of the sentences, once their batch is scored.
         '''
-        import random
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put_nowait((sentences, future, loop.time()))
+        return await future
 
-        # Initialize the sentence
-        sentence = []
-        sentence.append('<s>')
+    async def call(self, fn, *args):
+        '''
+        Run fn(*args) in the thread of the model, between two batches.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
 
-        curr_word = sentence[0] # Set the current word to be the '<s>'
+    async def run(self):
+        loop = asyncio.get_running_loop()
         while True:
-            next_word = random.choices(list(self.model[curr_word].keys()), weights=self.model[curr_word].values())[0]
-            sentence.append(next_word)
-            curr_word = next_word
-            if curr_word == '</s>':
-                break # Break if the token generated is '</s>'
-
-        return sentence
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = batch[0][2] + self.max_delay
+            while size < self.max_batch:
+                try:
+                    if loop.time() >= deadline:
+                        item = self.queue.get_nowait() # Only take the requests already waiting
+                    else:
+                        item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                batch.append(item)
+                size += len(item[0])
+            results = await self.call(self.score_batch, [sentences for sentences, future, arrival in batch])
+            for (sentences, future, arrival), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
 
-    def getSentenceLogProbability(self, sentence):
+    def score_batch(self, requests):
         '''
-        Calculate the conditonal log probability of the sentence
-        Input is the list of tokens
-        Output is the float number that is the log probability of the sentence
+        Score the sentences of all the requests with one scoreSentences call, and split the log probabilities by request.
+        If the call fails (e.g. on an unknown token), the requests are scored one by one so that only the faulty ones get the exception.
         '''
-        import math
-        log_prob_sum = 0
-        for i in range(len(sentence) - 1):
-            curr_word = sentence[i]
-            next_word = sentence[i+1]
-            if curr_word in self.model and next_word in self.model[curr_word]:
-                log_prob_sum += math.log(self.model[curr_word][next_word])
-            else:
-                log_prob_sum = -math.inf # If there's no such conditional distribution in the model, return -infinity
+        self.batches += 1
+        self.sentences += sum(map(len, requests))
+        try:
+            log_probs = self.model.scoreSentences([sentence for sentences in requests for sentence in sentences])
+        except Exception:
+            results = []
+            for sentences in requests:
+                try:
+                    results.append(self.model.scoreSentences(sentences))
+                except Exception as error:
+                    results.append(error)
+            return results
+        return np.split(log_probs, np.cumsum([len(sentences) for sentences in requests[:-1]]))
+
+    def stats(self):
+        return {'batches': self.batches, 'sentences': self.sentences, 'sentences/batch': self.sentences / max(self.batches, 1)}
+
+async def answerRequest(batcher, line, writer):
+    '''
+    Answer one JSON request line of a connection (see serveModel).
+    '''
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id, op = request.get('id'), request.get('op')
+        if op == 'score':
+            result = (await batcher.score(request['sentences'])).tolist()
+        elif op == 'perplexity':
+            sentences = request['sentences']
+            log_probs = await batcher.score(sentences)
+            result = math.exp(-log_probs.sum() / (sum(map(len, sentences)) - len(sentences))) # '<s>' isn't counted
+        elif op == 'generate':
+            result = await batcher.call(batcher.model.generateSentences, request.get('n', 1), request.get('seed'))
+        elif op == 'stats':
+            result = batcher.stats()
+        else:
+            raise ValueError("Unknown op: %r" % op)
+        response = {'id': request_id, 'result': result}
+    except Exception as error:
+        response = {'id': request_id, 'error': '%s: %s' % (type(error).__name__, error)}
+    writer.write((json.dumps(response) + '\n').encode('utf-8'))
+    await writer.drain()
+
+async def handleConnection(batcher, reader, writer):
+    '''
+    Answer the requests of a connection concurrently, until the client closes it.
+    '''
+    tasks = set()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
                 break
+            task = asyncio.ensure_future(answerRequest(batcher, line, writer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    except (ConnectionError, asyncio.CancelledError): # Client gone or server shutting down
+        pass
+    finally:
+        writer.close()
 
-        return log_prob_sum
+async def startServer(model, host='127.0.0.1', port=8000, path=None, max_batch=64, max_delay=0.002):
+    '''
+    Start serving the model in the running event loop, on a Unix socket if 'path' is given and on host:port otherwise (port 0 picks a free port).
+    Return the asyncio server and its ScoringBatcher.
+    '''
+    batcher = ScoringBatcher(model, max_batch, max_delay)
+    batcher.start()
+    handler = functools.partial(handleConnection, batcher)
+    if path is not None:
+        server = await asyncio.start_unix_server(handler, path)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    return server, batcher
 
-    def getCorpusPerplexity(self, testCorpus):
-        '''
-        Calculate the perplexcity of the testcorpus based on the model from the current corpus
-        Input testCorpus is the list of sentences
-        Output is a float number representing the perplexity of the input corpus
-        '''
-        import math
-        log_prob_sum = 0
-        word_count = 0
-        for sentence in testCorpus:
-            log_prob_sum += self.getSentenceLogProbability(sentence)
-            word_count += len(sentence) - 1 # Don't take '<s>' as the word count
+async def stopServer(server, batcher):
+    '''
+    Stop a server started with startServer.
+    '''
+    batcher.close()
+    server.close()
+    await server.wait_closed()
 
-        return math.exp(-log_prob_sum / word_count)
+def serveModel(model, host='127.0.0.1', port=8000, path=None, max_batch=64, max_delay=0.002):
+    '''
+    Serve the model until interrupted (see startServer). 'model' is a LanguageModel,
+    or the path of a saved model, loaded with shared=True so that the processes serving the same file share its tables.
+    '''
+    if isinstance(model, str):
+        model = LanguageModel.load(model, shared=True)
+
+    async def serve():
+        server, batcher = await startServer(model, host, port, path, max_batch, max_delay)
+        try:
+            await server.serve_forever()
+        finally:
+            await stopServer(server, batcher)
+
+    asyncio.run(serve())
+
+async def loadTest(sentences, host='127.0.0.1', port=8000, path=None, concurrency=16, requests=2000, batch=1):
+    '''
+    Send 'requests' scoring requests of 'batch' sentences each, taken in turn from 'sentences', over 'concurrency' connections
+    that each wait for a response before sending their next request.
+    Return the throughput and the latency percentiles of the requests in milliseconds.
+    '''
+    latencies = []
+    request_ids = iter(range(requests)) # Shared by the connections
+
+    async def client():
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        for i in request_ids:
+            chunk = [sentences[(i * batch + j) % len(sentences)] for j in range(batch)]
+            start = time.perf_counter()
+            writer.write((json.dumps({'id': i, 'op': 'score', 'sentences': chunk}) + '\n').encode('utf-8'))
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if 'error' in response:
+                raise ValueError(response['error'])
+        writer.close()
+        await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for c in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]).tolist()
+    return {'requests/s': requests / elapsed, 'sentences/s': requests * batch / elapsed, 'p50 ms': p50, 'p95 ms': p95, 'p99 ms': p99}
+
+def benchmarkServer(model, sentences, max_batches=(1, 64), concurrencies=(1, 16, 64), requests=2000, max_delay=0.002):
+    '''
+    Serve the model on a free localhost port from a background thread for every max_batch,
+    and run loadTest against it at every concurrency. Return the list of the results.
+    '''
+    import threading
+    results = []
+    for max_batch in max_batches:
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        server, batcher = asyncio.run_coroutine_threadsafe(startServer(model, port=0, max_batch=max_batch, max_delay=max_delay), loop).result()
+        port = server.sockets[0].getsockname()[1]
+        for concurrency in concurrencies:
+            result = asyncio.run(loadTest(sentences, port=port, concurrency=concurrency, requests=requests))
+            results.append({'max_batch': max_batch, 'concurrency': concurrency, **result})
+        asyncio.run_coroutine_threadsafe(stopServer(server, batcher), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return results
+
+def sanityCheckServer():
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    model = KneserNeyModel(train_corpus, n=3)
+    sentences = [sentence, *train_corpus, *test_corpus]
+    correct = [round(model.getSentenceLogProbability(sen), 10) for sen in sentences]
+
+    async def check():
+        server, batcher = await startServer(model, port=0, max_batch=4, max_delay=0.01)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        requests = [{'id': i, 'op': 'score', 'sentences': [sen]} for i, sen in enumerate(sentences)] # Sent at once, so they are batched
+        requests += [{'id': 'ppl', 'op': 'perplexity', 'sentences': test_corpus}, {'id': 'gen', 'op': 'generate', 'n': 2, 'seed': 0},
+                     {'id': 'unk', 'op': 'score', 'sentences': [[START, 'Tokyo', END]]}]
+        writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode('utf-8'))
+        responses = {}
+        for request in requests:
+            response = json.loads(await reader.readline())
+            responses[response['id']] = response
+        requests = [{'id': 'stats', 'op': 'stats'}]
+        writer.write((json.dumps(requests[0]) + '\n').encode('utf-8'))
+        responses['stats'] = json.loads(await reader.readline())
+        writer.close()
+        await writer.wait_closed()
+        await stopServer(server, batcher)
+        return responses
+
+    print("--- TEST: scoring server ---")
+    responses = asyncio.run(check())
+    probs = [round(responses[i]['result'][0], 10) for i in range(len(sentences))]
+    stats = responses['stats']['result']
+    passed = probs == correct and round(responses['ppl']['result'], 8) == round(model.getCorpusPerplexity(test_corpus), 8)
+    passed &= responses['gen']['result'] == model.generateSentences(2, seed=0) and 'error' in responses['unk']
+    passed &= stats['batches'] < stats['sentences']
+    print("Batches:", stats, '\t', 'PASSED' if passed else 'FAILED')
+    print("Test server passed!" if passed else "Test server failed...")
 
 if __name__=='__main__':
-    sanityCheck('bigram')
+    sanityCheckServer()
 
 if __name__=='__main__':
-    sanityCheckFullDataset('bigram')
+    model = KneserNeyModel(train_dataset, n=3)
+    for result in benchmarkServer(model, test_dataset):
+        print(result)
+
+"""### Sharing models between processes
+
+Worker processes that each train or load a model with the 'dict' backend hold a private copy of every dictionary, and even a forked copy doesn't stay shared: updating the reference counts of the Python objects writes to their pages. `LanguageModel.load(path, shared=True)` keeps the tables of the model in the memory-mapped file instead:
+
+* the bigram models use the 'csr' backend on the arrays of the file, including the sorted keys of their binary searches,
+* the vocabulary is a `MappedVocabulary`: tokens are decoded from the bytes of the file, and looked up in a hash table saved with the model (see `hashTokens`).
+
+The pages of the file are shared by all the processes mapping it, so N workers cost about the RAM of one model plus a few Python objects each. Putting the file on a tmpfs such as `/dev/shm` keeps it in memory. `sharingReport` measures the private memory of the workers on Linux.
+"""
+
+def privateMemory():
+    '''
+    Return the anonymous (private) resident memory of the process in MB, from /proc/self/status (Linux only).
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) / 1024
+
+def sharingWorker(path, shared, sentences):
+    before = privateMemory()
+    model = LanguageModel.load(path, shared=shared)
+    perplexity = model.getCorpusPerplexity(sentences)
+    return privateMemory() - before, perplexity
+
+def sharingReport(path, sentences, workers=4):
+    '''
+    Load the model saved at 'path' in 'workers' new processes, with and without shared=True, and compute the perplexity of the sentences in each.
+    Return the private memory each worker needed to load and query the model in MB, and the perplexities.
+    '''
+    import multiprocessing
+    report = {}
+    for shared in (False, True):
+        with multiprocessing.Pool(workers, maxtasksperchild=1) as pool:
+            results = pool.starmap(sharingWorker, [(path, shared, sentences)] * workers)
+        report['shared' if shared else 'private'] = {'MB per worker': [round(memory, 1) for memory, perplexity in results],
+                                                     'perplexity': results[0][1]}
+    return report
+
+def sanityCheckSharing(directory='.'):
+    import os
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    sentences = [sentence, *train_corpus, *test_corpus]
+    models = {'unigram': UnigramModel(train_corpus), 'bigram': BigramModel(train_corpus), 'smoothed-bigram': SmoothedBigramModelAD(train_corpus),
+              'kneser-ney': KneserNeyModel(train_corpus, n=3)}
+    path = os.path.join(directory, 'sanity_model.bin')
+
+    print("--- TEST: shared loading ---")
+    failed = 0
+    for name, model in models.items():
+        model.save(path)
+        shared = LanguageModel.load(path, shared=True)
+        correct = [round(model.getSentenceLogProbability(sen), 10) for sen in sentences]
+        probs = [round(shared.getSentenceLogProbability(sen), 10) for sen in sentences]
+        vocab = shared.vocab
+        passed = probs == correct and isinstance(vocab, MappedVocabulary) and list(vocab.idx2word) == model.vocab.idx2word
+        passed &= all(vocab.word2idx[word] == i for i, word in enumerate(model.vocab.idx2word)) and 'Tokyo' not in vocab
+        passed &= shared.generateSentences(3, seed=0) == LanguageModel.load(path).generateSentences(3, seed=0)
+        print(name, '\t', 'PASSED' if passed else 'FAILED')
+        if not passed: failed += 1
+    os.remove(path)
+    print("Test shared loading passed!" if not failed else "Test shared loading failed on %d models..." % failed)
 
 if __name__=='__main__':
-    runModel('bigram')
+    sanityCheckSharing()
 
-"""### Smoothed Bigram Model"""
+if __name__=='__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory: # Removed with the model file afterwards
+        path = os.path.join(directory, 'bigram.bin')
+        BigramModel(train_dataset).save(path)
+        print(sharingReport(path, test_dataset))
 
-class SmoothedBigramModelAD(BigramModel):
-    def __init__(self, trainCorpus):
+"""### Cached corpora
+
+`getDataset(directory)` reads the raw WikiText-2 files from a local directory instead of downloading them, through `loadCorpus`: the first run preprocesses each file into `.cache/<key>/` (a vocabulary file, the int32 ids of the tokens and the offsets of the sentences), the key being the SHA-256 of the file and of the preprocessing options, including the vocabulary used to replace the unknown words of the validation file. The next runs memory-map the arrays and return an `EncodedCorpus`, which the models count and score from its ids without decoding the sentences.
+"""
+
+def sanityCheckCorpusCache(directory='.'):
+    import shutil
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    path = os.path.join(directory, 'sanity_corpus.raw')
+    cache_dir = os.path.join(directory, 'sanity_cache')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(' '.join(sen[1:-1]) + '\n' for sen in train_corpus + test_corpus)
+    correct, vocab = preprocess(readParagraphs(path))
+
+    print("--- TEST: cached corpus ---")
+    corpus, cached_vocab = loadCorpus(path, cache_dir=cache_dir)
+    again, _ = loadCorpus(path, cache_dir=cache_dir) # Read from the cache
+    restricted, _ = loadCorpus(path, set(train_corpus[0]), cache_dir) # Another key
+    passed = list(corpus) == correct and list(again) == correct and cached_vocab == vocab and len(os.listdir(cache_dir)) == 2
+    passed &= list(restricted) == preprocess(readParagraphs(path), set(train_corpus[0]))[0] and list(corpus[1:3]) == correct[1:3]
+    model, cached_model = KneserNeyModel(correct, n=3), KneserNeyModel(corpus, n=3)
+    passed &= cached_model.vocab.idx2word == model.vocab.idx2word and cached_model.getCorpusPerplexity(corpus) == model.getCorpusPerplexity(correct)
+    os.remove(path)
+    shutil.rmtree(cache_dir)
+    print("Test cached corpus passed!" if passed else "Test cached corpus failed...")
+
+if __name__=='__main__':
+    sanityCheckCorpusCache()
+
+"""### Importing the models
+
+Importing this file does no work beyond defining its classes and functions: the datasets are only downloaded by `getDataset()`, and numpy, json and asyncio are imported with `lazyImport`, so they are only executed by the first code path that uses them (torchtext, hashlib, tempfile, threading and concurrent.futures are imported inside the functions that need them). `importReport` measures the cold start of the import in fresh interpreters.
+"""
+
+def importReport(module='n_gram_language_model', runs=5, heavy=('numpy', 'asyncio', 'json', 'torchtext', 'torch')):
+    '''
+    Import the module in 'runs' new interpreters, from the directory of this file, and return the best import time in milliseconds
+    with the list of the heavy modules actually executed by the import (it should be empty).
+    Python writes the bytecode of the module on the first run, unless PYTHONDONTWRITEBYTECODE is set: the next runs only load it.
+    '''
+    import subprocess
+    code = ("import sys, time, types; start = time.perf_counter(); import %s; elapsed = time.perf_counter() - start; "
+            "print(elapsed * 1000, *[name for name in %r if type(sys.modules.get(name)) is types.ModuleType])" % (module, list(heavy)))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for i in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True, check=True).stdout.split()
+        results.append((float(output[0]), output[1:]))
+    milliseconds, loaded = min(results)
+    return {'import ms': round(milliseconds, 1), 'heavy modules executed': loaded}
+
+if __name__=='__main__':
+    print(importReport())
+
+"""### Instrumentation
+
+`enableInstrumentation()` wraps `train`, `getSentenceLogProbability`, `getCorpusPerplexity`, `scoreSentences`, `generateSentence` and `generateSentences` on one model to count their calls, time them and count the tokens they process; for `SmoothedBigramModelAD` it also counts the bigrams scored from the model and those backing off to the unigram model. `getMetrics()` returns the statistics as a dictionary, `getMetrics('prometheus')` in the Prometheus text format, and `startProfile(method)` / `stopProfile()` run cProfile on the calls of a single method. The wrappers bind the arguments to the signature of the method, so corpora passed by name are counted too, and read a corpus given as a generator into a list before the call, so that it is still there to be counted. The tokens of an `EncodedCorpus` are counted from its offsets. The wrappers are set on the instance, never on the class, so the models that don't enable it pay nothing.
+"""
+
+def sanityCheckInstrumentation():
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    models = {'unigram': UnigramModel(train_corpus), 'bigram': BigramModel(train_corpus),
+              'smoothed-bigram': SmoothedBigramModelAD(train_corpus), 'smoothed-bigram (csr)': SmoothedBigramModelAD(train_corpus, backend='csr'),
+              'trigram': NGramModel(train_corpus, n=3), 'kneser-ney': KneserNeyModel(train_corpus, n=3)}
+    tokens = sum(len(sen) - 1 for sen in test_corpus)
+    words = sorted({word for sen in test_corpus for word in sen})
+    index = {word: i for i, word in enumerate(words)}
+    encoded = EncodedCorpus(words, np.array([index[word] for sen in test_corpus for word in sen], dtype=np.int32),
+                            np.cumsum([0] + [len(sen) for sen in test_corpus]))
+
+    print("--- TEST: instrumentation ---")
+    failed = 0
+    for name, model in models.items():
+        correct = model.getCorpusPerplexity(test_corpus), [model.getSentenceLogProbability(sen) for sen in test_corpus]
+        model.enableInstrumentation()
+        results = model.getCorpusPerplexity(test_corpus), [model.getSentenceLogProbability(sen) for sen in test_corpus]
+        model.generateSentences(3, seed=0)
+        metrics = model.getMetrics()
+        methods = metrics['methods']
+        passed = results == correct and methods['getCorpusPerplexity']['calls'] == 1 and methods['getCorpusPerplexity']['tokens'] == tokens
+        passed &= methods['getSentenceLogProbability']['calls'] >= len(test_corpus) and methods['generateSentence']['calls'] == 3
+        passed &= methods['generateSentences']['tokens'] == methods['generateSentence']['tokens'] and methods['train']['calls'] == 0
+        passed &= 0 < methods['getCorpusPerplexity']['p50_ms'] <= methods['getCorpusPerplexity']['p99_ms']
+
+        bigrams = metrics['bigrams']
+        if isinstance(model, SmoothedBigramModelAD):
+            # Only the outermost calls count: the test corpus is scored twice
+            pairs = [(curr, nxt) for sen in test_corpus for curr, nxt in zip(sen, sen[1:])]
+            seen = sum(curr in model.model and nxt in model.model[curr] for curr, nxt in pairs) if model.backend == 'dict' else None
+            passed &= bigrams['seen'] + bigrams['backoffs'] == 2 * len(pairs) and bigrams['backoffs'] > 0
+            passed &= seen is None or bigrams['seen'] == 2 * seen
+            model.update(train_corpus[:1])
+            model.getSentenceLogProbability(sentence)
+            passed &= model.getMetrics()['methods']['train']['calls'] == 1
+        else:
+            passed &= bigrams['seen'] == bigrams['backoffs'] == 0
+
+        text = model.getMetrics('prometheus')
+        passed &= '# TYPE languagemodel_latency_seconds summary' in text
+        passed &= 'languagemodel_calls_total{model="%s",method="getCorpusPerplexity"} 1.0' % type(model).__name__ in text
+
+        # Arguments passed by name, from a generator or as an EncodedCorpus are counted like the lists
+        perplexity, scores = model.getCorpusPerplexity(test_corpus), list(model.scoreSentences(test_corpus))
+        first = model.getMetrics()
+        passed &= model.getCorpusPerplexity(testCorpus=encoded) == perplexity
+        second = model.getMetrics()
+        passed &= list(model.scoreSentences(sen for sen in test_corpus)) == scores
+        third = model.getMetrics()
+        tokens_of = lambda metrics, method: metrics['methods'][method]['tokens']
+        passed &= tokens_of(second, 'getCorpusPerplexity') - tokens_of(first, 'getCorpusPerplexity') == tokens
+        passed &= tokens_of(third, 'scoreSentences') - tokens_of(second, 'scoreSentences') == tokens
+        lookups = lambda metrics: metrics['bigrams']['seen'] + metrics['bigrams']['backoffs']
+        passed &= lookups(third) - lookups(first) == (2 * tokens if isinstance(model, SmoothedBigramModelAD) else 0)
+
+        model.startProfile('getCorpusPerplexity')
+        model.getCorpusPerplexity(test_corpus)
+        model.generateSentence() # Not profiled
+        profiled = {function for (_, _, function) in model.stopProfile().stats}
+        passed &= 'getCorpusPerplexity' in profiled and 'generateSentence' not in profiled
+
+        model.disableInstrumentation()
+        passed &= model.instrumentation is None and not set(INSTRUMENTED_METHODS) & set(vars(model))
+        print(name, '\t', 'PASSED' if passed else 'FAILED')
+        if not passed: failed += 1
+    print("Test instrumentation passed!" if not failed else "Test instrumentation failed on %d models..." % failed)
+
+if __name__=='__main__':
+    sanityCheckInstrumentation()
+
+if __name__=='__main__':
+    model = SmoothedBigramModelAD(train_dataset)
+    model.enableInstrumentation()
+    model.getCorpusPerplexity(test_dataset)
+    for sen in test_dataset[:2000]:
+        model.getSentenceLogProbability(sen)
+    model.generateSentences(100, seed=0)
+    print(model.getMetrics('prometheus'))
+    model.startProfile('getCorpusPerplexity')
+    model.getCorpusPerplexity(test_dataset)
+    model.stopProfile().sort_stats('cumulative').print_stats(10)
+
+"""### Benchmarks
+
+`runBenchmarks` times every model class and backend offline, on synthetic corpora whose words follow a Zipf distribution (`zipfCorpus`), from 10k to 10M tokens: the training time and its peak memory (traced with tracemalloc in a second training run, so that the tracing doesn't slow the timed one), the scoring throughput of `scoreSentences`, the time of `getCorpusPerplexity` and the throughput of `generateSentences`. The test corpus has the same size for every training corpus and only contains words of the training corpus, with unseen bigrams. The results are written to a JSON file with the versions of Python and numpy, and `compareBenchmarks` lists the measures of a new file that regressed from an old one.
+"""
+
+import platform
+
+BENCHMARK_VERSION = 1
+BENCHMARK_MODELS = {'unigram': lambda corpus: UnigramModel(corpus),
+                    'smoothed-unigram': lambda corpus: SmoothedUnigramModel(corpus),
+                    'bigram': lambda corpus: BigramModel(corpus),
+                    'bigram (csr)': lambda corpus: BigramModel(corpus, backend='csr'),
+                    'smoothed-bigram': lambda corpus: SmoothedBigramModelAD(corpus),
+                    'smoothed-bigram (csr)': lambda corpus: SmoothedBigramModelAD(corpus, backend='csr'),
+                    'trigram': lambda corpus: NGramModel(corpus, n=3),
+                    'kneser-ney': lambda corpus: KneserNeyModel(corpus, n=3),
+                    'kneser-ney (8-bit)': lambda corpus: KneserNeyModel(corpus, n=3).quantize(8),
+                    'stupid-backoff': lambda corpus: StupidBackoffModel(corpus, n=3)}
+# Direction of each measure: 1 if higher is better, -1 if lower is better
+BENCHMARK_MEASURES = {'train_s': -1, 'peak_mb': -1, 'score_tokens_per_s': 1, 'perplexity_s': -1, 'generate_sentences_per_s': 1}
+
+def benchmarkModel(factory, train_corpus, test_corpus, sentences=1000, repeat=3, memory=True):
+    '''
+    Train a model with factory(train_corpus) and return its measures as a dictionary (the best of 'repeat' runs for the queries).
+    '''
+    import tracemalloc
+    def best(function):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    start = time.perf_counter()
+    model = factory(train_corpus)
+    results = {'train_s': time.perf_counter() - start, 'peak_mb': None}
+    if memory:
+        tracemalloc.start()
+        try:
+            factory(train_corpus)
+            results['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    test_tokens = sum(len(sentence) - 1 for sentence in test_corpus)
+    results['score_tokens_per_s'] = test_tokens / best(lambda: model.scoreSentences(test_corpus))
+    results['perplexity_s'] = best(lambda: model.getCorpusPerplexity(test_corpus))
+    results['generate_sentences_per_s'] = sentences / best(lambda: model.generateSentences(sentences, seed=0))
+    return results
+
+def runBenchmarks(sizes=(10**4, 10**5, 10**6, 10**7), models=tuple(BENCHMARK_MODELS), path='benchmarks.json',
+                  test_tokens=100000, seed=0, memory=True, label=None):
+    '''
+    Benchmark the models named in 'models' (keys of BENCHMARK_MODELS) on a synthetic training corpus of each size,
+    write the results to the JSON file 'path' (if not None) and return them.
+    'label' names the version of the code benchmarked, e.g. a commit.
+    '''
+    report = {'version': BENCHMARK_VERSION, 'label': label, 'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'config': {'sizes': list(sizes), 'test_tokens': test_tokens, 'seed': seed}, 'results': []}
+    for size in sizes:
+        train_corpus = zipfCorpus(size, seed=seed)
+        words = np.unique(train_corpus.ids)
+        test_corpus = zipfCorpus(test_tokens, len(train_corpus.tokens) - 2, seed=seed + 1, words=words[words >= 2] - 2)
+        for name in models:
+            results = benchmarkModel(BENCHMARK_MODELS[name], train_corpus, test_corpus, memory=memory)
+            report['results'].append({'model': name, 'tokens': int(len(train_corpus.ids)), 'vocab': int(len(words)), **results})
+            print(name, size, '\t', ', '.join('%s %.4g' % (key, value) for key, value in results.items() if value is not None))
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+def compareBenchmarks(old_path, new_path, tolerance=0.1):
+    '''
+    Return the measures of the benchmarks of 'new_path' worse than those of 'old_path' by more than the relative 'tolerance',
+    as a list of (model, tokens, measure, old value, new value).
+    '''
+    reports = []
+    for path in (old_path, new_path):
+        with open(path) as f:
+            reports.append({(result['model'], result['tokens']): result for result in json.load(f)['results']})
+    old, new = reports
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        for measure, direction in BENCHMARK_MEASURES.items():
+            before, after = old[key][measure], new[key][measure]
+            if before and after and (after - before) * direction < -tolerance * before:
+                regressions.append((*key, measure, before, after))
+    return regressions
+
+def sanityCheckBenchmarks(directory='.'):
+    path = os.path.join(directory, 'sanity_benchmarks.json')
+    print("--- TEST: benchmarks ---")
+    corpus = zipfCorpus(20000, seed=3)
+    passed = np.array_equal(corpus.ids, zipfCorpus(20000, seed=3).ids) and not np.array_equal(corpus.ids, zipfCorpus(20000, seed=4).ids)
+    passed &= 19000 < len(corpus.ids) <= 20000 and all(sen[0] == '<s>' and sen[-1] == '</s>' and len(sen) > 2 for sen in corpus)
+    test_corpus = zipfCorpus(5000, 1000, seed=4, words=[0, 1, 2])
+    passed &= set(test_corpus.ids.tolist()) == {0, 1, 2, 3, 4}
+
+    report = runBenchmarks(sizes=(5000,), models=('bigram', 'kneser-ney (8-bit)'), path=path, test_tokens=2000)
+    with open(path) as f:
+        passed &= json.load(f) == report and len(report['results']) == 2
+    passed &= all(result['train_s'] > 0 and result['peak_mb'] > 0 and result['score_tokens_per_s'] > 0 for result in report['results'])
+    passed &= compareBenchmarks(path, path) == []
+    faster = os.path.join(directory, 'sanity_benchmarks_faster.json')
+    with open(faster, 'w') as f:
+        json.dump(dict(report, results=[dict(result, train_s=result['train_s'] / 2) for result in report['results']]), f)
+    passed &= [regression[2] for regression in compareBenchmarks(faster, path)] == ['train_s', 'train_s'] and compareBenchmarks(path, faster) == []
+    os.remove(path)
+    os.remove(faster)
+    print("Test benchmarks passed!" if passed else "Test benchmarks failed...")
+
+if __name__=='__main__':
+    sanityCheckBenchmarks()
+
+if __name__=='__main__':
+    runBenchmarks()
+
+"""### Approximate n-gram models
+
+`StupidBackoffModel` keeps the counts of the k-grams (k = 2..n) in a count-min sketch instead of a trie: `depth` rows of `width` uint32 counters, each k-gram being added to one counter per row chosen by a hash of its ids, and its count estimated by the minimum of its counters, which never underestimates. A Bloom filter of `bloom_bits` bits records which k-grams were seen, so that the k-grams it rejects count 0 instead of the collisions of their counters. Only the unigram counts are exact, so the memory of the model is set by its parameters (plus one counter per word), not by the number of distinct n-grams.
+
+It scores with stupid backoff (Brants et al., 2007): $S(w|h) = c(hw) / c(h)$ if $hw$ was seen, $\alpha\, S(w|h')$ otherwise, down to $S(w) = c(w) / N$. The scores don't sum to 1, so its perplexity is only comparable between stupid backoff models; generation normalizes them over the vocabulary at each word. `getEstimationError` compares it with the same model computed from the exact counts of a corpus.
+"""
+
+GRAM_SEED = 0x9e3779b97f4a7c15
+
+def mix64(x):
+    '''
+    Return the SplitMix64 finalizer of a uint64 array, a bijection spreading every bit of the input over the bits of the output.
+    '''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+def hashGrams(grams):
+    '''
+    Return the uint64 hashes of the suffixes of the rows of an (m, k) id array, from the last word alone to the whole row, as a list of k arrays.
+    The hash of a k-gram only depends on its ids, whatever the row it is a suffix of.
+    '''
+    hashes = []
+    h = np.full(len(grams), GRAM_SEED, dtype=np.uint64)
+    for column in range(grams.shape[1] - 1, -1, -1):
+        h = mix64(h ^ grams[:, column].astype(np.uint64))
+        hashes.append(h)
+    return hashes
+
+class CountMinSketch(object):
+    def __init__(self, width, depth, table=None):
         '''
-        Initialize and train the model
-        Input 'trainCorpus' is a list of sentence where each sentence is a list of words.
+        Count-min sketch of 'depth' rows of 'width' uint32 counters, indexed by uint64 hashes.
         '''
-        self.corpus = trainCorpus
-        self.model, self.model_count, self.D, self.S = self.train()
-        self.unigram = self.get_unirgam()
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32) if table is None else table
+        self.seeds = mix64(np.arange(1, depth + 1, dtype=np.uint64))
 
-    def train(self):
+    def columns(self, hashes, row):
+        return (mix64(hashes ^ self.seeds[row]) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, hashes):
         '''
-        Train the model with the smoothed method
-        Output is a dictionary of dictionaries that represents the smoothed distribution of the model
+        Add 1 to the counters of every hash (a hash occurring several times is added as many times).
+        A table memory-mapped read-only by LanguageModel.load is copied first.
         '''
-        import math
-        unigram_model = self.get_unirgam()
+        if not self.table.flags.writeable:
+            self.table = self.table.copy()
+        for row in range(self.depth):
+            self.table[row] += np.bincount(self.columns(hashes, row), minlength=self.width).astype(np.uint32)
 
-        model = {}
-        model_count = {}
-        for sentence in self.corpus:
-            for i in range(len(sentence) - 1):
-                word = sentence[i]
-                word_next = sentence[i + 1]
-                if word in model:
-                    if word_next in model[word]:
-                        model[word][word_next] += 1
-                    else:
-                        model[word][word_next] = 1
-                else:
-                    model[word] = {word_next : 1}
+    def get(self, hashes):
+        '''
+        Return the estimated count of every hash, the minimum of its counters: at least its true count.
+        '''
+        counts = self.table[0][self.columns(hashes, 0)].astype(np.int64)
+        for row in range(1, self.depth):
+            np.minimum(counts, self.table[row][self.columns(hashes, row)], out=counts)
+        return counts
 
-        D, S = self.calculate_DS(model)
+class BloomFilter(object):
+    def __init__(self, size, hashes, bits=None):
+        '''
+        Bloom filter of 'size' bits (a multiple of 8), packed in a uint8 array, setting 'hashes' bits per item.
+        The bits of an item come from two hashes of its uint64 hash (h1 + i h2, Kirsch & Mitzenmacher, 2006).
+        '''
+        assert size % 8 == 0, "size must be a multiple of 8"
+        self.size = size
+        self.hashes = hashes
+        self.bits = np.zeros(size // 8, dtype=np.uint8) if bits is None else bits
 
-        # Calculate the conditional porbabilities
-        for word in model:
-            total_next_words = sum(model[word].values())
-            model_count[word] = total_next_words
-            for word_next in model[word]:
-                model[word][word_next] = max(model[word][word_next] - D, 0) / total_next_words + (D / total_next_words * S[word] * unigram_model[word_next])
+    def positions(self, hashes):
+        h1 = mix64(hashes ^ np.uint64(1))
+        h2 = mix64(hashes ^ np.uint64(2)) | np.uint64(1)
+        return [((h1 + np.uint64(i) * h2) % np.uint64(self.size)).astype(np.int64) for i in range(self.hashes)]
 
-        return model, model_count, D, S
+    def add(self, hashes):
+        '''
+        Set the bits of every hash in place in the packed array (copied first if memory-mapped read-only by LanguageModel.load).
+        '''
+        if not self.bits.flags.writeable:
+            self.bits = self.bits.copy()
+        for positions in self.positions(hashes):
+            np.bitwise_or.at(self.bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
 
-    def calculate_DS(self, model):
+    def contains(self, hashes):
         '''
-        Calculate the D and S of the model
+        Return a boolean array, True for every hash added (and for the false positives).
+        The bits are tested one at a time, only for the hashes that passed the previous ones.
         '''
-        n1 = 0
-        n2 = 0
-        S = {}
-        for word in model:
-            S[word] = len(model[word])
-            for next_word in model[word]:
-                if model[word][next_word] == 1:
-                    n1 += 1
-                elif model[word][next_word] == 2:
-                    n2 += 1
+        h1 = mix64(hashes ^ np.uint64(1))
+        h2 = mix64(hashes ^ np.uint64(2)) | np.uint64(1)
+        found = np.arange(len(hashes))
+        for i in range(self.hashes):
+            positions = ((h1[found] + np.uint64(i) * h2[found]) % np.uint64(self.size)).astype(np.int64)
+            found = found[(self.bits[positions >> 3] >> (positions & 7).astype(np.uint8)) & 1 == 1]
+        result = np.zeros(len(hashes), dtype=bool)
+        result[found] = True
+        return result
 
-        D = n1 / (n1 + 2 * n2)
+class StupidBackoffModel(LanguageModel):
+    def __init__(self, trainCorpus, n=3, width=2**21, depth=4, bloom_bits=2**26, bloom_hashes=5, alpha=0.4, vocab=None):
+        '''
+        Initialize and train an approximate n-gram model with stupid backoff scoring.
+        'width' and 'depth' set the size of the count-min sketch (width * depth * 4 bytes), 'bloom_bits' and 'bloom_hashes' those of the Bloom filter,
+        'alpha' is the backoff factor and 'vocab' an optional Vocabulary to share with other models.
+        '''
+        assert n >= 2, 'Use UnigramModel for n = 1'
+        self.corpus = trainCorpus
+        self.n = n
+        self.alpha = alpha
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.workers = None
+        self.sketch = CountMinSketch(width, depth)
+        self.bloom = BloomFilter(bloom_bits, bloom_hashes)
+        self.unigram_counts = np.zeros(0, dtype=np.int64)
+        self.train()
 
-        return D, S
+    def train(self):
+        '''
+        Count the corpus into the sketch, 100000 sentences at a time.
+        '''
+        corpus, size = self.corpus, 100000
+        if isinstance(corpus, (list, EncodedCorpus)):
+            chunks = (corpus[i:i + size] for i in range(0, len(corpus), size))
+        else:
+            chunks = iterChunks(corpus, size)
+        for chunk in chunks:
+            self.addCounts(chunk)
 
-    def get_unirgam(self):
+    def addCounts(self, sentences):
         '''
-        Get the smoothed unigram model for the corpus
+        Add the unigrams of the sentences to the exact counts and their k-grams (k = 2..n) to the sketch and the Bloom filter.
+        The k-grams ending at a position are the suffixes of the longest n-gram ending there, so they are all hashed at once.
         '''
-        model = {}
-        total_counts = 0
-        for sentence in self.corpus:
-            for word in sentence:
-                if word != '<s>':
-                    total_counts += 1
-                    if word in model:
-                        model[word] += 1
-                    else:
-                        model[word] = 1
+        ids, offsets = self.vocab.encode_corpus(sentences, grow=True)
+        counts = np.bincount(ids, minlength=len(self.vocab))
+        counts[:len(self.unigram_counts)] += self.unigram_counts
+        self.unigram_counts = counts
+        self.total = int(counts.sum() - counts[self.vocab.word2idx[START]]) if START in self.vocab else int(counts.sum())
+        self.candidates = None
+        for k, grams, positions in gramWindows(ids, offsets, self.n):
+            hashes = np.concatenate(hashGrams(grams)[1:])
+            self.sketch.add(hashes)
+            self.bloom.add(hashes)
 
-        number_tokens = len(model.keys())
+    def update(self, sentences):
+        self.addCounts(sentences if isinstance(sentences, (list, EncodedCorpus)) else list(sentences))
+        self.clearCache()
 
-        for word in model:
-            model[word] = (model[word] + 1) / (total_counts + number_tokens)
+    def getCounts(self, grams):
+        '''
+        Return the estimated counts of the rows of an (m, k) id array (k >= 2), 0 for the k-grams rejected by the Bloom filter.
+        '''
+        hashes = hashGrams(grams)[-1]
+        counts = np.zeros(len(grams), dtype=np.int64)
+        found = self.bloom.contains(hashes)
+        counts[found] = self.sketch.get(hashes[found])
+        return counts
 
-        return model
+    def getGramLogScores(self, grams, getCounts=None):
+        '''
+        Calculate the stupid backoff log score of the last word of the rows of an (m, k) id array given the words before it,
+        backing off from the k-gram down to the unigram. 'getCounts' replaces the estimated k-gram counts (see getEstimationError).
+        '''
+        getCounts = getCounts or self.getCounts
+        m, k = grams.shape
+        scores = np.empty(m)
+        pending = np.arange(m)
+        for j in range(k, 1, -1):
+            suffixes = grams[pending, k - j:]
+            counts = getCounts(suffixes)
+            contexts = self.unigram_counts[suffixes[:, 0]] if j == 2 else getCounts(suffixes[:, :-1])
+            hit = (counts > 0) & (contexts > 0)
+            scores[pending[hit]] = (k - j) * math.log(self.alpha) + np.log(np.minimum(counts[hit], contexts[hit]) / contexts[hit])
+            pending = pending[~hit]
+        scores[pending] = (k - 1) * math.log(self.alpha) + np.log(self.unigram_counts[grams[pending, -1]] / self.total)
+        return scores
+
+    def checkKnown(self, ids):
+        unknown = (ids < 0) | (ids >= len(self.unigram_counts))
+        if unknown.any() or not self.unigram_counts[ids].all():
+            raise ValueError("Sentence contains tokens that doesn't belong to the corpus")
+        return ids
+
+    def scoreSentences(self, sentences, getCounts=None):
+        '''
+        Calculate the log score of every sentence of the list, all their n-grams at once, one batch per n-gram length.
+        Return a float64 array.
+        '''
+        ids, offsets = self.vocab.encode_corpus(sentences)
+        return sumSegments(self.getTokenLogScores(ids, offsets, getCounts), offsets)
+
+    def getTokenLogScores(self, ids, offsets, getCounts=None):
+        '''
+        Calculate the log score of every word of an encoded corpus given the previous ones, 0 for the first word of each sentence.
+        '''
+        self.checkKnown(ids)
+        log_probs = np.zeros(len(ids))
+        for k, grams, positions in gramWindows(ids, offsets, self.n):
+            log_probs[positions] = self.getGramLogScores(grams, getCounts)
+        return log_probs
 
     def getSentenceLogProbability(self, sentence):
         '''
-        Calculate the conditonal log probability of the sentence
+        Calculate the stupid backoff log score of the sentence.
         Input is the list of tokens
-        Output is the float number that is the log probability of the sentence
+        Output is the float number that is the log score of the sentence
         '''
-        import math
-        D = self.D
-        S = self.S
-        unigram = self.unigram
-        log_prob_sum = 0
-        for i in range(len(sentence) - 1):
-            curr_word = sentence[i]
-            next_word = sentence[i+1]
-            total_next_words = self.model_count[curr_word]
-            if curr_word in self.model and next_word in self.model[curr_word]:
-                log_prob_sum += math.log(self.model[curr_word][next_word])
-            else:
-                log_prob_sum += math.log(D / total_next_words * S[curr_word] * unigram[next_word])
+        if self.cache is not None:
+            return self.cache.lookup(self, sentence)
+        return float(self.scoreSentences([sentence])[0])
+
+    def getSuffixLogProbability(self, sentence, start):
+        return self.getSuffixLogProbabilities(sentence, start, [len(sentence)])[0]
+
+    def getSuffixLogProbabilities(self, sentence, start, stops):
+        ids = self.checkKnown(self.vocab.encode(sentence[:stops[-1]]))
+        log_probs = np.zeros(len(ids) + 1)
+        for k, grams, positions in gramWindows(ids, np.array([0, len(ids)]), self.n):
+            new = positions >= start
+            if new.any():
+                log_probs[positions[new] + 1] = self.getGramLogScores(grams[new])
+        return np.cumsum(log_probs)[stops].tolist()
+
+    def getCorpusPerplexity(self, testCorpus):
+        '''
+        Calculate the perplexity of the test corpus from the stupid backoff scores, '<s>' not being counted as a word.
+        '''
+        ids, offsets = self.vocab.encode_corpus(testCorpus)
+        log_prob_sum = self.getTokenLogScores(ids, offsets).sum()
+        word_count = len(ids) - (len(offsets) - 1) # Don't take '<s>' as the word count
+        return math.exp(-log_prob_sum / word_count)
+
+    def generateSentence(self, rng=random):
+        '''
+        Generate a sentence, each word being drawn given the n-1 words before it with a probability proportional to its stupid backoff score.
+        'rng' is the random number generator to draw from (the random module by default).
+        The output sentence is a list of tokens beginning with '<s>' and ending with '</s>'
+        '''
+        if self.candidates is None:
+            candidates = np.flatnonzero(self.unigram_counts)
+            self.candidates = candidates[candidates != self.vocab.word2idx[START]]
+        candidates = self.candidates
+        end = self.vocab.word2idx[END]
+        ids = [self.vocab.word2idx[START]]
+        while ids[-1] != end:
+            context = np.array(ids[-(self.n - 1):])
+            grams = np.column_stack([np.broadcast_to(context, (len(candidates), len(context))), candidates])
+            scores = self.getGramLogScores(grams)
+            cumulative = np.cumsum(np.exp(scores - scores.max()))
+            i = int(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right'))
+            ids.append(int(candidates[min(i, len(candidates) - 1)]))
+        return self.vocab.decode(ids)
+
+    def getExactCounts(self, trie):
+        '''
+        Return the function returning the exact counts of k-grams (see getCounts) in an NGramTrie.
+        '''
+        def getCounts(grams):
+            nodes = trie.find(grams)
+            counts = np.zeros(len(grams), dtype=np.int64)
+            counts[nodes >= 0] = trie.counts[grams.shape[1] - 1][nodes[nodes >= 0]]
+            return counts
+        return getCounts
+
+    def getEstimationError(self, trainCorpus, testCorpus=None, samples=100000, seed=0):
+        '''
+        Compare the model with the same model computed from the exact counts of its training corpus 'trainCorpus' (an NGramTrie of it),
+        on the test corpus (the training corpus by default). Return a dictionary with
+        - the error of the estimated counts of the distinct k-grams of the corpus (mean, mean relative, max, share of exact counts),
+        - the false positive rate of the Bloom filter, and the share of nonzero counts, on 'samples' random k-grams never seen,
+        - the mean and max absolute error of the log score of every word of the test corpus, and both perplexities,
+        - the size of the sketch and the Bloom filter, and the number of distinct k-grams they hold.
+        '''
+        trie = countCorpus(trainCorpus, self.vocab, self.n)
+        getExactCounts = self.getExactCounts(trie)
+        errors, grams_count = [], 0
+        fp_rng = np.random.default_rng(seed)
+        false_positives, nonzero = [], []
+        for level in range(1, self.n):
+            grams = trie.grams(level)
+            grams_count += len(grams)
+            errors.append(self.getCounts(grams) - trie.counts[level])
+            random_grams = fp_rng.choice(np.flatnonzero(self.unigram_counts), size=(samples, level + 1))
+            random_grams = random_grams[trie.find(random_grams) < 0]
+            hashes = hashGrams(random_grams)[-1]
+            false_positives.append(self.bloom.contains(hashes))
+            nonzero.append(self.getCounts(random_grams) > 0)
+        errors = np.concatenate(errors)
+        exact = np.concatenate([trie.counts[level] for level in range(1, self.n)])
 
+        testCorpus = trainCorpus if testCorpus is None else testCorpus
+        ids, offsets = self.vocab.encode_corpus(testCorpus)
+        self.checkKnown(ids)
+        differences, words, log_probs = [], 0, np.zeros(2)
+        for k, grams, positions in gramWindows(ids, offsets, self.n):
+            scores, exact_scores = self.getGramLogScores(grams), self.getGramLogScores(grams, getExactCounts)
+            differences.append(np.abs(scores - exact_scores))
+            words += len(grams)
+            log_probs += scores.sum(), exact_scores.sum()
+        differences = np.concatenate(differences)
+        return {'count_mean_error': float(errors.mean()), 'count_mean_relative_error': float((errors / exact).mean()),
+                'count_max_error': int(errors.max()), 'count_exact_share': float((errors == 0).mean()),
+                'bloom_false_positive_rate': float(np.concatenate(false_positives).mean()),
+                'unseen_nonzero_share': float(np.concatenate(nonzero).mean()),
+                'score_mean_abs_error': float(differences.mean()), 'score_max_abs_error': float(differences.max()),
+                'perplexity': math.exp(-log_probs[0] / words), 'exact_perplexity': math.exp(-log_probs[1] / words),
+                'sketch_mb': self.sketch.table.nbytes / 2**20, 'bloom_mb': self.bloom.bits.nbytes / 2**20, 'distinct_grams': grams_count}
 
-        return log_prob_sum
+    def getState(self):
+        arrays = {'sketch': self.sketch.table, 'bloom': self.bloom.bits, 'unigram_counts': self.unigram_counts}
+        params = {'n': self.n, 'alpha': self.alpha, 'width': self.sketch.width, 'depth': self.sketch.depth,
+                  'bloom_bits': self.bloom.size, 'bloom_hashes': self.bloom.hashes}
+        return arrays, params
+
+    def setState(self, arrays, params):
+        self.n, self.alpha = params['n'], params['alpha']
+        self.sketch = CountMinSketch(params['width'], params['depth'], arrays['sketch'])
+        self.bloom = BloomFilter(params['bloom_bits'], params['bloom_hashes'], arrays['bloom'])
+        self.unigram_counts = arrays['unigram_counts']
+        counts = self.unigram_counts
+        self.total = int(counts.sum() - counts[self.vocab.word2idx[START]]) if START in self.vocab else int(counts.sum())
+        self.candidates = None
+
+def stupidBackoffScores(corpus, sentences, n=3, alpha=0.4):
+    '''
+    Reference implementation of stupid backoff with the exact counts of the corpus in dictionaries, word by word.
+    '''
+    counts = defaultdict(int)
+    for sen in corpus:
+        for i in range(len(sen)):
+            for k in range(1, min(i + 1, n) + 1):
+                counts[tuple(sen[i - k + 1:i + 1])] += 1
+    total = sum(count for gram, count in counts.items() if len(gram) == 1 and gram[0] != START)
+    scores = []
+    for sen in sentences:
+        score = 0.0
+        for i in range(1, len(sen)):
+            gram, penalty = tuple(sen[max(0, i - n + 1):i + 1]), 0.0
+            while len(gram) > 1 and not counts.get(gram):
+                gram, penalty = gram[1:], penalty + math.log(alpha)
+            score += penalty + math.log(counts[gram] / (counts[gram[:-1]] if len(gram) > 1 else total))
+        scores.append(score)
+    return scores
+
+def sanityCheckStupidBackoff(directory='.'):
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    sentences = [sentence, *train_corpus, *test_corpus]
+    correct = [round(score, 10) for score in stupidBackoffScores(train_corpus, sentences)]
+
+    print("--- TEST: stupid backoff ---")
+    model = StupidBackoffModel(train_corpus, width=2**16, bloom_bits=2**16)
+    probs = [round(model.getSentenceLogProbability(sen), 10) for sen in sentences]
+    passed = probs == correct and np.allclose(model.scoreSentences(sentences), correct)
+    passed &= all(round(model.getSuffixLogProbability(sen, 3) + stupidBackoffScores(train_corpus, [sen[:3]])[0], 8) == round(prob, 8)
+                  for sen, prob in zip(sentences, probs))
+    sen = model.generateSentence(random.Random(0))
+    passed &= sen[0] == START and sen[-1] == END and model.generateSentences(3, seed=1) == model.generateSentences(3, seed=1)
+    print("Exact counts:", 'PASSED' if passed else 'FAILED')
+
+    updated = StupidBackoffModel(train_corpus[:1], width=2**16, bloom_bits=2**16)
+    updated.update(train_corpus[1:])
+    path = os.path.join(directory, 'sanity_stupid_backoff.lm')
+    model.save(path)
+    loaded = LanguageModel.load(path)
+    same = [round(m.getSentenceLogProbability(sen), 10) for m in (updated, loaded) for sen in sentences] == correct * 2
+    os.remove(path)
+    updated.save(path)
+    reloaded = LanguageModel.load(path)
+    reloaded.update(train_corpus[1:])
+    updated.update(train_corpus[1:])
+    same &= [reloaded.getSentenceLogProbability(sen) for sen in sentences] == [updated.getSentenceLogProbability(sen) for sen in sentences]
+    del loaded, reloaded
+    os.remove(path)
+    print("Update, save / load:", 'PASSED' if same else 'FAILED')
+
+    tiny = StupidBackoffModel(train_corpus, width=8, depth=2, bloom_bits=64, bloom_hashes=2)
+    errors = tiny.getEstimationError(train_corpus, test_corpus, samples=1000)
+    exact = model.getEstimationError(train_corpus, test_corpus, samples=1000)
+    approximate = errors['count_mean_error'] > 0 and errors['score_mean_abs_error'] > 0 and errors['sketch_mb'] < exact['sketch_mb']
+    approximate &= exact['count_max_error'] == 0 and exact['score_max_abs_error'] < 1e-9 and exact['perplexity'] == exact['exact_perplexity']
+    print("Estimation error:", errors, '\t', 'PASSED' if approximate else 'FAILED')
+    print("Test stupid backoff passed!" if passed and same and approximate else "Test stupid backoff failed...")
 
 if __name__=='__main__':
-    sanityCheck('smoothed-bigram')
+    sanityCheckStupidBackoff()
 
 if __name__=='__main__':
-    sanityCheckFullDataset('smoothed-bigram')
+    model = StupidBackoffModel(train_dataset, n=3)
+    print(model.getEstimationError(train_dataset, test_dataset))
+    for width in (2**14, 2**16, 2**18):
+        print(width, StupidBackoffModel(train_dataset, n=3, width=width, bloom_bits=2**20).getEstimationError(train_dataset, test_dataset))
+
+"""### Parallel evaluation
+
+`evaluateCorpus(model, corpus, workers)` scores a test corpus in a pool of worker processes, each holding the model once: a model saved to a file is memory-mapped by every worker with `LanguageModel.load(path, shared=True)`, and a model in memory is inherited by forking (or saved to a temporary file where processes can't be forked). A raw text file is never read by the parent process: it is split into byte ranges ending at line ends, and each worker reads and preprocesses its ranges with `scanCorpus`, mapping the words unknown to the model to `<UNK>` as `getDataset` does for the validation set. A list of sentences or an `EncodedCorpus` is shared with the workers like in `countCorpus`, and any other iterable is sent to them in chunks.
+
+Each worker adds the log probabilities of its sentences exactly (the partials of Shewchuk's algorithm, as `math.fsum` does), so the total doesn't depend on the number of workers or on the chunks. The per-sentence scores are written to a file in the order of the corpus.
+"""
+
+import io
+
+eval_model = None # Model scored by the worker processes of evaluateCorpus
+eval_corpus = None # Corpus shared with them
+
+def initEvalWorker(model, path, corpus):
+    '''
+    Give a worker process the model, loaded from 'path' unless it is None, and the corpus.
+    '''
+    global eval_model, eval_corpus
+    eval_model = model if path is None else LanguageModel.load(path, shared=True)
+    eval_corpus = corpus
+
+def addExact(partials, values):
+    '''
+    Add floats to the list of partials of their exact sum (non-overlapping floats, Shewchuk 1997), and return it.
+    math.fsum(partials) is the correctly rounded sum of all the values added.
+    '''
+    for x in values:
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            high = x + y
+            low = y - (high - x)
+            if low:
+                partials[i] = low
+                i += 1
+            x = high
+        partials[i:] = [x]
+    return partials
+
+def scoreChunk(sentences, with_scores):
+    '''
+    Score a chunk of sentences with eval_model (run in a worker process).
+    Return the partials of the sum of the finite log probabilities, the number of sentences scoring -infinity, the numbers of sentences and words,
+    and the lines 'log probability<TAB>words' of the sentences if 'with_scores'.
+    '''
+    scores = eval_model.scoreSentences(sentences)
+    if isinstance(sentences, EncodedCorpus):
+        lengths = np.diff(sentences.offsets) - 1
+    else:
+        lengths = np.array([len(sentence) - 1 for sentence in sentences], dtype=np.int64)
+    finite = np.isfinite(scores)
+    lines = ''.join('%r\t%d\n' % pair for pair in zip(scores.tolist(), lengths.tolist())) if with_scores else None
+    return addExact([], scores[finite].tolist()), int((~finite).sum()), len(scores), int(lengths.sum()), lines
+
+def evaluateShard(bounds, with_scores):
+    lo, hi = bounds
+    return scoreChunk(eval_corpus[lo:hi], with_scores)
+
+def evaluateSpan(span, encoding, with_scores):
+    '''
+    Read, preprocess and score the paragraphs of the bytes [start, stop) of the raw text file eval_corpus.
+    '''
+    start, stop = span
+    with open(eval_corpus, 'rb') as f:
+        f.seek(start)
+        text = f.read(stop - start).decode(encoding)
+    sentences, _ = scanCorpus(io.StringIO(text, newline=None), eval_model.vocab)
+    return scoreChunk(sentences, with_scores)
+
+def fileSpans(path, chunk_bytes):
+    '''
+    Split a file into byte ranges of about 'chunk_bytes' bytes, each ending at a line end (or at the end of the file).
+    '''
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size) - 1)
+            f.readline()
+            bounds.append(f.tell())
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def evaluateCorpus(model, corpus, workers=None, scores_path=None, chunk_size=10000, chunk_bytes=1 << 22, encoding='utf-8'):
+    '''
+    Calculate the log probability and the perplexity of a test corpus with 'workers' processes (one per core by default).
+    'model' is a LanguageModel or the path of a model saved with save, 'corpus' the path of a raw text file (read in ranges of 'chunk_bytes' bytes),
+    a list of sentences, an EncodedCorpus or any iterable of sentences (scored in chunks of 'chunk_size' sentences).
+    With 'scores_path' the log probability and the number of words of every sentence are written to that file, one sentence per line.
+    Return a dictionary with the numbers of sentences and words, the exact total log probability (-infinity if a sentence scores -infinity)
+    and the perplexity, '<s>' not being counted as a word.
+    '''
+    import multiprocessing, tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count()
+    with_scores = scores_path is not None
+    if isinstance(corpus, str):
+        fn, tasks, args, shared = evaluateSpan, fileSpans(corpus, chunk_bytes), (encoding, with_scores), corpus
+    elif isinstance(corpus, (list, EncodedCorpus)):
+        bounds = list(range(0, len(corpus), chunk_size)) + [len(corpus)]
+        fn, tasks, args, shared = evaluateShard, zip(bounds[:-1], bounds[1:]), (with_scores,), corpus
+    else:
+        fn, tasks, args, shared = scoreChunk, iterChunks(corpus, chunk_size), (with_scores,), None
+
+    path, temporary = (model, None) if isinstance(model, str) else (None, None)
+    context = None
+    if workers > 1 and path is None:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            temporary = path = os.path.join(tempfile.mkdtemp(), 'model.bin')
+            model.save(path)
+
+    partials, infinite, sentences, words = [], 0, 0, 0
+    output = open(scores_path, 'w') if with_scores else None
+    executor = None
+    try:
+        if workers <= 1:
+            initEvalWorker(model, path, shared)
+            results = (fn(task, *args) for task in tasks)
+        else:
+            executor = ProcessPoolExecutor(workers, mp_context=context, initializer=initEvalWorker,
+                                           initargs=(None if path else model, path, shared))
+            results = mapBounded(executor, fn, tasks, 2 * workers, *args)
+        for chunk_partials, chunk_infinite, chunk_sentences, chunk_words, lines in results:
+            addExact(partials, chunk_partials)
+            infinite += chunk_infinite
+            sentences += chunk_sentences
+            words += chunk_words
+            if output is not None:
+                output.write(lines)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        initEvalWorker(None, None, None)
+        if output is not None:
+            output.close()
+        if temporary is not None:
+            os.remove(temporary)
+            os.rmdir(os.path.dirname(temporary))
+
+    log_prob = -math.inf if infinite else math.fsum(partials)
+    return {'sentences': sentences, 'words': words, 'log_prob': log_prob, 'perplexity': math.exp(-log_prob / words) if words else math.nan}
+
+def sanityCheckEvaluation(directory='.'):
+    train_corpus, test_corpus, sentence = getSanityCorpora()
+    path, model_path, scores_path = [os.path.join(directory, name) for name in ('sanity_eval.raw', 'sanity_eval.bin', 'sanity_eval.tsv')]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(' '.join(sen[1:-1]) + '\n' for sen in (train_corpus + test_corpus) * 20)
+    models = {'bigram': BigramModel(train_corpus), 'smoothed-bigram': SmoothedBigramModelAD(train_corpus), 'kneser-ney': KneserNeyModel(train_corpus, n=3)}
+
+    print("--- TEST: parallel evaluation ---")
+    failed = 0
+    for name, model in models.items():
+        sentences = preprocess(readParagraphs(path), model.vocab)[0]
+        scores = model.scoreSentences(sentences)
+        correct = {'sentences': len(sentences), 'words': sum(map(len, sentences)) - len(sentences), 'log_prob': math.fsum(scores)}
+        model.save(model_path)
+        runs = [evaluateCorpus(model, path, workers=1, chunk_bytes=100),
+                evaluateCorpus(model, path, workers=2, chunk_bytes=100, scores_path=scores_path),
+                evaluateCorpus(model_path, sentences, workers=2, chunk_size=7),
+                evaluateCorpus(model, iter(sentences), workers=3, chunk_size=5)]
+        passed = all({key: run[key] for key in correct} == correct for run in runs)
+        passed &= all(round(run['perplexity'], 8) == round(model.getCorpusPerplexity(sentences), 8) for run in runs if correct['log_prob'] > -math.inf)
+        with open(scores_path) as f:
+            lines = [line.split('\t') for line in f]
+        passed &= [float(score) for score, words in lines] == scores.tolist() and [int(words) for score, words in lines] == [len(sen) - 1 for sen in sentences]
+        print(name, '\t', runs[1], '\t', 'PASSED' if passed else 'FAILED')
+        if not passed: failed += 1
+    for name in (path, model_path, scores_path):
+        os.remove(name)
+    print("Test parallel evaluation passed!" if not failed else "Test parallel evaluation failed on %d models..." % failed)
+
+if __name__=='__main__':
+    sanityCheckEvaluation()
 
 if __name__=='__main__':
-    runModel('smoothed-bigram')
\ No newline at end of file
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory: # Removed with the model file afterwards
+        path = os.path.join(directory, 'kneser-ney.bin')
+        KneserNeyModel(train_dataset, n=3).save(path)
+        for workers in (1, 2, 4, 8):
+            start = time.time()
+            results = evaluateCorpus(path, test_dataset, workers=workers)
+            print(workers, 'workers\t%.2fs' % (time.time() - start), results)
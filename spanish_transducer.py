@@ -12,23 +12,34 @@ This files builds up a finite state trabsducer which transduces the infinitive f
 """
 
 import os
-import pandas as pd
-from tabulate import tabulate
-pdtabulate=lambda df:tabulate(df,headers='keys',tablefmt='psql', showindex=False)
+import sys
+
+def pdtabulate(df):
+    from tabulate import tabulate
+    return tabulate(df,headers='keys',tablefmt='psql', showindex=False)
 
 def readVerbFile(file):
+    import pandas as pd
     url='https://drive.google.com/u/0/uc?id=1U6vrmAKep0hDscPrCZ7yJKjFQmPQsfG2&export=download'
     df = pd.read_csv(url, header=None)
 
     return df.values.tolist()
 
-verbs = readVerbFile('verbsList.csv')
+verbs = None # List of [infinitive, preterite, class], downloaded by getVerbs() on first use
+
+def getVerbs():
+    global verbs
+    if verbs is None:
+        verbs = readVerbFile('verbsList.csv')
+    return verbs
 
 def testFST(print_examples = 'all'):
+    import pandas as pd
+    verbs = getVerbs()
     assert print_examples in {'all', 'incorrect', 'none'}, "print_examples must be 'all', 'incorrect', or 'none'"
     rule_classes = [('0a*', "0a* Regular -Car verb (stem end in consonant)", 'hablar      ==>  habló'), ('0b*', "0b* Regular -Var verb (stem end in vowel)", 'pasear      ==>  paseó'), ('0c*', "0c* Regular -er verb", 'comer       ==>  comió'), ('0d*', "0d* Regular -ir verb (excluding -guir, -quir)", 'abrir       ==>  abrió'), ('1a', "1a  Verbs in -ñer", 'tañer       ==>  tañó'), ('1b', "1b  Verbs in -ñir (excluding -eñir)", 'gañir       ==>  gañó'), ('2a', "2a  Verbs in -Ver", 'leer        ==>  leyó'), ('2b', "2b  Verbs in -Vir", 'construir   ==>  construyó'), ('2c*', "2c* Verbs in -guir (excluding -eguir)", 'distinguir  ==>  distinguió'), ('2d*', "2d* Verbs in -quir", 'delinquir   ==>  delinquió'), ('3a', "3a  Verbs in -eCir", 'pedir       ==>  pidió'), ('3b', "3b  Verbs in -eCCir", 'sentir      ==>  sintió'), ('3c', "3c  Verbs in -eCCCir", 'henchir     ==>  hinchió'), ('3d', "3d  Verbs in -eguir", 'seguir      ==>  siguió'), ('3e', "3e  Verbs in -eñir", 'heñir       ==>  hiñó')]
 
-    f = buildFST()
+    f = buildFST().compile()
     myParses = f.parseInputList([x[0] for x in verbs])
     scores, totals, examples = {}, {}, []
 
@@ -353,6 +364,86 @@ class FST:
         print(nParses, "/", totalStrings, "=", str(fraction*100)+'%', "of examples parsed")
         return res
 
+    def compile(self):
+        return CompiledFST(self)
+
+class CompiledFST:
+    # Integer transition table of an FST, which transduces in a single left-to-right pass.
+    # parseInput returns exactly what FST.parseInput returns: the outputs of all the accepting paths, concatenated in the order
+    # in which the recursive parser finds them. That order follows the iteration order of the sets of transitions of the FST,
+    # so the table keeps it, and only gives the same outputs as the FST it was compiled from.
+    def __init__(self, fst):
+        self.stateNames = list(fst.allStates)
+        stateIds = {name: i for i, name in enumerate(self.stateNames)}
+        self.charIds = dict()
+        for state in fst.allStates.values():
+            for inString in state.transitions:
+                if inString != "" and inString not in self.charIds:
+                    self.charIds[inString] = len(self.charIds)
+        self.start = stateIds[fst.initState.id]
+
+        # (output, next state) of the transitions of every state on every character, and of its epsilon transitions
+        delta = [[[] for c in self.charIds] for s in self.stateNames]
+        epsilons = [[] for s in self.stateNames]
+        for name, state in fst.allStates.items():
+            for inString, transSet in state.transitions.items():
+                for t in transSet:
+                    transition = (t.string_out, stateIds[t.state_out])
+                    if inString == "":
+                        epsilons[stateIds[name]].append(transition)
+                    else:
+                        delta[stateIds[name]][self.charIds[inString]].append(transition)
+
+        # The parser first follows the epsilon transitions of a state, then reads a character from it:
+        # closure[s] lists the (output, state) reached from s by epsilon transitions, in that order, ending with s itself
+        closure = [None] * len(self.stateNames)
+        self.final = [None] * len(self.stateNames)
+        def close(s, visiting):
+            if closure[s] is None:
+                if s in visiting:
+                    print("ERROR: compile: epsilon cycle through state", self.stateNames[s])
+                    sys.exit()
+                visiting.add(s)
+                closure[s] = [(out + rest, q) for out, t in epsilons[s] for rest, q in close(t, visiting)] + [("", s)]
+                # At the end of the input, a state accepts through its epsilon transitions, or with an empty output if it is final and has none
+                ends = [out + rest for out, t in epsilons[s] for rest in self.final[t]]
+                self.final[s] = ends if ends or not fst.allStates[self.stateNames[s]].isFinal else [""]
+                visiting.discard(s)
+            return closure[s]
+
+        # step[s][c] lists the (output, next state) of every path reading the character c from the state s
+        self.step = [[[(out + tout, to) for out, q in close(s, set()) for tout, to in delta[q][c]] for c in range(len(self.charIds))]
+                     for s in range(len(self.stateNames))]
+
+    def parseInput(self, inString):
+        inString = inString.rstrip('\n')
+        # The live paths after each character, as (state, index of the path it extends, output of the step)
+        paths = [(self.start, -1, "")]
+        steps = [paths]
+        for char in inString:
+            c = self.charIds.get(char)
+            if c is None:
+                return False, "FAIL"
+            paths = [(to, i, out) for i, (s, parent, previous) in enumerate(paths) for out, to in self.step[s][c]]
+            if paths == []:
+                return False, "FAIL"
+            steps.append(paths)
+
+        outputs = []
+        for i, (s, parent, out) in enumerate(paths):
+            if self.final[s]:
+                pieces, j = [], i
+                for k in range(len(steps) - 1, 0, -1):
+                    state, j, out = steps[k][j]
+                    pieces.append(out)
+                prefix = "".join(reversed(pieces))
+                outputs.extend(prefix + end for end in self.final[s])
+        if outputs == []:
+            return False, "FAIL"
+        return True, "".join(outputs)
+
+    parseInputList = FST.parseInputList
+
 """## Spanish transduction rule
 <li><b>Stems ending in <TT>ñ</TT>:</b> If the stem ends in <TT>ñ</TT>, the ending is <TT>-ó</TT> rather than <TT>-ió</TT>:
 <ul>
@@ -476,4 +567,27 @@ def buildFST():
     return f
 
 if __name__ == '__main__':
-    testFST(print_examples='incorrect')
\ No newline at end of file
+    testFST(print_examples='incorrect')
+
+"""## Compiled FST
+
+`FST.compile()` turns the FST into a `CompiledFST`: states and characters are numbered, and the epsilon closure of every state is folded into a table `step[state][char]` of the (output, next state) of every path reading the character. `parseInput` then reads the input once from left to right, keeping the list of live paths in the order of the recursive parser, so the outputs are the same, and its cost grows linearly with the length of the word.
+"""
+
+def testCompiledFST(words=None):
+    import time
+    words = [x[0] for x in getVerbs()] if words is None else words
+    f = buildFST()
+    compiled = f.compile()
+    start = time.time()
+    parses = [f.parseInput(word) for word in words]
+    parse_time = time.time() - start
+    start = time.time()
+    compiled_parses = [compiled.parseInput(word) for word in words]
+    compiled_time = time.time() - start
+    different = [word for word, parse, compiled_parse in zip(words, parses, compiled_parses) if parse != compiled_parse]
+    print("FST: %.3fs, compiled FST: %.3fs for %d words" % (parse_time, compiled_time, len(words)))
+    print("Test compiled FST passed!" if not different else "Test compiled FST failed on: " + ", ".join(different))
+
+if __name__ == '__main__':
+    testCompiledFST()
\ No newline at end of file
@@ -12,30 +12,51 @@ This file achieves word embedding based on the word2vec paradigm.
 ## Download \& Preprocess the Data
 """
 
-!pip install torchdata==0.5.1
-!pip install torchtext==0.14.0
-
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-if __name__=='__main__':
-    print('Using device:', DEVICE)
+# On Colab, install the dependencies of torchtext.datasets first (only needed to download WikiText-2 with getDataset()):
+# !pip install torchdata==0.5.1
+# !pip install torchtext==0.14.0
 
 # Constants (feel free to use these in your code, but do not change them)
 CBOW_START = "<s>"   # Start-of-sentence token
 CBOW_END = "</s>"    # End-of-sentence-token
 CBOW_UNK = "<UNK>"   # Unknown word token
 
-import torchtext
+import importlib.util
 import random
 import sys
 
-def cbow_preprocess(data, vocab=None, do_lowercase=True):
-    final_data = []
+def lazyImport(name):
+    '''
+    Return the module 'name', only executed on the first access to one of its attributes (see importlib.util.LazyLoader),
+    so that importing this file doesn't pay for the heavy dependencies until they are used.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named %r" % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def iter_cbow_preprocess(data, vocab=None, do_lowercase=True, counts=None):
+    '''
+    Streaming version of cbow_preprocess: read the paragraphs of 'data' lazily and yield every (lowercased) sentence,
+    surrounded by the start and end tokens, as soon as it is complete.
+    If 'counts' is a dictionary, the counts of the tokens of the yielded sentences are added to it in the same pass.
+    '''
     lowercase = "abcdefghijklmnopqrstuvwxyz"
+    def finish(sen):
+        # Make words lowercase for this assignment
+        sen = [CBOW_START] + [x.lower() if do_lowercase and x != CBOW_UNK else x for x in sen] + [CBOW_END]
+        if counts is not None:
+            for word in sen:
+                counts[word] = counts.get(word, 0) + 1
+        return sen
+
     for paragraph in data:
         paragraph = [x if x != '<unk>' else CBOW_UNK for x in paragraph.split()]
         if vocab is not None:
@@ -46,7 +67,7 @@ def cbow_preprocess(data, vocab=None, do_lowercase=True):
         for word in paragraph:
             if prev_quot:
                 if word[0] not in lowercase:
-                    final_data.append(sen)
+                    yield finish(sen)
                     sen = []
                     prev_punct, prev_quot = False, False
             if prev_punct:
@@ -54,26 +75,101 @@ def cbow_preprocess(data, vocab=None, do_lowercase=True):
                     prev_punct, prev_quot = False, True
                 else:
                     if word[0] not in lowercase:
-                        final_data.append(sen)
+                        yield finish(sen)
                         sen = []
                         prev_punct, prev_quot = False, False
             if word in {'.', '?', '!'}: prev_punct = True
-            sen += [word]
+            sen.append(word)
         if sen[-1] not in {'.', '?', '!', '"'}: continue # Prevent a lot of short sentences
-        final_data.append(sen)
-    vocab_was_none = vocab is None
+        yield finish(sen)
+
+def cbow_preprocess(data, vocab=None, do_lowercase=True):
+    counts = {} if vocab is None else None
+    final_data = list(iter_cbow_preprocess(data, vocab, do_lowercase, counts))
     if vocab is None:
-        vocab = {}
-    for i in range(len(final_data)):
-        # Make words lowercase for this assignment
-        final_data[i] = [x.lower() if do_lowercase and x != CBOW_UNK else x for x in final_data[i]]
-        final_data[i] = [CBOW_START] + final_data[i] + [CBOW_END]
-        if vocab_was_none:
-            for word in final_data[i]:
-                vocab[word] = vocab.get(word, 0) + 1
+        vocab = counts
     return final_data, vocab
 
-def getDataset():
+import os
+
+np = lazyImport('numpy')
+
+CBOW_CACHE_VERSION = 1
+
+def read_paragraphs(path, encoding='utf-8'):
+    '''
+    Lazily yield the paragraphs (lines) of a raw text file, such as the wiki.train.raw file of WikiText.
+    '''
+    with open(path, encoding=encoding) as f:
+        yield from f
+
+def cbow_corpus_key(path, vocab=None, do_lowercase=True, encoding='utf-8'):
+    '''
+    Return the cache key of the preprocessed corpus of a text file: the SHA-256 of its contents and of the preprocessing options.
+    '''
+    import hashlib, json
+    options = {'version': CBOW_CACHE_VERSION, 'do_lowercase': do_lowercase, 'encoding': encoding,
+               'vocab': None if vocab is None else hashlib.sha256('\n'.join(sorted(vocab)).encode('utf-8')).hexdigest()}
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_cbow_cache(path, directory, vocab=None, do_lowercase=True, encoding='utf-8'):
+    '''
+    Preprocess a text file with iter_cbow_preprocess into a cache directory: 'vocab.txt' with one token per line in the order of their ids,
+    'ids.npy' with the int32 ids of all the tokens and 'offsets.npy' with the int64 offsets of the sentences.
+    '''
+    import shutil, tempfile
+    word2idx = {}
+    ids = [np.zeros(0, dtype=np.int32)]
+    for sentence in iter_cbow_preprocess(read_paragraphs(path, encoding), vocab, do_lowercase):
+        ids.append(np.array([word2idx.setdefault(word, len(word2idx)) for word in sentence], dtype=np.int32))
+    offsets = np.zeros(len(ids), dtype=np.int64)
+    np.cumsum([len(sentence) for sentence in ids[1:]], out=offsets[1:])
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent)
+    with open(os.path.join(temporary, 'vocab.txt'), 'w', encoding='utf-8') as f:
+        f.writelines(word + '\n' for word in word2idx)
+    np.save(os.path.join(temporary, 'ids.npy'), np.concatenate(ids))
+    np.save(os.path.join(temporary, 'offsets.npy'), offsets)
+    try:
+        os.rename(temporary, directory) # The cache directory only appears once complete
+    except OSError: # Written by another process in the meantime
+        shutil.rmtree(temporary)
+
+def load_cbow_corpus(path, vocab=None, do_lowercase=True, cache_dir='.cache', encoding='utf-8'):
+    '''
+    Offline, cached version of cbow_preprocess(read_paragraphs(path), vocab, do_lowercase) for a raw text file.
+    The first call preprocesses the file into cache_dir, under the key of its contents and options (see cbow_corpus_key);
+    the next ones memory-map the cached arrays instead of reading the text again.
+    Return the list of sentences and the token counts (or 'vocab' if given), like cbow_preprocess.
+    '''
+    directory = os.path.join(cache_dir, cbow_corpus_key(path, vocab, do_lowercase, encoding))
+    if not os.path.isdir(directory):
+        write_cbow_cache(path, directory, vocab, do_lowercase, encoding)
+    with open(os.path.join(directory, 'vocab.txt'), encoding='utf-8') as f:
+        tokens = f.read().split('\n')[:-1]
+    ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r').tolist()
+    words = np.array(tokens, dtype=object)[ids].tolist()
+    sentences = [words[lo:hi] for lo, hi in zip(offsets[:-1], offsets[1:])]
+    if vocab is None:
+        vocab = dict(zip(tokens, np.bincount(ids, minlength=len(tokens)).tolist()))
+    return sentences, vocab
+
+def getDataset(directory=None, cache_dir='.cache'):
+    '''
+    Return the preprocessed training sentences of WikiText-2 and their token counts, downloaded through torchtext,
+    or read offline from the wiki.train.raw file of 'directory' and cached (see load_cbow_corpus).
+    '''
+    if directory is not None:
+        return load_cbow_corpus(os.path.join(directory, 'wiki.train.raw'), cache_dir=cache_dir)
+
+    import torchtext
     dataset = torchtext.datasets.WikiText2(root='.data', split=('train',))
     train_dataset, vocab = cbow_preprocess(dataset[0])
     return train_dataset, vocab
@@ -85,12 +181,14 @@ if __name__ == '__main__':
     for x in random.sample(sentences, 10):
         print (x)
 
-"""## Define the dataset class"""
+"""## Define the dataset class
+
+Importing this file doesn't import torch: it is imported inside the functions that use it, `CbowDataset` is a plain map-style dataset (what `torch.utils.data.DataLoader` expects: `__len__` and `__getitem__`), and `CbowModel` and `DEVICE`, which need torch to be defined, are created on first access (see `getCbowModel` and `getDevice`). The preprocessing and cache functions above only use numpy, itself imported with `lazyImport`.
+"""
 
-from torch.utils import data
 from collections import defaultdict
 
-class CbowDataset(data.Dataset):
+class CbowDataset(object):
     def __init__(self, sentences, vocab, context_size):
 
         assert CBOW_START in vocab and CBOW_END in vocab and CBOW_UNK in vocab
@@ -142,6 +240,7 @@ class CbowDataset(data.Dataset):
         assert len(self.training_examples) > 0
         context_words = self.training_examples[idx][0]
         context_indices = [self.word2idx[word] for word in context_words]
+        import torch
         return torch.tensor(context_indices)
 
     def get_target_index(self, idx):
@@ -173,6 +272,7 @@ class CbowDataset(data.Dataset):
 """
 
 def sanityCheckCbowDataset():
+    import torch
     #	Read in the sample corpus
     test_sents = [['<s>', 'the', 'man', 'walks', 'the', 'dog', 'in', 'the', 'park', '</s>'],
             ['<s>', 'i', 'saw', 'the', 'man', 'with', 'the', 'telescope', 'on', 'the', CBOW_UNK, '</s>']]
@@ -271,52 +371,93 @@ if __name__ == '__main__':
 
 """## Define the CBOW Model"""
 
-class CbowModel(nn.Module):
-    def __init__(self, vocab_size, embed_size, hidden_size, context_size):
-        '''
-        vocab_size: Size of the vocabulary
-        embed_size: Size of your embedding vectors
-        hidden_size: Size of hidden layer of neural network
-        context_size: The size of your context window used to generate training examples
-        '''
-        super(CbowModel, self).__init__()
+def getDevice():
+    '''
+    Return the torch.device the model is trained on: the GPU if torch can use one, else the CPU. Resolved on the first call.
+    '''
+    global DEVICE_CACHE
+    if DEVICE_CACHE is None:
+        import torch
+        DEVICE_CACHE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return DEVICE_CACHE
 
-        self.context_size = context_size
+DEVICE_CACHE = None
 
-        self.embedding = nn.Embedding(vocab_size, embed_size)
+def getCbowModel():
+    '''
+    Return the CbowModel class, a torch.nn.Module defined on the first call so that importing this file doesn't import torch.
+    word_embedding.CbowModel and word_embedding.DEVICE call getCbowModel() and getDevice() on first access.
+    '''
+    global CBOW_MODEL_CACHE
+    if CBOW_MODEL_CACHE is not None:
+        return CBOW_MODEL_CACHE
+    import torch
 
-        self.linear1 = nn.Linear(embed_size, hidden_size)
+    class CbowModel(torch.nn.Module):
+        def __init__(self, vocab_size, embed_size, hidden_size, context_size):
+            '''
+            vocab_size: Size of the vocabulary
+            embed_size: Size of your embedding vectors
+            hidden_size: Size of hidden layer of neural network
+            context_size: The size of your context window used to generate training examples
+            '''
+            super(CbowModel, self).__init__()
 
-        self.linear2 = nn.Linear(hidden_size, vocab_size)
+            self.context_size = context_size
 
-    def forward(self, inputs):
-        '''
-        inputs: Tensor of size [batch_size, 2*context_size]
+            self.embedding = torch.nn.Embedding(vocab_size, embed_size)
 
-        Returns output: Tensor of size [batch_size, vocab_size]
-        '''
+            self.linear1 = torch.nn.Linear(embed_size, hidden_size)
+
+            self.linear2 = torch.nn.Linear(hidden_size, vocab_size)
+
+        def forward(self, inputs):
+            '''
+            inputs: Tensor of size [batch_size, 2*context_size]
+
+            Returns output: Tensor of size [batch_size, vocab_size]
+            '''
+
+            embeddings = self.embedding(inputs)
 
-        embeddings = self.embedding(inputs)
+            avarge_embeddings = torch.mean(embeddings, 1)
 
-        avarge_embeddings = torch.mean(embeddings, 1)
+            linear_out = torch.nn.functional.relu(self.linear1(avarge_embeddings))
 
-        linear_out = F.relu(self.linear1(avarge_embeddings))
+            linear_out = self.linear2(linear_out)
 
-        linear_out = self.linear2(linear_out)
+            return linear_out
 
-        return linear_out
+    CBOW_MODEL_CACHE = CbowModel
+    return CbowModel
+
+CBOW_MODEL_CACHE = None
+
+def __getattr__(name):
+    # Module attributes that need torch, created on first access (PEP 562)
+    if name == 'CbowModel':
+        return getCbowModel()
+    if name == 'DEVICE':
+        return getDevice()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+if __name__=='__main__':
+    CbowModel, DEVICE = getCbowModel(), getDevice()
+    print('Using device:', DEVICE)
 
 """Sanity Check"""
 
 count_parameters = lambda model: sum(p.numel() for p in model.parameters() if p.requires_grad)
 
 def makeCbowSanityBatch(test_params):
+    import torch
     batch_size = test_params['batch_size']
     new_test_params = {k:v for k,v in test_params.items() if k != 'batch_size'}
     batch = torch.randint(0, new_test_params['vocab_size'], (batch_size,new_test_params['context_size']*2))
     return batch, new_test_params
 
 def sanityCheckModel(all_test_params, NN, expected_outputs, init_or_forward, make_batch_fxn=None):
+    import torch
     print('--- TEST: ' + ('Number of Model Parameters (tests __init__(...))' if init_or_forward=='init' else 'Output shape of forward(...)') + ' ---')
 
     for tp_idx, (test_params, expected_output) in enumerate(zip(all_test_params, expected_outputs)):
@@ -355,6 +496,8 @@ def sanityCheckModel(all_test_params, NN, expected_outputs, init_or_forward, mak
 
 
 if __name__ == '__main__':
+    import torch
+
     # Test init
     cbow_init_inputs = [{'vocab_size': 10, 'embed_size': 32, 'hidden_size': 64, 'context_size': 2}, {'vocab_size': 10, 'embed_size': 32, 'hidden_size': 64, 'context_size': 4}, {'vocab_size': 10, 'embed_size': 32, 'hidden_size': 128, 'context_size': 2}, {'vocab_size': 10, 'embed_size': 32, 'hidden_size': 128, 'context_size': 4}, {'vocab_size': 10, 'embed_size': 64, 'hidden_size': 64, 'context_size': 2}, {'vocab_size': 10, 'embed_size': 64, 'hidden_size': 64, 'context_size': 4}, {'vocab_size': 10, 'embed_size': 64, 'hidden_size': 128, 'context_size': 2}, {'vocab_size': 10, 'embed_size': 64, 'hidden_size': 128, 'context_size': 4}, {'vocab_size': 1000, 'embed_size': 32, 'hidden_size': 64, 'context_size': 2}, {'vocab_size': 1000, 'embed_size': 32, 'hidden_size': 64, 'context_size': 4}, {'vocab_size': 1000, 'embed_size': 32, 'hidden_size': 128, 'context_size': 2}, {'vocab_size': 1000, 'embed_size': 32, 'hidden_size': 128, 'context_size': 4}, {'vocab_size': 1000, 'embed_size': 64, 'hidden_size': 64, 'context_size': 2}, {'vocab_size': 1000, 'embed_size': 64, 'hidden_size': 64, 'context_size': 4}, {'vocab_size': 1000, 'embed_size': 64, 'hidden_size': 128, 'context_size': 2}, {'vocab_size': 1000, 'embed_size': 64, 'hidden_size': 128, 'context_size': 4}]
     cbow_init_expected_outputs = [3082, 3082, 5834, 5834, 5450, 5450, 10250, 10250, 99112, 99112, 165224, 165224, 133160, 133160, 201320, 201320]
@@ -381,10 +524,9 @@ if __name__=='__main__':
     cbow_dataset = CbowDataset(sentences, vocab, CONTEXT_SIZE)
     cbow_dataloader = torch.utils.data.DataLoader(cbow_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=2, drop_last=True)
 
-from tqdm.notebook import tqdm
-from torch import optim
-
 def train_cbow_model(model, num_epochs, data_loader, optimizer, criterion):
+    from tqdm.notebook import tqdm
+    DEVICE = getDevice()
     print("Training CBOW model....")
     for epoch in range(num_epochs):
         epoch_loss, n = 0, 0
@@ -415,16 +557,14 @@ if __name__=='__main__':
 
 """Create the criterion to measure the loss of the model."""
 
-import torch.optim as optim
-
 if __name__=='__main__':
     LEARNING_RATE = 0.01
 
     # Define the loss function
-    criterion = nn.CrossEntropyLoss().to(DEVICE)
+    criterion = torch.nn.CrossEntropyLoss().to(DEVICE)
 
     # Define the optimizer
-    optimizer = optim.Adam(cbow_model.parameters(), lr=LEARNING_RATE)
+    optimizer = torch.optim.Adam(cbow_model.parameters(), lr=LEARNING_RATE)
 
 if __name__=='__main__':
     N_EPOCHS = 6 # Feel free to change this
@@ -455,4 +595,28 @@ if __name__=='__main__':
     fig = px.scatter(df, x='x', y='y', text='word')
     fig.update_traces(textposition='top center')
     fig.update_layout(height=600, title_text='Word Embedding 2D Visualization')
-    fig.show()
\ No newline at end of file
+    fig.show()
+"""## Importing the model
+
+`importReport` measures the cold start of `import word_embedding` in fresh interpreters: it should take a few milliseconds and execute neither torch, torchtext nor numpy, which are only loaded by the first code path that uses them.
+"""
+
+def importReport(module='word_embedding', runs=5, heavy=('numpy', 'torch', 'torchtext', 'tqdm')):
+    '''
+    Import the module in 'runs' new interpreters, from the directory of this file, and return the best import time in milliseconds
+    with the list of the heavy modules actually executed by the import (it should be empty).
+    Python writes the bytecode of the module on the first run, unless PYTHONDONTWRITEBYTECODE is set: the next runs only load it.
+    '''
+    import subprocess
+    code = ("import sys, time, types; start = time.perf_counter(); import %s; elapsed = time.perf_counter() - start; "
+            "print(elapsed * 1000, *[name for name in %r if type(sys.modules.get(name)) is types.ModuleType])" % (module, list(heavy)))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for i in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=directory, capture_output=True, text=True, check=True).stdout.split()
+        results.append((float(output[0]), output[1:]))
+    milliseconds, loaded = min(results)
+    return {'import ms': round(milliseconds, 1), 'heavy modules executed': loaded}
+
+if __name__=='__main__':
+    print(importReport())